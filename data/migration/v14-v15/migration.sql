@@ -0,0 +1,28 @@
+BEGIN;
+
+-- Render telemetry {{{
+CREATE TYPE analytics.RenderStatus AS ENUM(
+  'SUCCESS',
+  'UNKNOWN_ROUTE',
+  'SYSTEM_ERROR',
+  'RENDER_ERROR',
+  'TIMED_OUT',
+  'CONNECTION_FAILURE',
+  'CANCELLED'
+);
+
+ALTER TABLE analytics.gui_renders ADD COLUMN skin TEXT;
+ALTER TABLE analytics.gui_renders ADD COLUMN locale TEXT;
+ALTER TABLE analytics.gui_renders ADD COLUMN queue_wait INTEGER;
+ALTER TABLE analytics.gui_renders ADD COLUMN render_time INTEGER;
+ALTER TABLE analytics.gui_renders ADD COLUMN output_bytes INTEGER;
+ALTER TABLE analytics.gui_renders ADD COLUMN cache_hit BOOLEAN;
+ALTER TABLE analytics.gui_renders ADD COLUMN status analytics.RenderStatus NOT NULL DEFAULT 'SUCCESS';
+ALTER TABLE analytics.gui_renders ADD COLUMN error TEXT;
+CREATE INDEX gui_renders_created_at ON analytics.gui_renders (created_at);
+-- }}}
+
+INSERT INTO VersionHistory (version, author) VALUES (15, 'v14-v15 migration');
+COMMIT;
+
+-- vim: set fdm=marker:
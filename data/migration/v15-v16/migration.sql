@@ -0,0 +1,64 @@
+BEGIN;
+
+-- Analytics rollups {{{
+CREATE INDEX commands_created_at ON analytics.commands (created_at);
+CREATE INDEX voice_sessions_created_at ON analytics.voice_sessions (created_at);
+CREATE INDEX snapshots_created_at ON analytics.snapshots (created_at);
+
+CREATE TYPE analytics.RollupPeriod AS ENUM(
+  'HOUR',
+  'DAY'
+);
+
+CREATE TABLE analytics.rollup_state(
+  name TEXT PRIMARY KEY,
+  rolled_until TIMESTAMPTZ NOT NULL
+);
+
+CREATE TABLE analytics.command_rollups(
+  period analytics.RollupPeriod NOT NULL,
+  bucket TIMESTAMPTZ NOT NULL,
+  appname TEXT NOT NULL,
+  cmdname TEXT NOT NULL,
+  status analytics.CommandStatus NOT NULL,
+  count INTEGER NOT NULL,
+  total_time REAL NOT NULL,
+  max_time REAL NOT NULL,
+  PRIMARY KEY (period, bucket, appname, cmdname, status)
+);
+
+CREATE TABLE analytics.voice_rollups(
+  period analytics.RollupPeriod NOT NULL,
+  bucket TIMESTAMPTZ NOT NULL,
+  appname TEXT NOT NULL,
+  guildid BIGINT NOT NULL,
+  joins INTEGER NOT NULL,
+  leaves INTEGER NOT NULL,
+  PRIMARY KEY (period, bucket, appname, guildid)
+);
+
+CREATE TABLE analytics.snapshot_rollups(
+  period analytics.RollupPeriod NOT NULL,
+  bucket TIMESTAMPTZ NOT NULL,
+  appname TEXT NOT NULL,
+  samples INTEGER NOT NULL,
+  guild_min INTEGER NOT NULL,
+  guild_max INTEGER NOT NULL,
+  guild_sum BIGINT NOT NULL,
+  member_min INTEGER NOT NULL,
+  member_max INTEGER NOT NULL,
+  member_sum BIGINT NOT NULL,
+  user_min INTEGER NOT NULL,
+  user_max INTEGER NOT NULL,
+  user_sum BIGINT NOT NULL,
+  voice_min INTEGER NOT NULL,
+  voice_max INTEGER NOT NULL,
+  voice_sum BIGINT NOT NULL,
+  PRIMARY KEY (period, bucket, appname)
+);
+-- }}}
+
+INSERT INTO VersionHistory (version, author) VALUES (16, 'v15-v16 migration');
+COMMIT;
+
+-- vim: set fdm=marker:
@@ -0,0 +1,235 @@
+BEGIN;
+
+-- Partition voice_sessions by month {{{
+DROP VIEW voice_sessions_combined;
+
+-- Older deployments inherit the constraint, index and sequence names of session_history,
+-- so the old names are resolved from the catalog rather than assumed.
+CREATE OR REPLACE FUNCTION _detach_unpartitioned(_table TEXT)
+  RETURNS VOID
+AS $$
+  DECLARE
+    _old TEXT := _table || '_unpartitioned';
+    _pkey TEXT;
+    _seq REGCLASS;
+  BEGIN
+    EXECUTE format('ALTER TABLE %I RENAME TO %I', _table, _old);
+
+    SELECT conname INTO _pkey FROM pg_constraint WHERE conrelid = _old::regclass AND contype = 'p';
+    EXECUTE format('ALTER TABLE %I RENAME CONSTRAINT %I TO %I', _old, _pkey, _old || '_pkey');
+
+    _seq := pg_get_serial_sequence(_old, 'sessionid')::regclass;
+    EXECUTE format('ALTER SEQUENCE %s OWNED BY NONE', _seq);
+    IF to_regclass(_table || '_sessionid_seq') IS DISTINCT FROM _seq THEN
+      EXECUTE format('ALTER SEQUENCE %s RENAME TO %I', _seq, _table || '_sessionid_seq');
+    END IF;
+  END;
+$$ LANGUAGE PLPGSQL;
+
+SELECT _detach_unpartitioned('voice_sessions');
+DROP INDEX IF EXISTS voice_session_members;
+DROP INDEX IF EXISTS voice_session_guild_time;
+DROP INDEX IF EXISTS voice_session_user_time;
+DROP INDEX IF EXISTS session_history_members;
+
+CREATE TABLE voice_sessions(
+  sessionid INTEGER NOT NULL DEFAULT nextval('voice_sessions_sessionid_seq'),
+  guildid BIGINT NOT NULL,
+  userid BIGINT NOT NULL,
+  channelid BIGINT,
+  rating INTEGER,
+  tag TEXT,
+  start_time TIMESTAMPTZ NOT NULL,
+  duration INTEGER NOT NULL,
+  live_duration INTEGER DEFAULT 0,
+  stream_duration INTEGER DEFAULT 0,
+  video_duration INTEGER DEFAULT 0,
+  transactionid INTEGER REFERENCES coin_transactions (transactionid) ON UPDATE CASCADE ON DELETE CASCADE,
+  PRIMARY KEY (sessionid, start_time),
+  FOREIGN KEY (guildid, userid) REFERENCES members (guildid, userid) ON DELETE CASCADE
+) PARTITION BY RANGE (start_time);
+ALTER SEQUENCE voice_sessions_sessionid_seq OWNED BY voice_sessions.sessionid;
+CREATE INDEX voice_session_members ON voice_sessions (guildid, userid, start_time);
+CREATE INDEX voice_session_guild_time ON voice_sessions USING BTREE (guildid, start_time);
+CREATE INDEX voice_session_user_time ON voice_sessions USING BTREE (userid, start_time);
+ALTER TABLE voice_sessions ADD FOREIGN KEY (channelid) REFERENCES tracked_channels (channelid);
+CREATE TABLE voice_sessions_default PARTITION OF voice_sessions DEFAULT;
+-- }}}
+
+-- Partition text_sessions by month {{{
+SELECT _detach_unpartitioned('text_sessions');
+DROP INDEX IF EXISTS text_sessions_members;
+DROP INDEX IF EXISTS text_sessions_start_time;
+DROP INDEX IF EXISTS text_sessions_end_time;
+
+CREATE TABLE text_sessions(
+  sessionid BIGINT NOT NULL DEFAULT nextval('text_sessions_sessionid_seq'),
+  guildid BIGINT NOT NULL,
+  userid BIGINT NOT NULL,
+  start_time TIMESTAMPTZ NOT NULL,
+  duration INTEGER NOT NULL,
+  messages INTEGER NOT NULL,
+  words INTEGER NOT NULL,
+  periods INTEGER NOT NULL,
+  user_expid BIGINT REFERENCES user_experience,
+  member_expid BIGINT REFERENCES member_experience,
+  end_time TIMESTAMP GENERATED ALWAYS AS
+    ((start_time AT TIME ZONE 'UTC') + duration * interval '1 second')
+  STORED,
+  PRIMARY KEY (sessionid, start_time),
+  FOREIGN KEY (guildid, userid) REFERENCES members (guildid, userid) ON DELETE CASCADE
+) PARTITION BY RANGE (start_time);
+ALTER SEQUENCE text_sessions_sessionid_seq OWNED BY text_sessions.sessionid;
+CREATE INDEX text_sessions_members ON text_sessions (guildid, userid);
+CREATE INDEX text_sessions_end_time ON text_sessions (end_time);
+CREATE TABLE text_sessions_default PARTITION OF text_sessions DEFAULT;
+-- }}}
+
+-- Monthly session partition maintenance {{{
+-- Partitions are named <table>_yYYYYmMM, and cover one UTC calendar month of start_time.
+-- Rows outside the existing partitions land in <table>_default,
+-- and are moved into their partition when it is created.
+
+CREATE OR REPLACE FUNCTION create_month_partition(_parent TEXT, _month DATE)
+  RETURNS TEXT
+AS $$
+  DECLARE
+    _month_start TIMESTAMP := date_trunc('month', _month::TIMESTAMP);
+    _start TIMESTAMPTZ := _month_start AT TIME ZONE 'UTC';
+    _end TIMESTAMPTZ := (_month_start + interval '1 month') AT TIME ZONE 'UTC';
+    _name TEXT := _parent || to_char(_month_start, '"_y"YYYY"m"MM');
+    _default TEXT := _parent || '_default';
+    _columns TEXT;
+  BEGIN
+    IF to_regclass(_name) IS NOT NULL THEN
+      RETURN _name;
+    END IF;
+
+    SELECT string_agg(quote_ident(column_name), ', ' ORDER BY ordinal_position) INTO _columns
+    FROM information_schema.columns
+    WHERE table_schema = current_schema() AND table_name = _parent AND is_generated = 'NEVER';
+
+    -- Move any rows for this month out of the default partition, so the new partition may be attached
+    EXECUTE format(
+      'CREATE TEMPORARY TABLE _partition_rows AS SELECT %s FROM %I WHERE start_time >= %L AND start_time < %L',
+      _columns, _default, _start, _end
+    );
+    EXECUTE format('DELETE FROM %I WHERE start_time >= %L AND start_time < %L', _default, _start, _end);
+
+    EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)', _name, _parent, _start, _end);
+    -- Recent partitions are indexed on start_time with a B-tree,
+    -- replaced by a BRIN index once the month has closed
+    EXECUTE format('CREATE INDEX %I ON %I (start_time)', _name || '_start_time', _name);
+
+    EXECUTE format('INSERT INTO %I (%s) SELECT %s FROM _partition_rows', _parent, _columns, _columns);
+    DROP TABLE _partition_rows;
+    RETURN _name;
+  END;
+$$ LANGUAGE PLPGSQL;
+
+CREATE OR REPLACE FUNCTION create_session_partitions(_months_ahead INTEGER DEFAULT 3)
+  RETURNS SETOF TEXT
+AS $$
+  DECLARE
+    _this_month TIMESTAMP := date_trunc('month', NOW() AT TIME ZONE 'UTC');
+    _month TIMESTAMP;
+  BEGIN
+    FOR _month IN
+      SELECT generate_series(_this_month, _this_month + make_interval(months => _months_ahead), interval '1 month')
+    LOOP
+      RETURN NEXT create_month_partition('voice_sessions', _month::DATE);
+      RETURN NEXT create_month_partition('text_sessions', _month::DATE);
+    END LOOP;
+  END;
+$$ LANGUAGE PLPGSQL;
+
+CREATE OR REPLACE FUNCTION index_closed_session_partitions()
+  RETURNS SETOF TEXT
+AS $$
+  DECLARE
+    _this_month TIMESTAMP := date_trunc('month', NOW() AT TIME ZONE 'UTC');
+    _partition TEXT;
+  BEGIN
+    FOR _partition IN
+      SELECT child.relname
+      FROM pg_inherits
+      JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+      JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+      WHERE parent.relname IN ('voice_sessions', 'text_sessions')
+        AND child.relname ~ '_y\d{4}m\d{2}$'
+        AND to_date(substring(child.relname from '\d{4}m\d{2}$'), 'YYYY"m"MM') < _this_month
+        AND to_regclass(child.relname || '_start_time_brin') IS NULL
+    LOOP
+      EXECUTE format('CREATE INDEX %I ON %I USING BRIN (start_time)', _partition || '_start_time_brin', _partition);
+      EXECUTE format('DROP INDEX IF EXISTS %I', _partition || '_start_time');
+      RETURN NEXT _partition;
+    END LOOP;
+  END;
+$$ LANGUAGE PLPGSQL;
+-- }}}
+
+
+-- Move existing sessions into their partitions {{{
+SELECT create_month_partition('voice_sessions', month::DATE)
+FROM generate_series(
+  date_trunc('month', (SELECT MIN(start_time) FROM voice_sessions_unpartitioned) AT TIME ZONE 'UTC'),
+  date_trunc('month', NOW() AT TIME ZONE 'UTC'),
+  interval '1 month'
+) AS month;
+
+SELECT create_month_partition('text_sessions', month::DATE)
+FROM generate_series(
+  date_trunc('month', (SELECT MIN(start_time) FROM text_sessions_unpartitioned) AT TIME ZONE 'UTC'),
+  date_trunc('month', NOW() AT TIME ZONE 'UTC'),
+  interval '1 month'
+) AS month;
+
+SELECT create_session_partitions(3);
+
+INSERT INTO voice_sessions (
+  sessionid, guildid, userid, channelid, rating, tag,
+  start_time, duration, live_duration, stream_duration, video_duration, transactionid
+) SELECT
+  sessionid, guildid, userid, channelid, rating, tag,
+  start_time, duration, live_duration, stream_duration, video_duration, transactionid
+FROM voice_sessions_unpartitioned;
+
+INSERT INTO text_sessions (
+  sessionid, guildid, userid, start_time, duration, messages, words, periods, user_expid, member_expid
+) SELECT
+  sessionid, guildid, userid, start_time, duration, messages, words, periods, user_expid, member_expid
+FROM text_sessions_unpartitioned;
+
+DROP TABLE voice_sessions_unpartitioned;
+DROP TABLE text_sessions_unpartitioned;
+DROP FUNCTION _detach_unpartitioned(TEXT);
+
+SELECT index_closed_session_partitions();
+-- }}}
+
+-- Recreate combined voice session view {{{
+CREATE VIEW voice_sessions_combined AS
+  SELECT
+    userid,
+    guildid,
+    start_time,
+    duration,
+    (start_time + duration * interval '1 second') AS end_time
+  FROM voice_sessions
+  UNION ALL
+  SELECT
+    userid,
+    guildid,
+    start_time,
+    EXTRACT(EPOCH FROM (NOW() - start_time)) AS duration,
+    NOW() AS end_time
+  FROM voice_sessions_ongoing;
+-- }}}
+
+ANALYZE voice_sessions;
+ANALYZE text_sessions;
+
+INSERT INTO VersionHistory (version, author) VALUES (17, 'v16-v17 migration');
+COMMIT;
+
+-- vim: set fdm=marker:
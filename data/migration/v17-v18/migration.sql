@@ -0,0 +1,234 @@
+BEGIN;
+
+-- Compacted voice history {{{
+-- Voice sessions older than the compaction horizon are folded into per-member daily totals.
+-- Each day is split at UTC midnight, and the compacted and raw regions never overlap in time.
+CREATE TABLE voice_session_days(
+  guildid BIGINT NOT NULL,
+  userid BIGINT NOT NULL,
+  day DATE NOT NULL,
+  sessions INTEGER NOT NULL DEFAULT 0,
+  duration INTEGER NOT NULL DEFAULT 0,
+  live_duration INTEGER NOT NULL DEFAULT 0,
+  stream_duration INTEGER NOT NULL DEFAULT 0,
+  video_duration INTEGER NOT NULL DEFAULT 0,
+  coins_earned INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (guildid, userid, day),
+  FOREIGN KEY (guildid, userid) REFERENCES members (guildid, userid) ON DELETE CASCADE
+);
+CREATE INDEX voice_session_days_users ON voice_session_days (userid, day);
+
+-- Voice time per user per day across all guilds, with overlapping sessions counted once
+CREATE TABLE voice_user_days(
+  userid BIGINT NOT NULL REFERENCES user_config (userid) ON DELETE CASCADE,
+  day DATE NOT NULL,
+  duration INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (userid, day)
+);
+-- }}}
+
+-- Compaction function {{{
+CREATE FUNCTION compact_voice_sessions(_until TIMESTAMPTZ)
+  RETURNS INTEGER
+AS $$
+  DECLARE
+    _count INTEGER;
+  BEGIN
+    -- Sessions starting before _until, with the number of seconds before _until to compact.
+    -- Sessions running over _until are truncated to start at _until, and finished on a later run.
+    CREATE TEMPORARY TABLE _compacting ON COMMIT DROP AS
+      SELECT
+        sessionid, guildid, userid, start_time, duration, transactionid,
+        COALESCE(live_duration, 0) AS live_duration,
+        COALESCE(stream_duration, 0) AS stream_duration,
+        COALESCE(video_duration, 0) AS video_duration,
+        LEAST(duration, CEIL(EXTRACT(EPOCH FROM (_until - start_time))))::INTEGER AS compacted
+      FROM voice_sessions
+      WHERE start_time < _until;
+
+    -- Split the compacted part of each session at UTC midnight.
+    -- Piece lengths are differences of offsets from the session start, so they sum to exactly `compacted`.
+    CREATE TEMPORARY TABLE _pieces ON COMMIT DROP AS
+      SELECT
+        guildid, userid, day::DATE AS day,
+        (
+          LEAST(compacted, GREATEST(0, FLOOR(EXTRACT(EPOCH FROM (((day + interval '1 day') AT TIME ZONE 'UTC') - start_time)))))
+          - LEAST(compacted, GREATEST(0, FLOOR(EXTRACT(EPOCH FROM ((day AT TIME ZONE 'UTC') - start_time)))))
+        )::INTEGER AS duration,
+        tstzrange(
+          GREATEST(start_time, day AT TIME ZONE 'UTC'),
+          LEAST(start_time + compacted * interval '1 second', (day + interval '1 day') AT TIME ZONE 'UTC')
+        ) AS span
+      FROM _compacting,
+      generate_series(
+        date_trunc('day', start_time AT TIME ZONE 'UTC'),
+        date_trunc('day', (start_time + compacted * interval '1 second') AT TIME ZONE 'UTC'),
+        interval '1 day'
+      ) AS day;
+
+    -- Session counts, stream durations and coins are attributed to the day the session started.
+    -- The stream durations of truncated sessions are split in proportion to the compacted time.
+    INSERT INTO voice_session_days (
+      guildid, userid, day, sessions, duration, live_duration, stream_duration, video_duration, coins_earned
+    )
+      SELECT
+        guildid, userid, day,
+        SUM(sessions), SUM(duration), SUM(live_duration), SUM(stream_duration), SUM(video_duration), SUM(coins)
+      FROM (
+        SELECT guildid, userid, day, 0 AS sessions, duration,
+          0 AS live_duration, 0 AS stream_duration, 0 AS video_duration, 0 AS coins
+        FROM _pieces
+        UNION ALL
+        SELECT
+          c.guildid, c.userid, (c.start_time AT TIME ZONE 'UTC')::DATE,
+          (c.compacted = c.duration)::INTEGER,
+          0,
+          c.live_duration::BIGINT * c.compacted / GREATEST(c.duration, 1),
+          c.stream_duration::BIGINT * c.compacted / GREATEST(c.duration, 1),
+          c.video_duration::BIGINT * c.compacted / GREATEST(c.duration, 1),
+          CASE WHEN c.compacted = c.duration THEN COALESCE(t.amount + t.bonus, 0) ELSE 0 END
+        FROM _compacting c
+        LEFT JOIN coin_transactions t ON t.transactionid = c.transactionid
+      ) AS parts
+      GROUP BY guildid, userid, day
+    ON CONFLICT (guildid, userid, day) DO UPDATE SET
+      sessions = voice_session_days.sessions + EXCLUDED.sessions,
+      duration = voice_session_days.duration + EXCLUDED.duration,
+      live_duration = voice_session_days.live_duration + EXCLUDED.live_duration,
+      stream_duration = voice_session_days.stream_duration + EXCLUDED.stream_duration,
+      video_duration = voice_session_days.video_duration + EXCLUDED.video_duration,
+      coins_earned = voice_session_days.coins_earned + EXCLUDED.coins_earned;
+
+    INSERT INTO voice_user_days (userid, day, duration)
+      SELECT userid, day, SUM(EXTRACT(EPOCH FROM (upper(part) - lower(part))))::INTEGER
+      FROM (
+        SELECT userid, day, unnest(range_agg(span)) AS part
+        FROM _pieces
+        WHERE NOT isempty(span)
+        GROUP BY userid, day
+      ) AS merged
+      GROUP BY userid, day
+    ON CONFLICT (userid, day) DO UPDATE SET
+      duration = voice_user_days.duration + EXCLUDED.duration;
+
+    UPDATE voice_sessions s SET
+      start_time = c.start_time + c.compacted * interval '1 second',
+      duration = c.duration - c.compacted,
+      live_duration = c.live_duration - c.live_duration::BIGINT * c.compacted / GREATEST(c.duration, 1),
+      stream_duration = c.stream_duration - c.stream_duration::BIGINT * c.compacted / GREATEST(c.duration, 1),
+      video_duration = c.video_duration - c.video_duration::BIGINT * c.compacted / GREATEST(c.duration, 1)
+    FROM _compacting c
+    WHERE s.sessionid = c.sessionid AND s.start_time = c.start_time AND c.compacted < c.duration;
+
+    DELETE FROM voice_sessions s
+    USING _compacting c
+    WHERE s.sessionid = c.sessionid AND s.start_time = c.start_time AND c.compacted = c.duration;
+    GET DIAGNOSTICS _count = ROW_COUNT;
+
+    DROP TABLE _compacting;
+    DROP TABLE _pieces;
+    RETURN _count;
+  END;
+$$ LANGUAGE PLPGSQL;
+-- }}}
+
+-- Statistics over compacted history {{{
+-- Compacted days appear as a single block of time starting at UTC midnight.
+DROP FUNCTION study_time_since(_guildid BIGINT, _userid BIGINT, _timestamp TIMESTAMPTZ);
+DROP FUNCTION study_time_between(_guildid BIGINT, _userid BIGINT, _start TIMESTAMPTZ, _end TIMESTAMPTZ);
+DROP VIEW voice_sessions_combined;
+
+CREATE VIEW voice_sessions_combined AS
+  SELECT
+    userid,
+    guildid,
+    start_time,
+    duration,
+    (start_time + duration * interval '1 second') AS end_time
+  FROM voice_sessions
+  UNION ALL
+  SELECT
+    userid,
+    guildid,
+    start_time,
+    EXTRACT(EPOCH FROM (NOW() - start_time)) AS duration,
+    NOW() AS end_time
+  FROM voice_sessions_ongoing
+  UNION ALL
+  SELECT
+    userid,
+    guildid,
+    day::TIMESTAMP AT TIME ZONE 'UTC' AS start_time,
+    duration,
+    (day::TIMESTAMP AT TIME ZONE 'UTC') + duration * interval '1 second' AS end_time
+  FROM voice_session_days;
+
+CREATE VIEW voice_user_history AS
+  SELECT
+    userid,
+    start_time,
+    (start_time + duration * interval '1 second') AS end_time
+  FROM voice_sessions
+  UNION ALL
+  SELECT
+    userid,
+    start_time,
+    NOW() AS end_time
+  FROM voice_sessions_ongoing
+  UNION ALL
+  SELECT
+    userid,
+    day::TIMESTAMP AT TIME ZONE 'UTC' AS start_time,
+    (day::TIMESTAMP AT TIME ZONE 'UTC') + duration * interval '1 second' AS end_time
+  FROM voice_user_days;
+
+CREATE FUNCTION study_time_between(_guildid BIGINT, _userid BIGINT, _start TIMESTAMPTZ, _end TIMESTAMPTZ)
+  RETURNS INTEGER
+AS $$
+  BEGIN
+    IF _guildid IS NULL THEN
+      -- Per-guild compacted days may overlap, so use the merged per-user days
+      RETURN (
+        SELECT
+          SUM(COALESCE(EXTRACT(EPOCH FROM (upper(part) - lower(part))), 0))
+        FROM (
+          SELECT
+          unnest(range_agg(tstzrange(start_time, end_time)) * multirange(tstzrange(_start, _end))) AS part
+          FROM voice_user_history
+          WHERE
+            userid=_userid
+            AND start_time < _end
+            AND end_time > _start
+        ) AS disjoint_parts
+      );
+    END IF;
+    RETURN (
+      SELECT
+        SUM(COALESCE(EXTRACT(EPOCH FROM (upper(part) - lower(part))), 0))
+      FROM (
+        SELECT
+        unnest(range_agg(tstzrange(start_time, end_time)) * multirange(tstzrange(_start, _end))) AS part
+        FROM voice_sessions_combined
+        WHERE
+          guildid=_guildid
+          AND userid=_userid
+          AND start_time < _end
+          AND end_time > _start
+      ) AS disjoint_parts
+    );
+  END;
+$$ LANGUAGE PLPGSQL;
+
+CREATE FUNCTION study_time_since(_guildid BIGINT, _userid BIGINT, _timestamp TIMESTAMPTZ)
+  RETURNS INTEGER
+AS $$
+  BEGIN
+    RETURN (SELECT study_time_between(_guildid, _userid, _timestamp, NOW()));
+  END;
+$$ LANGUAGE PLPGSQL;
+-- }}}
+
+INSERT INTO VersionHistory (version, author) VALUES (18, 'v17-v18 migration');
+COMMIT;
+
+-- vim: set fdm=marker:
@@ -0,0 +1,33 @@
+BEGIN;
+
+-- Role mutation jobs {{{
+-- Bulk member role updates, applied in the background at a rate-limit aware pace.
+-- Pending members are deleted as they are processed, so interrupted jobs resume where they stopped.
+CREATE TABLE role_mutation_jobs(
+  jobid SERIAL PRIMARY KEY,
+  guildid BIGINT NOT NULL REFERENCES guild_config (guildid) ON DELETE CASCADE,
+  kind TEXT NOT NULL,
+  reason TEXT,
+  priority INTEGER NOT NULL DEFAULT 1,
+  total INTEGER NOT NULL DEFAULT 0,
+  done INTEGER NOT NULL DEFAULT 0,
+  skipped INTEGER NOT NULL DEFAULT 0,
+  failed INTEGER NOT NULL DEFAULT 0,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  completed_at TIMESTAMPTZ
+);
+CREATE INDEX role_mutation_jobs_pending ON role_mutation_jobs (guildid) WHERE completed_at IS NULL;
+
+CREATE TABLE role_mutation_members(
+  jobid INTEGER NOT NULL REFERENCES role_mutation_jobs (jobid) ON DELETE CASCADE,
+  userid BIGINT NOT NULL,
+  add_roles BIGINT[] NOT NULL DEFAULT '{}',
+  remove_roles BIGINT[] NOT NULL DEFAULT '{}',
+  PRIMARY KEY (jobid, userid)
+);
+-- }}}
+
+INSERT INTO VersionHistory (version, author) VALUES (19, 'v18-v19 migration');
+COMMIT;
+
+-- vim: set fdm=marker:
@@ -4,7 +4,7 @@ CREATE TABLE VersionHistory(
   time TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL,
   author TEXT
 );
-INSERT INTO VersionHistory (version, author) VALUES (14, 'Initial Creation');
+INSERT INTO VersionHistory (version, author) VALUES (19, 'Initial Creation');
 
 
 CREATE OR REPLACE FUNCTION update_timestamp_column()
@@ -664,7 +664,7 @@ CREATE TABLE bot_config_experience_rates(
 );
 
 CREATE TABLE text_sessions(
-  sessionid BIGSERIAL PRIMARY KEY,
+  sessionid BIGSERIAL,
   guildid BIGINT NOT NULL,
   userid BIGINT NOT NULL,
   start_time TIMESTAMPTZ NOT NULL,
@@ -677,11 +677,12 @@ CREATE TABLE text_sessions(
   end_time TIMESTAMP GENERATED ALWAYS AS
     ((start_time AT TIME ZONE 'UTC') + duration * interval '1 second')
   STORED,
+  PRIMARY KEY (sessionid, start_time),
   FOREIGN KEY (guildid, userid) REFERENCES members (guildid, userid) ON DELETE CASCADE
-);
+) PARTITION BY RANGE (start_time);
 CREATE INDEX text_sessions_members ON text_sessions (guildid, userid);
-CREATE INDEX text_sessions_start_time ON text_sessions (start_time);
 CREATE INDEX text_sessions_end_time ON text_sessions (end_time);
+CREATE TABLE text_sessions_default PARTITION OF text_sessions DEFAULT;
 
 CREATE TABLE untracked_text_channels(
   channelid BIGINT PRIMARY KEY,
@@ -703,7 +704,7 @@ CREATE TYPE SessionChannelType AS ENUM (
 
 
 CREATE TABLE voice_sessions(
-  sessionid SERIAL PRIMARY KEY,
+  sessionid SERIAL,
   guildid BIGINT NOT NULL,
   userid BIGINT NOT NULL,
   channelid BIGINT,
@@ -715,12 +716,99 @@ CREATE TABLE voice_sessions(
   stream_duration INTEGER DEFAULT 0,
   video_duration INTEGER DEFAULT 0,
   transactionid INTEGER REFERENCES coin_transactions (transactionid) ON UPDATE CASCADE ON DELETE CASCADE,
+  PRIMARY KEY (sessionid, start_time),
   FOREIGN KEY (guildid, userid) REFERENCES members (guildid, userid) ON DELETE CASCADE
-);
+) PARTITION BY RANGE (start_time);
 CREATE INDEX voice_session_members ON voice_sessions (guildid, userid, start_time);
 CREATE INDEX voice_session_guild_time ON voice_sessions USING BTREE (guildid, start_time);
 CREATE INDEX voice_session_user_time ON voice_sessions USING BTREE (userid, start_time);
 ALTER TABLE voice_sessions ADD FOREIGN KEY (channelid) REFERENCES tracked_channels (channelid);
+CREATE TABLE voice_sessions_default PARTITION OF voice_sessions DEFAULT;
+
+-- Monthly session partition maintenance {{{
+-- Partitions are named <table>_yYYYYmMM, and cover one UTC calendar month of start_time.
+-- Rows outside the existing partitions land in <table>_default,
+-- and are moved into their partition when it is created.
+
+CREATE OR REPLACE FUNCTION create_month_partition(_parent TEXT, _month DATE)
+  RETURNS TEXT
+AS $$
+  DECLARE
+    _month_start TIMESTAMP := date_trunc('month', _month::TIMESTAMP);
+    _start TIMESTAMPTZ := _month_start AT TIME ZONE 'UTC';
+    _end TIMESTAMPTZ := (_month_start + interval '1 month') AT TIME ZONE 'UTC';
+    _name TEXT := _parent || to_char(_month_start, '"_y"YYYY"m"MM');
+    _default TEXT := _parent || '_default';
+    _columns TEXT;
+  BEGIN
+    IF to_regclass(_name) IS NOT NULL THEN
+      RETURN _name;
+    END IF;
+
+    SELECT string_agg(quote_ident(column_name), ', ' ORDER BY ordinal_position) INTO _columns
+    FROM information_schema.columns
+    WHERE table_schema = current_schema() AND table_name = _parent AND is_generated = 'NEVER';
+
+    -- Move any rows for this month out of the default partition, so the new partition may be attached
+    EXECUTE format(
+      'CREATE TEMPORARY TABLE _partition_rows AS SELECT %s FROM %I WHERE start_time >= %L AND start_time < %L',
+      _columns, _default, _start, _end
+    );
+    EXECUTE format('DELETE FROM %I WHERE start_time >= %L AND start_time < %L', _default, _start, _end);
+
+    EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)', _name, _parent, _start, _end);
+    -- Recent partitions are indexed on start_time with a B-tree,
+    -- replaced by a BRIN index once the month has closed
+    EXECUTE format('CREATE INDEX %I ON %I (start_time)', _name || '_start_time', _name);
+
+    EXECUTE format('INSERT INTO %I (%s) SELECT %s FROM _partition_rows', _parent, _columns, _columns);
+    DROP TABLE _partition_rows;
+    RETURN _name;
+  END;
+$$ LANGUAGE PLPGSQL;
+
+CREATE OR REPLACE FUNCTION create_session_partitions(_months_ahead INTEGER DEFAULT 3)
+  RETURNS SETOF TEXT
+AS $$
+  DECLARE
+    _this_month TIMESTAMP := date_trunc('month', NOW() AT TIME ZONE 'UTC');
+    _month TIMESTAMP;
+  BEGIN
+    FOR _month IN
+      SELECT generate_series(_this_month, _this_month + make_interval(months => _months_ahead), interval '1 month')
+    LOOP
+      RETURN NEXT create_month_partition('voice_sessions', _month::DATE);
+      RETURN NEXT create_month_partition('text_sessions', _month::DATE);
+    END LOOP;
+  END;
+$$ LANGUAGE PLPGSQL;
+
+CREATE OR REPLACE FUNCTION index_closed_session_partitions()
+  RETURNS SETOF TEXT
+AS $$
+  DECLARE
+    _this_month TIMESTAMP := date_trunc('month', NOW() AT TIME ZONE 'UTC');
+    _partition TEXT;
+  BEGIN
+    FOR _partition IN
+      SELECT child.relname
+      FROM pg_inherits
+      JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+      JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+      WHERE parent.relname IN ('voice_sessions', 'text_sessions')
+        AND child.relname ~ '_y\d{4}m\d{2}$'
+        AND to_date(substring(child.relname from '\d{4}m\d{2}$'), 'YYYY"m"MM') < _this_month
+        AND to_regclass(child.relname || '_start_time_brin') IS NULL
+    LOOP
+      EXECUTE format('CREATE INDEX %I ON %I USING BRIN (start_time)', _partition || '_start_time_brin', _partition);
+      EXECUTE format('DROP INDEX IF EXISTS %I', _partition || '_start_time');
+      RETURN NEXT _partition;
+    END LOOP;
+  END;
+$$ LANGUAGE PLPGSQL;
+-- }}}
+
+SELECT create_session_partitions(3);
 
 CREATE TABLE voice_sessions_ongoing(
   guildid BIGINT NOT NULL,
@@ -859,6 +947,139 @@ $$ LANGUAGE PLPGSQL;
 -- Function to finish session? Or handle in application?
 -- Does database function make transaction, or application?
 
+-- Compacted voice history {{{
+-- Voice sessions older than the compaction horizon are folded into per-member daily totals.
+-- Each day is split at UTC midnight, and the compacted and raw regions never overlap in time.
+CREATE TABLE voice_session_days(
+  guildid BIGINT NOT NULL,
+  userid BIGINT NOT NULL,
+  day DATE NOT NULL,
+  sessions INTEGER NOT NULL DEFAULT 0,
+  duration INTEGER NOT NULL DEFAULT 0,
+  live_duration INTEGER NOT NULL DEFAULT 0,
+  stream_duration INTEGER NOT NULL DEFAULT 0,
+  video_duration INTEGER NOT NULL DEFAULT 0,
+  coins_earned INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (guildid, userid, day),
+  FOREIGN KEY (guildid, userid) REFERENCES members (guildid, userid) ON DELETE CASCADE
+);
+CREATE INDEX voice_session_days_users ON voice_session_days (userid, day);
+
+-- Voice time per user per day across all guilds, with overlapping sessions counted once
+CREATE TABLE voice_user_days(
+  userid BIGINT NOT NULL REFERENCES user_config (userid) ON DELETE CASCADE,
+  day DATE NOT NULL,
+  duration INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (userid, day)
+);
+-- }}}
+
+-- Compaction function {{{
+CREATE FUNCTION compact_voice_sessions(_until TIMESTAMPTZ)
+  RETURNS INTEGER
+AS $$
+  DECLARE
+    _count INTEGER;
+  BEGIN
+    -- Sessions starting before _until, with the number of seconds before _until to compact.
+    -- Sessions running over _until are truncated to start at _until, and finished on a later run.
+    CREATE TEMPORARY TABLE _compacting ON COMMIT DROP AS
+      SELECT
+        sessionid, guildid, userid, start_time, duration, transactionid,
+        COALESCE(live_duration, 0) AS live_duration,
+        COALESCE(stream_duration, 0) AS stream_duration,
+        COALESCE(video_duration, 0) AS video_duration,
+        LEAST(duration, CEIL(EXTRACT(EPOCH FROM (_until - start_time))))::INTEGER AS compacted
+      FROM voice_sessions
+      WHERE start_time < _until;
+
+    -- Split the compacted part of each session at UTC midnight.
+    -- Piece lengths are differences of offsets from the session start, so they sum to exactly `compacted`.
+    CREATE TEMPORARY TABLE _pieces ON COMMIT DROP AS
+      SELECT
+        guildid, userid, day::DATE AS day,
+        (
+          LEAST(compacted, GREATEST(0, FLOOR(EXTRACT(EPOCH FROM (((day + interval '1 day') AT TIME ZONE 'UTC') - start_time)))))
+          - LEAST(compacted, GREATEST(0, FLOOR(EXTRACT(EPOCH FROM ((day AT TIME ZONE 'UTC') - start_time)))))
+        )::INTEGER AS duration,
+        tstzrange(
+          GREATEST(start_time, day AT TIME ZONE 'UTC'),
+          LEAST(start_time + compacted * interval '1 second', (day + interval '1 day') AT TIME ZONE 'UTC')
+        ) AS span
+      FROM _compacting,
+      generate_series(
+        date_trunc('day', start_time AT TIME ZONE 'UTC'),
+        date_trunc('day', (start_time + compacted * interval '1 second') AT TIME ZONE 'UTC'),
+        interval '1 day'
+      ) AS day;
+
+    -- Session counts, stream durations and coins are attributed to the day the session started.
+    -- The stream durations of truncated sessions are split in proportion to the compacted time.
+    INSERT INTO voice_session_days (
+      guildid, userid, day, sessions, duration, live_duration, stream_duration, video_duration, coins_earned
+    )
+      SELECT
+        guildid, userid, day,
+        SUM(sessions), SUM(duration), SUM(live_duration), SUM(stream_duration), SUM(video_duration), SUM(coins)
+      FROM (
+        SELECT guildid, userid, day, 0 AS sessions, duration,
+          0 AS live_duration, 0 AS stream_duration, 0 AS video_duration, 0 AS coins
+        FROM _pieces
+        UNION ALL
+        SELECT
+          c.guildid, c.userid, (c.start_time AT TIME ZONE 'UTC')::DATE,
+          (c.compacted = c.duration)::INTEGER,
+          0,
+          c.live_duration::BIGINT * c.compacted / GREATEST(c.duration, 1),
+          c.stream_duration::BIGINT * c.compacted / GREATEST(c.duration, 1),
+          c.video_duration::BIGINT * c.compacted / GREATEST(c.duration, 1),
+          CASE WHEN c.compacted = c.duration THEN COALESCE(t.amount + t.bonus, 0) ELSE 0 END
+        FROM _compacting c
+        LEFT JOIN coin_transactions t ON t.transactionid = c.transactionid
+      ) AS parts
+      GROUP BY guildid, userid, day
+    ON CONFLICT (guildid, userid, day) DO UPDATE SET
+      sessions = voice_session_days.sessions + EXCLUDED.sessions,
+      duration = voice_session_days.duration + EXCLUDED.duration,
+      live_duration = voice_session_days.live_duration + EXCLUDED.live_duration,
+      stream_duration = voice_session_days.stream_duration + EXCLUDED.stream_duration,
+      video_duration = voice_session_days.video_duration + EXCLUDED.video_duration,
+      coins_earned = voice_session_days.coins_earned + EXCLUDED.coins_earned;
+
+    INSERT INTO voice_user_days (userid, day, duration)
+      SELECT userid, day, SUM(EXTRACT(EPOCH FROM (upper(part) - lower(part))))::INTEGER
+      FROM (
+        SELECT userid, day, unnest(range_agg(span)) AS part
+        FROM _pieces
+        WHERE NOT isempty(span)
+        GROUP BY userid, day
+      ) AS merged
+      GROUP BY userid, day
+    ON CONFLICT (userid, day) DO UPDATE SET
+      duration = voice_user_days.duration + EXCLUDED.duration;
+
+    UPDATE voice_sessions s SET
+      start_time = c.start_time + c.compacted * interval '1 second',
+      duration = c.duration - c.compacted,
+      live_duration = c.live_duration - c.live_duration::BIGINT * c.compacted / GREATEST(c.duration, 1),
+      stream_duration = c.stream_duration - c.stream_duration::BIGINT * c.compacted / GREATEST(c.duration, 1),
+      video_duration = c.video_duration - c.video_duration::BIGINT * c.compacted / GREATEST(c.duration, 1)
+    FROM _compacting c
+    WHERE s.sessionid = c.sessionid AND s.start_time = c.start_time AND c.compacted < c.duration;
+
+    DELETE FROM voice_sessions s
+    USING _compacting c
+    WHERE s.sessionid = c.sessionid AND s.start_time = c.start_time AND c.compacted = c.duration;
+    GET DIAGNOSTICS _count = ROW_COUNT;
+
+    DROP TABLE _compacting;
+    DROP TABLE _pieces;
+    RETURN _count;
+  END;
+$$ LANGUAGE PLPGSQL;
+-- }}}
+
+-- Compacted days appear as a single block of time starting at UTC midnight.
 CREATE VIEW voice_sessions_combined AS
   SELECT
     userid,
@@ -874,12 +1095,55 @@ CREATE VIEW voice_sessions_combined AS
     start_time,
     EXTRACT(EPOCH FROM (NOW() - start_time)) AS duration,
     NOW() AS end_time
-  FROM voice_sessions_ongoing;
+  FROM voice_sessions_ongoing
+  UNION ALL
+  SELECT
+    userid,
+    guildid,
+    day::TIMESTAMP AT TIME ZONE 'UTC' AS start_time,
+    duration,
+    (day::TIMESTAMP AT TIME ZONE 'UTC') + duration * interval '1 second' AS end_time
+  FROM voice_session_days;
+
+CREATE VIEW voice_user_history AS
+  SELECT
+    userid,
+    start_time,
+    (start_time + duration * interval '1 second') AS end_time
+  FROM voice_sessions
+  UNION ALL
+  SELECT
+    userid,
+    start_time,
+    NOW() AS end_time
+  FROM voice_sessions_ongoing
+  UNION ALL
+  SELECT
+    userid,
+    day::TIMESTAMP AT TIME ZONE 'UTC' AS start_time,
+    (day::TIMESTAMP AT TIME ZONE 'UTC') + duration * interval '1 second' AS end_time
+  FROM voice_user_days;
 
 CREATE FUNCTION study_time_between(_guildid BIGINT, _userid BIGINT, _start TIMESTAMPTZ, _end TIMESTAMPTZ)
   RETURNS INTEGER
 AS $$
   BEGIN
+    IF _guildid IS NULL THEN
+      -- Per-guild compacted days may overlap, so use the merged per-user days
+      RETURN (
+        SELECT
+          SUM(COALESCE(EXTRACT(EPOCH FROM (upper(part) - lower(part))), 0))
+        FROM (
+          SELECT
+          unnest(range_agg(tstzrange(start_time, end_time)) * multirange(tstzrange(_start, _end))) AS part
+          FROM voice_user_history
+          WHERE
+            userid=_userid
+            AND start_time < _end
+            AND end_time > _start
+        ) AS disjoint_parts
+      );
+    END IF;
     RETURN (
       SELECT
         SUM(COALESCE(EXTRACT(EPOCH FROM (upper(part) - lower(part))), 0))
@@ -888,7 +1152,7 @@ AS $$
         unnest(range_agg(tstzrange(start_time, end_time)) * multirange(tstzrange(_start, _end))) AS part
         FROM voice_sessions_combined
         WHERE
-          (_guildid IS NULL OR guildid=_guildid)
+          guildid=_guildid
           AND userid=_userid
           AND start_time < _end
           AND end_time > _start
@@ -1110,6 +1374,33 @@ CREATE TABLE past_member_roles(
 CREATE INDEX member_role_persistence_members ON past_member_roles (guildid, userid);
 -- }}}
 
+-- Role mutation jobs {{{
+-- Bulk member role updates, applied in the background at a rate-limit aware pace.
+-- Pending members are deleted as they are processed, so interrupted jobs resume where they stopped.
+CREATE TABLE role_mutation_jobs(
+  jobid SERIAL PRIMARY KEY,
+  guildid BIGINT NOT NULL REFERENCES guild_config (guildid) ON DELETE CASCADE,
+  kind TEXT NOT NULL,
+  reason TEXT,
+  priority INTEGER NOT NULL DEFAULT 1,
+  total INTEGER NOT NULL DEFAULT 0,
+  done INTEGER NOT NULL DEFAULT 0,
+  skipped INTEGER NOT NULL DEFAULT 0,
+  failed INTEGER NOT NULL DEFAULT 0,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  completed_at TIMESTAMPTZ
+);
+CREATE INDEX role_mutation_jobs_pending ON role_mutation_jobs (guildid) WHERE completed_at IS NULL;
+
+CREATE TABLE role_mutation_members(
+  jobid INTEGER NOT NULL REFERENCES role_mutation_jobs (jobid) ON DELETE CASCADE,
+  userid BIGINT NOT NULL,
+  add_roles BIGINT[] NOT NULL DEFAULT '{}',
+  remove_roles BIGINT[] NOT NULL DEFAULT '{}',
+  PRIMARY KEY (jobid, userid)
+);
+-- }}}
+
 -- Member profile tags {{{
 CREATE TABLE member_profile_tags(
   tagid SERIAL PRIMARY KEY,
@@ -1349,10 +1640,87 @@ CREATE TABLE analytics.voice_sessions(
   action analytics.VoiceAction NOT NULL
 ) INHERITS (analytics.events);
 
+CREATE TYPE analytics.RenderStatus AS ENUM(
+  'SUCCESS',
+  'UNKNOWN_ROUTE',
+  'SYSTEM_ERROR',
+  'RENDER_ERROR',
+  'TIMED_OUT',
+  'CONNECTION_FAILURE',
+  'CANCELLED'
+);
+
 CREATE TABLE analytics.gui_renders(
   cardname TEXT NOT NULL,
-  duration INTEGER NOT NULL
+  duration INTEGER NOT NULL,
+  skin TEXT,
+  locale TEXT,
+  queue_wait INTEGER,
+  render_time INTEGER,
+  output_bytes INTEGER,
+  cache_hit BOOLEAN,
+  status analytics.RenderStatus NOT NULL DEFAULT 'SUCCESS',
+  error TEXT
 ) INHERITS (analytics.events);
+CREATE INDEX gui_renders_created_at ON analytics.gui_renders (created_at);
+-- }}}
+
+-- Analytics rollups {{{
+CREATE INDEX commands_created_at ON analytics.commands (created_at);
+CREATE INDEX voice_sessions_created_at ON analytics.voice_sessions (created_at);
+CREATE INDEX snapshots_created_at ON analytics.snapshots (created_at);
+
+CREATE TYPE analytics.RollupPeriod AS ENUM(
+  'HOUR',
+  'DAY'
+);
+
+CREATE TABLE analytics.rollup_state(
+  name TEXT PRIMARY KEY,
+  rolled_until TIMESTAMPTZ NOT NULL
+);
+
+CREATE TABLE analytics.command_rollups(
+  period analytics.RollupPeriod NOT NULL,
+  bucket TIMESTAMPTZ NOT NULL,
+  appname TEXT NOT NULL,
+  cmdname TEXT NOT NULL,
+  status analytics.CommandStatus NOT NULL,
+  count INTEGER NOT NULL,
+  total_time REAL NOT NULL,
+  max_time REAL NOT NULL,
+  PRIMARY KEY (period, bucket, appname, cmdname, status)
+);
+
+CREATE TABLE analytics.voice_rollups(
+  period analytics.RollupPeriod NOT NULL,
+  bucket TIMESTAMPTZ NOT NULL,
+  appname TEXT NOT NULL,
+  guildid BIGINT NOT NULL,
+  joins INTEGER NOT NULL,
+  leaves INTEGER NOT NULL,
+  PRIMARY KEY (period, bucket, appname, guildid)
+);
+
+CREATE TABLE analytics.snapshot_rollups(
+  period analytics.RollupPeriod NOT NULL,
+  bucket TIMESTAMPTZ NOT NULL,
+  appname TEXT NOT NULL,
+  samples INTEGER NOT NULL,
+  guild_min INTEGER NOT NULL,
+  guild_max INTEGER NOT NULL,
+  guild_sum BIGINT NOT NULL,
+  member_min INTEGER NOT NULL,
+  member_max INTEGER NOT NULL,
+  member_sum BIGINT NOT NULL,
+  user_min INTEGER NOT NULL,
+  user_max INTEGER NOT NULL,
+  user_sum BIGINT NOT NULL,
+  voice_min INTEGER NOT NULL,
+  voice_max INTEGER NOT NULL,
+  voice_sum BIGINT NOT NULL,
+  PRIMARY KEY (period, bucket, appname)
+);
 -- }}}
 
 -- vim: set fdm=marker:
@@ -0,0 +1,80 @@
+# !/bin/python3
+"""
+Benchmark ShardTalk message codecs.
+
+Compares encode and decode throughput and message size of the pickle codec
+with the schema codec, for the analytics event routes.
+
+Usage: python scripts/bench_codec.py [--conf config/bot.conf] [--iterations 100000]
+"""
+
+import sys
+import os
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.getcwd()))
+sys.path.insert(0, os.path.join(os.getcwd(), "src"))
+
+
+def bench(name, codec, event, iterations):
+    from meta.ipc.codec import encode_message, decode_envelope
+
+    args = (event,)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        encoded = encode_message(name, codec, args, {})
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        _, _, body = decode_envelope(encoded)
+        decoded, _ = codec.decode_request(body)
+    decode_time = time.perf_counter() - start
+
+    assert decoded[0] == event, f"Round trip mismatch: {decoded[0]} != {event}"
+    return len(encoded), iterations / encode_time, iterations / decode_time
+
+
+def main(iterations):
+    from meta.ipc.codec import SchemaCodec, pickle_codec
+    from utils.lib import utc_now
+    from analytics.events import CommandEvent, GuildEvent, VoiceEvent, RenderEvent
+    from analytics.data import CommandStatus, GuildAction, VoiceAction, RenderStatus
+
+    now = utc_now()
+    events = {
+        'command_event': CommandEvent(
+            appname='leobot', cmdname='profile', userid=123456789012345678, created_at=now,
+            status=CommandStatus.COMPLETED, execution_time=0.123,
+            cogname='StatsCog', guildid=123456789012345678, ctxid=123456789012345678
+        ),
+        'guild_event': GuildEvent(
+            appname='leobot', guildid=123456789012345678, action=GuildAction.JOINED, created_at=now
+        ),
+        'voice_event': VoiceEvent(
+            appname='leobot', guildid=123456789012345678, userid=123456789012345678,
+            action=VoiceAction.JOINED, created_at=now
+        ),
+        'render_event': RenderEvent(
+            appname='leobot', cardname='profile_card', duration=120, status=RenderStatus.SUCCESS,
+            created_at=now, skin='base', locale='en-GB', queue_wait=2, render_time=110,
+            output_bytes=48213, cache_hit=True
+        ),
+    }
+
+    print(f"{'route':<14} | {'codec':<6} | {'bytes':>5} | {'encode/s':>10} | {'decode/s':>10}")
+    for name, event in events.items():
+        for codec_name, codec in (('pickle', pickle_codec), ('schema', SchemaCodec(type(event)))):
+            size, encode_rate, decode_rate = bench(name, codec, event, iterations)
+            print(f"{name:<14} | {codec_name:<6} | {size:>5} | {encode_rate:>10.0f} | {decode_rate:>10.0f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=100000)
+    bench_args, remaining = parser.parse_known_args()
+    # Leave the remaining arguments (e.g. --conf) for the application parser
+    sys.argv = [sys.argv[0], *remaining]
+
+    main(bench_args.iterations)
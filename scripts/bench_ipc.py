@@ -0,0 +1,136 @@
+# !/bin/python3
+"""
+Benchmark ShardTalk request throughput and latency.
+
+Compares the held, framed peer connections used by AppClient
+with the previous design of opening a new connection for every message.
+The receiving peer runs in a separate local process.
+
+Usage: python scripts/bench_ipc.py [--conf config/bot.conf] [--messages 5000] [--concurrency 50]
+"""
+
+import sys
+import os
+import time
+import asyncio
+import argparse
+import statistics
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.getcwd()))
+sys.path.insert(0, os.path.join(os.getcwd(), "src"))
+
+
+HOST = '127.0.0.1'
+FRAMED_PORT = 47101
+LEGACY_PORT = 47102
+
+
+async def _echo(value):
+    return value
+
+
+def serve():
+    """
+    Run both the framed and legacy receivers in this process.
+    """
+    from meta.ipc import AppClient, SchemaCodec
+    from meta.ipc.codec import decode_envelope
+
+    async def legacy_handle(reader, writer):
+        data = await reader.read()
+        _, route_name, body = decode_envelope(data)
+        route = client.routes[route_name]
+        args, kwargs = route.codec.decode_request(body)
+        writer.write(await route.run(args, kwargs))
+        await writer.drain()
+        writer.close()
+
+    async def main():
+        global client
+        await asyncio.start_server(client.handle_request, host=HOST, port=FRAMED_PORT)
+        await asyncio.start_server(legacy_handle, host=HOST, port=LEGACY_PORT)
+        await asyncio.Event().wait()
+
+    global client
+    client = AppClient('bench_server', 'bench', {'host': HOST, 'port': FRAMED_PORT}, {})
+    client.register_route('echo', codec=SchemaCodec(bytes, result=bytes))(_echo)
+    asyncio.run(main())
+
+
+async def legacy_request(payload):
+    reader, writer = await asyncio.open_connection(host=HOST, port=LEGACY_PORT)
+    writer.write(payload.encoded())
+    await writer.drain()
+    writer.write_eof()
+    result = await reader.read()
+    writer.close()
+    return payload.route.decode(result)
+
+
+async def measure(name, send, messages, concurrency):
+    # Sequential latency
+    latencies = []
+    for i in range(min(messages, 1000)):
+        start = time.perf_counter()
+        await send(i)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+
+    # Concurrent throughput
+    sem = asyncio.Semaphore(concurrency)
+
+    async def bounded(i):
+        async with sem:
+            await send(i)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(bounded(i) for i in range(messages)))
+    elapsed = time.perf_counter() - start
+
+    print(
+        f"{name:<8} | {messages / elapsed:>10.0f} msg/s | "
+        f"p50 {statistics.median(latencies) * 1e6:>8.0f} us | "
+        f"p99 {latencies[int(len(latencies) * 0.99)] * 1e6:>8.0f} us"
+    )
+
+
+async def run(messages, concurrency):
+    from meta.ipc import AppClient, SchemaCodec
+
+    client = AppClient('bench_client', 'bench', {'host': HOST, 'port': 47100}, {})
+    client.peers['bench_server'] = {'host': HOST, 'port': FRAMED_PORT}
+    route = client.register_route('echo', codec=SchemaCodec(bytes, result=bytes))(_echo)
+
+    payload = b'x' * 64
+
+    async def framed(i):
+        return await route(payload).send('bench_server')
+
+    async def legacy(i):
+        return await legacy_request(route(payload))
+
+    print(f"{messages} messages, concurrency {concurrency}")
+    await measure('legacy', legacy, messages, concurrency)
+    await measure('framed', framed, messages, concurrency)
+    await client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    bench_args, remaining = parser.parse_known_args()
+    # Leave the remaining arguments (e.g. --conf) for the application parser
+    sys.argv = [sys.argv[0], *remaining]
+
+    import logging
+    logging.disable(logging.WARNING)
+
+    server = multiprocessing.Process(target=serve, daemon=True)
+    server.start()
+    time.sleep(1)
+    try:
+        asyncio.run(run(bench_args.messages, bench_args.concurrency))
+    finally:
+        server.terminate()
@@ -0,0 +1,122 @@
+# !/bin/python3
+"""
+Benchmark the voice leaderboard export queries on a synthetic guild.
+
+Creates a guild with `--members` members and `--sessions` voice sessions per member
+inside a transaction which is rolled back afterwards,
+then compares evaluating `study_time_between` once per member
+with the set-based `VoiceSessionStats.member_totals_between` query.
+
+Usage: python scripts/bench_leaderboard.py [--conf config/bot.conf] [--members 100000] [--sessions 20]
+"""
+
+import sys
+import os
+import time
+import argparse
+import asyncio
+import datetime as dt
+
+sys.path.insert(0, os.path.join(os.getcwd()))
+sys.path.insert(0, os.path.join(os.getcwd(), "src"))
+
+
+GUILDID = 1
+USER_OFFSET = 10 ** 12
+
+
+per_member_query = """
+    SELECT guildid, userid, study_time_between(guildid, userid, %s, %s) AS total_time
+    FROM members
+    WHERE guildid = %s
+    ORDER BY total_time DESC NULLS LAST
+    LIMIT %s
+"""
+
+
+async def populate(cursor, members, sessions, start):
+    await cursor.execute(
+        "INSERT INTO guild_config (guildid) VALUES (%s)",
+        (GUILDID,)
+    )
+    await cursor.execute(
+        "INSERT INTO user_config (userid) SELECT %s + i FROM generate_series(1, %s) AS i",
+        (USER_OFFSET, members)
+    )
+    await cursor.execute(
+        "INSERT INTO members (guildid, userid) SELECT %s, %s + i FROM generate_series(1, %s) AS i",
+        (GUILDID, USER_OFFSET, members)
+    )
+    # Sessions of up to two hours, spread randomly over the 90 days after `start`
+    await cursor.execute(
+        """
+        INSERT INTO voice_sessions (guildid, userid, start_time, duration)
+        SELECT
+            %s,
+            %s + i,
+            %s + (j * 90.0 / %s + random())::FLOAT * interval '1 day',
+            (random() * 7200)::INTEGER
+        FROM generate_series(1, %s) AS i, generate_series(0, %s - 1) AS j
+        """,
+        (GUILDID, USER_OFFSET, start, sessions, members, sessions)
+    )
+    await cursor.execute("ANALYZE voice_sessions")
+
+
+async def timed(cursor, query, args):
+    start = time.perf_counter()
+    await cursor.execute(query, args)
+    rows = await cursor.fetchall()
+    return time.perf_counter() - start, rows
+
+
+async def main(members, sessions, limit):
+    import psycopg
+    from psycopg.rows import dict_row
+    from meta import conf
+    from modules.statistics.data import StatsData
+
+    start = dt.datetime(2020, 1, 1, tzinfo=dt.timezone.utc)
+    window = (start + dt.timedelta(days=30), start + dt.timedelta(days=60))
+
+    model = StatsData.VoiceSessionStats
+    set_query = model._totals_between_query()
+
+    async with await psycopg.AsyncConnection.connect(conf.data['args'], row_factory=dict_row) as conn:
+        async with conn.cursor() as cursor:
+            print(f"Populating {members} members with {sessions} sessions each...")
+            await populate(cursor, members, sessions, start)
+
+            per_member_time, per_member = await timed(
+                cursor, per_member_query, (*window, GUILDID, limit)
+            )
+            print(f"Per-member study_time_between: {per_member_time:.3f}s")
+
+            set_time, set_rows = await timed(
+                cursor, set_query, (window[1], window[0], GUILDID, window[1], window[0])
+            )
+            print(f"Set-based leaderboard_between: {set_time:.3f}s ({per_member_time / set_time:.1f}x faster)")
+
+            expected = {row['userid']: row['total_time'] for row in per_member if row['total_time']}
+            actual = {row['userid']: int(row['total_time']) for row in set_rows}
+            mismatched = [
+                userid for userid, total in expected.items() if abs(actual.get(userid, 0) - total) > 1
+            ]
+            if mismatched:
+                print(f"Warning: {len(mismatched)} members have differing totals, e.g. {mismatched[:5]}")
+            else:
+                print(f"Totals agree for the top {len(expected)} members.")
+
+        await conn.rollback()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--members', type=int, default=100000)
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--limit', type=int, default=100000)
+    bench_args, remaining = parser.parse_known_args()
+    # Leave the remaining arguments (e.g. --conf) for the application parser
+    sys.argv = [sys.argv[0], *remaining]
+
+    asyncio.run(main(bench_args.members, bench_args.sessions, bench_args.limit))
@@ -0,0 +1,52 @@
+# !/bin/python3
+"""
+Maintain the monthly voice_sessions and text_sessions partitions.
+
+Creates the partitions for the current month and the next `--months` months,
+moving any rows which landed in the default partitions into them,
+and replaces the start_time B-tree index of closed months with a BRIN index.
+Safe to run repeatedly, intended to be run daily from cron.
+
+Usage: python scripts/maintain_partitions.py [--conf config/bot.conf] [--months 3]
+"""
+
+import sys
+import os
+import argparse
+import asyncio
+
+sys.path.insert(0, os.path.join(os.getcwd()))
+sys.path.insert(0, os.path.join(os.getcwd(), "src"))
+
+
+async def main(months):
+    import psycopg
+    from meta import conf
+
+    async with await psycopg.AsyncConnection.connect(conf.data['args'], autocommit=True) as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute("SELECT create_session_partitions(%s)", (months,))
+            for partition, in await cursor.fetchall():
+                print(f"Partition ready: {partition}")
+
+            await cursor.execute("SELECT index_closed_session_partitions()")
+            for partition, in await cursor.fetchall():
+                print(f"BRIN indexed closed partition: {partition}")
+
+            await cursor.execute(
+                "SELECT relname, n_live_tup FROM pg_stat_user_tables "
+                "WHERE relname IN ('voice_sessions_default', 'text_sessions_default')"
+            )
+            for relname, rows in await cursor.fetchall():
+                if rows:
+                    print(f"Warning: {relname} holds about {rows} rows outside the monthly partitions.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--months', type=int, default=3)
+    script_args, remaining = parser.parse_known_args()
+    # Leave the remaining arguments (e.g. --conf) for the application parser
+    sys.argv = [sys.argv[0], *remaining]
+
+    asyncio.run(main(script_args.months))
@@ -1,33 +1,42 @@
+import asyncio
 import logging
+import datetime as dt
+from typing import Optional
 
 import discord
+from discord.ext import commands as cmds
+from discord import app_commands as appcmds
 from discord.ext.commands import Bot, Cog, HybridCommand, HybridCommandError
 from discord.ext.commands.errors import CommandInvokeError, CheckFailure
 from discord.app_commands.errors import CommandInvokeError as appCommandInvokeError
 
-from meta import LionCog, LionBot, LionContext
+from meta import LionCog, LionBot, LionContext, conf
 from meta.app import shard_talk, appname
+from meta.ipc import SchemaCodec
 from meta.errors import HandledException, SafeCancellation
 from meta.logger import log_wrap
-from utils.lib import utc_now
+from utils.lib import utc_now, tabulate
+from wards import sys_admin_ward
+from gui.client import client as gui_client
 
-from .data import AnalyticsData
+from .data import AnalyticsData, RenderStatus
 from .events import (
     CommandStatus, CommandEvent, command_event_handler,
     GuildAction, GuildEvent, guild_event_handler,
-    VoiceAction, VoiceEvent, voice_event_handler
+    VoiceAction, VoiceEvent, voice_event_handler,
+    RenderEvent, render_event_handler,
+    EventEmitter
 )
-from .snapshot import shard_snapshot
+from .snapshot import shard_snapshot, shard_counters, ShardSnapshot
 
 logger = logging.getLogger(__name__)
 
 
-# TODO: Client side might be better handled as a single connection fed by a queue?
-# Maybe consider this again after the interactive REPL idea
-# Or if it seems like this is giving an absurd amount of traffic
-
-
 class Analytics(LionCog):
+    admin_guilds = conf.bot.getintlist('admin_guilds')
+    # How often to rebuild the incremental shard counters from the client cache
+    reconcile_period = conf.analytics.getint('reconcile_period', 3600)
+
     def __init__(self, bot: LionBot):
         self.bot = bot
         self.data = bot.db.load_registry(AnalyticsData())
@@ -36,15 +45,92 @@ class Analytics(LionCog):
         self.talk_command_event = command_event_handler.bind(shard_talk).route
         self.talk_guild_event = guild_event_handler.bind(shard_talk).route
         self.talk_voice_event = voice_event_handler.bind(shard_talk).route
+        self.talk_render_event = render_event_handler.bind(shard_talk).route
+
+        # Events are buffered and sent to the analytics server in batches
+        self.command_events = EventEmitter(command_event_handler, self.an_app)
+        self.guild_events = EventEmitter(guild_event_handler, self.an_app)
+        self.voice_events = EventEmitter(voice_event_handler, self.an_app)
+        self.render_events = EventEmitter(render_event_handler, self.an_app)
+        self.emitters = [self.command_events, self.guild_events, self.voice_events, self.render_events]
 
-        self.talk_shard_snapshot = shard_talk.register_route()(shard_snapshot)
+        self.talk_shard_snapshot = shard_talk.register_route(codec=SchemaCodec(result=ShardSnapshot))(shard_snapshot)
+
+        self._reconcile_task: Optional[asyncio.Task] = None
 
     async def cog_load(self):
         await self.data.init()
+        for emitter in self.emitters:
+            emitter.start()
+        gui_client.render_listeners.append(self.on_gui_render)
+        self._reconcile_task = asyncio.create_task(self._reconcile_loop(), name='shard-counter-reconcile')
+
+    async def cog_unload(self):
+        if self.on_gui_render in gui_client.render_listeners:
+            gui_client.render_listeners.remove(self.on_gui_render)
+        for emitter in self.emitters:
+            await emitter.close()
+        if self._reconcile_task is not None and not self._reconcile_task.done():
+            self._reconcile_task.cancel()
+
+    @log_wrap(action='Reconcile')
+    async def _reconcile_loop(self):
+        while True:
+            await asyncio.sleep(self.reconcile_period)
+            if self.bot.is_ready():
+                try:
+                    shard_counters.reconcile(self.bot)
+                except Exception:
+                    logger.exception("Unexpected exception reconciling shard counters. Continuing.")
+                else:
+                    if any(shard_counters.last_drift.values()):
+                        logger.info(f"Corrected shard counter drift: {shard_counters.last_drift}")
+
+    @LionCog.listener('on_ready')
+    async def reconcile_counters(self):
+        shard_counters.reconcile(self.bot)
+
+    @LionCog.listener('on_member_join')
+    async def count_member_join(self, member: discord.Member):
+        shard_counters.member_join(member)
+
+    @LionCog.listener('on_raw_member_remove')
+    async def count_member_remove(self, payload: discord.RawMemberRemoveEvent):
+        if self.bot.get_guild(payload.guild_id) is not None:
+            shard_counters.member_remove(
+                payload.guild_id, payload.user.id, isinstance(payload.user, discord.Member)
+            )
+
+    def on_gui_render(self, metrics: dict):
+        """
+        Render listener attached to the GUI client.
+        Converts the request metrics into a RenderEvent and queues it for the analytics server.
+        """
+        def ms(seconds):
+            return int(seconds * 1000) if seconds is not None else None
+
+        kwargs = metrics.get('kwargs') or {}
+        status = metrics.get('status', 'SYSTEM_ERROR')
+        event = RenderEvent(
+            appname=appname,
+            cardname=metrics['route'],
+            duration=ms(metrics['duration']),
+            status=getattr(RenderStatus, status, RenderStatus.SYSTEM_ERROR),
+            created_at=utc_now(),
+            skin=(kwargs.get('skin') or {}).get('base_skin_id'),
+            locale=kwargs.get('locale'),
+            queue_wait=ms(metrics.get('queue_wait')),
+            render_time=ms(metrics.get('render_time')),
+            output_bytes=metrics.get('output_bytes'),
+            cache_hit=metrics.get('cache_hit'),
+            error=metrics.get('error'),
+        )
+        self.render_events.emit(event)
 
     @LionCog.listener()
     @log_wrap(action='AnEvent')
     async def on_voice_state_update(self, member, before, after):
+        shard_counters.voice_update(before, after)
         if not before.channel and after.channel:
             # Member joined channel
             action = VoiceAction.JOINED
@@ -62,10 +148,7 @@ class Analytics(LionCog):
             action=action,
             created_at=utc_now()
         )
-        if self.an_app not in shard_talk.peers:
-            logger.warning(f"Analytics peer not found, discarding event: {event}")
-        else:
-            await self.talk_voice_event(event).send(self.an_app, wait_for_reply=False)
+        self.voice_events.emit(event)
 
     @LionCog.listener()
     @log_wrap(action='AnEvent')
@@ -73,16 +156,14 @@ class Analytics(LionCog):
         """
         Send guild join event.
         """
+        shard_counters.guild_join(guild)
         event = GuildEvent(
             appname=appname,
             guildid=guild.id,
             action=GuildAction.JOINED,
             created_at=utc_now()
         )
-        if self.an_app not in shard_talk.peers:
-            logger.warning(f"Analytics peer not found, discarding event: {event}")
-        else:
-            await self.talk_guild_event(event).send(self.an_app, wait_for_reply=False)
+        self.guild_events.emit(event)
 
     @LionCog.listener()
     @log_wrap(action='AnEvent')
@@ -90,16 +171,14 @@ class Analytics(LionCog):
         """
         Send guild leave event
         """
+        shard_counters.guild_remove(guild)
         event = GuildEvent(
             appname=appname,
             guildid=guild.id,
             action=GuildAction.LEFT,
             created_at=utc_now()
         )
-        if self.an_app not in shard_talk.peers:
-            logger.warning(f"Analytics peer not found, discarding event: {event}")
-        else:
-            await self.talk_guild_event(event).send(self.an_app, wait_for_reply=False)
+        self.guild_events.emit(event)
 
     @LionCog.listener()
     @log_wrap(action='AnEvent')
@@ -119,10 +198,7 @@ class Analytics(LionCog):
             guildid=ctx.guild.id if ctx.guild else None,
             ctxid=ctx.message.id
         )
-        if self.an_app not in shard_talk.peers:
-            logger.warning(f"Analytics peer not found, discarding event: {event}")
-        else:
-            await self.talk_command_event(event).send(self.an_app, wait_for_reply=False)
+        self.command_events.emit(event)
 
     @LionCog.listener()
     @log_wrap(action='AnEvent')
@@ -171,7 +247,45 @@ class Analytics(LionCog):
             guildid=ctx.guild.id if ctx.guild else None,
             ctxid=ctx.message.id
         )
-        if self.an_app not in shard_talk.peers:
-            logger.warning(f"Analytics peer not found, discarding event: {event}")
-        else:
-            await self.talk_command_event(event).send(self.an_app, wait_for_reply=False)
+        self.command_events.emit(event)
+
+    @cmds.hybrid_command(
+        name='renderstats',
+        description="Show rendering latency percentiles by card."
+    )
+    @appcmds.describe(
+        hours="Size of the time window to summarise, in hours.",
+        by_skin="Whether to also group the results by base skin."
+    )
+    @appcmds.guilds(*admin_guilds)
+    @sys_admin_ward
+    async def renderstats_cmd(self, ctx: LionContext, hours: int = 24, by_skin: bool = False):
+        """
+        Summarise the recorded render telemetry over the last `hours` hours.
+        """
+        since = utc_now() - dt.timedelta(hours=hours)
+        rows = await self.data.GuiRender.render_summary(since, by_skin=by_skin)
+        if not rows:
+            await ctx.reply(f"No renders recorded in the last `{hours}` hours.")
+            return
+
+        def fmt(value):
+            return f"{value:.0f}" if value is not None else '-'
+
+        fields = []
+        for row in rows[:20]:
+            key = f"{row['cardname']} ({row['skin']})" if by_skin else row['cardname']
+            fields.append((
+                key,
+                f"{row['renders']} renders, {row['failures']} failed | "
+                f"total p50 {fmt(row['duration_p50'])}ms p95 {fmt(row['duration_p95'])}ms | "
+                f"render p50 {fmt(row['render_p50'])}ms p95 {fmt(row['render_p95'])}ms | "
+                f"wait p95 {fmt(row['wait_p95'])}ms | "
+                f"{fmt((row['mean_bytes'] or 0) / 1024)}KiB"
+            ))
+        embed = discord.Embed(
+            title=f"Render statistics for the last {hours} hours",
+            description='\n'.join(tabulate(*fields)),
+            colour=discord.Colour.orange()
+        )
+        await ctx.reply(embed=embed)
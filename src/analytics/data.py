@@ -1,9 +1,12 @@
+from typing import Optional
 from enum import Enum
+import datetime as dt
 
+from meta.logger import log_wrap
 from data.registry import Registry
 from data.adapted import RegisterEnum
 from data.models import RowModel
-from data.columns import Integer, String, Timestamp, Column
+from data.columns import Integer, String, Timestamp, Bool, Column
 
 
 class CommandStatus(Enum):
@@ -47,10 +50,92 @@ class VoiceAction(Enum):
     LEFT = ('LEFT',)
 
 
+class RenderStatus(Enum):
+    """
+    Schema
+    ------
+    CREATE TYPE analytics.RenderStatus AS ENUM(
+        'SUCCESS',
+        'UNKNOWN_ROUTE',
+        'SYSTEM_ERROR',
+        'RENDER_ERROR',
+        'TIMED_OUT',
+        'CONNECTION_FAILURE',
+        'CANCELLED'
+    );
+    """
+    SUCCESS = ('SUCCESS',)
+    UNKNOWN_ROUTE = ('UNKNOWN_ROUTE',)
+    SYSTEM_ERROR = ('SYSTEM_ERROR',)
+    RENDER_ERROR = ('RENDER_ERROR',)
+    TIMED_OUT = ('TIMED_OUT',)
+    CONNECTION_FAILURE = ('CONNECTION_FAILURE',)
+    CANCELLED = ('CANCELLED',)
+
+
+class RollupPeriod(Enum):
+    """
+    Schema
+    ------
+    CREATE TYPE analytics.RollupPeriod AS ENUM(
+        'HOUR',
+        'DAY'
+    );
+    """
+    HOUR = ('HOUR',)
+    DAY = ('DAY',)
+
+
+class RollupModel(RowModel):
+    """
+    Base for rollup tables.
+
+    Subclasses provide `_hourly_` and `_daily_` queries,
+    which (re)compute all buckets in the range [start, end).
+    Hourly buckets are computed from the raw table, and daily buckets from the hourly buckets.
+    """
+    _hourly_: str
+    _daily_: str
+    # Raw table hourly rollups are computed from
+    _source_: str
+
+    @classmethod
+    @log_wrap(action='rollup')
+    async def rollup(cls, period: RollupPeriod, start: dt.datetime, end: dt.datetime) -> int:
+        """
+        Compute the `period` buckets between `start` and `end`.
+        Returns the number of rollup rows written.
+        """
+        query = cls._hourly_ if period is RollupPeriod.HOUR else cls._daily_
+        async with cls._connector.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(query, {'start': start, 'end': end})
+                return cursor.rowcount
+
+    @classmethod
+    async def earliest(cls, period: RollupPeriod) -> Optional[dt.datetime]:
+        """
+        The earliest time with data to roll up into the given period.
+        """
+        if period is RollupPeriod.HOUR:
+            query = f"SELECT MIN(created_at) AS earliest FROM {cls._source_}"
+            params = ()
+        else:
+            query = f"SELECT MIN(bucket) AS earliest FROM {cls._schema_}.{cls._tablename_} WHERE period = %s"
+            params = (RollupPeriod.HOUR,)
+        async with cls._connector.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(query, params)
+                row = await cursor.fetchone()
+        return row['earliest'] if row else None
+
+
 class AnalyticsData(Registry, name='analytics'):
     CommandStatus = RegisterEnum(CommandStatus, name="analytics.CommandStatus")
     GuildAction = RegisterEnum(GuildAction, name="analytics.GuildAction")
     VoiceAction = RegisterEnum(VoiceAction, name="analytics.VoiceAction")
+    RenderStatus = RegisterEnum(RenderStatus, name="analytics.RenderStatus")
+    RollupPeriod = RegisterEnum(RollupPeriod, name="analytics.RollupPeriod")
 
     class Snapshots(RowModel):
         """
@@ -173,8 +258,19 @@ class AnalyticsData(Registry, name='analytics'):
         ------
         CREATE TABLE analytics.gui_renders(
             cardname TEXT NOT NULL,
-            duration INTEGER NOT NULL
+            duration INTEGER NOT NULL,
+            skin TEXT,
+            locale TEXT,
+            queue_wait INTEGER,
+            render_time INTEGER,
+            output_bytes INTEGER,
+            cache_hit BOOLEAN,
+            status analytics.RenderStatus NOT NULL DEFAULT 'SUCCESS',
+            error TEXT
         ) INHERITS (analytics.events);
+        CREATE INDEX gui_renders_created_at ON analytics.gui_renders (created_at);
+
+        Durations are stored in milliseconds.
         """
         _schema_ = 'analytics'
         _tablename_ = 'gui_renders'
@@ -187,3 +283,245 @@ class AnalyticsData(Registry, name='analytics'):
 
         cardname = String()
         duration = Integer()
+        skin = String()
+        locale = String()
+        queue_wait = Integer()
+        render_time = Integer()
+        output_bytes = Integer()
+        cache_hit = Bool()
+        status: Column[RenderStatus] = Column()
+        error = String()
+
+        @classmethod
+        @log_wrap(action='render_summary')
+        async def render_summary(cls, since: dt.datetime, by_skin=False):
+            """
+            Summarise render latency and output size per card (and optionally skin) since the given time.
+            Returns rows with count, error count, p50/p95 total duration and render time, and mean output size.
+            """
+            group = "cardname, skin" if by_skin else "cardname"
+            query = f"""
+                SELECT
+                    {group},
+                    COUNT(*) AS renders,
+                    COUNT(*) FILTER (WHERE status != 'SUCCESS') AS failures,
+                    percentile_cont(0.5) WITHIN GROUP (ORDER BY duration) AS duration_p50,
+                    percentile_cont(0.95) WITHIN GROUP (ORDER BY duration) AS duration_p95,
+                    percentile_cont(0.5) WITHIN GROUP (ORDER BY render_time) AS render_p50,
+                    percentile_cont(0.95) WITHIN GROUP (ORDER BY render_time) AS render_p95,
+                    percentile_cont(0.95) WITHIN GROUP (ORDER BY queue_wait) AS wait_p95,
+                    AVG(output_bytes) AS mean_bytes
+                FROM analytics.gui_renders
+                WHERE created_at >= %s
+                GROUP BY {group}
+                ORDER BY duration_p95 DESC
+            """
+            async with cls._connector.connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(query, (since,))
+                    return await cursor.fetchall()
+
+    class RollupState(RowModel):
+        """
+        Schema
+        ------
+        CREATE TABLE analytics.rollup_state(
+            name TEXT PRIMARY KEY,
+            rolled_until TIMESTAMPTZ NOT NULL
+        );
+
+        Records the end of the last completed bucket for each rollup, e.g. `commands:HOUR`.
+        """
+        _schema_ = 'analytics'
+        _tablename_ = 'rollup_state'
+
+        name = String(primary=True)
+        rolled_until = Timestamp()
+
+    class CommandRollup(RollupModel):
+        """
+        Schema
+        ------
+        CREATE TABLE analytics.command_rollups(
+            period analytics.RollupPeriod NOT NULL,
+            bucket TIMESTAMPTZ NOT NULL,
+            appname TEXT NOT NULL,
+            cmdname TEXT NOT NULL,
+            status analytics.CommandStatus NOT NULL,
+            count INTEGER NOT NULL,
+            total_time REAL NOT NULL,
+            max_time REAL NOT NULL,
+            PRIMARY KEY (period, bucket, appname, cmdname, status)
+        );
+        """
+        _schema_ = 'analytics'
+        _tablename_ = 'command_rollups'
+        _source_ = 'analytics.commands'
+
+        period: Column[RollupPeriod] = Column(primary=True)
+        bucket = Timestamp(primary=True)
+        appname = String(primary=True)
+        cmdname = String(primary=True)
+        status: Column[CommandStatus] = Column(primary=True)
+        count = Integer()
+        total_time: Column[float] = Column()
+        max_time: Column[float] = Column()
+
+        _hourly_ = """
+            INSERT INTO analytics.command_rollups
+                (period, bucket, appname, cmdname, status, count, total_time, max_time)
+            SELECT
+                'HOUR', date_trunc('hour', created_at, 'UTC'), appname, cmdname, status,
+                COUNT(*), SUM(execution_time), MAX(execution_time)
+            FROM analytics.commands
+            WHERE created_at >= %(start)s AND created_at < %(end)s
+            GROUP BY 2, 3, 4, 5
+            ON CONFLICT (period, bucket, appname, cmdname, status) DO UPDATE SET
+                count = EXCLUDED.count, total_time = EXCLUDED.total_time, max_time = EXCLUDED.max_time
+        """
+        _daily_ = """
+            INSERT INTO analytics.command_rollups
+                (period, bucket, appname, cmdname, status, count, total_time, max_time)
+            SELECT
+                'DAY', date_trunc('day', bucket, 'UTC'), appname, cmdname, status,
+                SUM(count), SUM(total_time), MAX(max_time)
+            FROM analytics.command_rollups
+            WHERE period = 'HOUR' AND bucket >= %(start)s AND bucket < %(end)s
+            GROUP BY 2, 3, 4, 5
+            ON CONFLICT (period, bucket, appname, cmdname, status) DO UPDATE SET
+                count = EXCLUDED.count, total_time = EXCLUDED.total_time, max_time = EXCLUDED.max_time
+        """
+
+    class VoiceRollup(RollupModel):
+        """
+        Schema
+        ------
+        CREATE TABLE analytics.voice_rollups(
+            period analytics.RollupPeriod NOT NULL,
+            bucket TIMESTAMPTZ NOT NULL,
+            appname TEXT NOT NULL,
+            guildid BIGINT NOT NULL,
+            joins INTEGER NOT NULL,
+            leaves INTEGER NOT NULL,
+            PRIMARY KEY (period, bucket, appname, guildid)
+        );
+        """
+        _schema_ = 'analytics'
+        _tablename_ = 'voice_rollups'
+        _source_ = 'analytics.voice_sessions'
+
+        period: Column[RollupPeriod] = Column(primary=True)
+        bucket = Timestamp(primary=True)
+        appname = String(primary=True)
+        guildid = Integer(primary=True)
+        joins = Integer()
+        leaves = Integer()
+
+        _hourly_ = """
+            INSERT INTO analytics.voice_rollups (period, bucket, appname, guildid, joins, leaves)
+            SELECT
+                'HOUR', date_trunc('hour', created_at, 'UTC'), appname, guildid,
+                COUNT(*) FILTER (WHERE action = 'JOINED'),
+                COUNT(*) FILTER (WHERE action = 'LEFT')
+            FROM analytics.voice_sessions
+            WHERE created_at >= %(start)s AND created_at < %(end)s
+            GROUP BY 2, 3, 4
+            ON CONFLICT (period, bucket, appname, guildid) DO UPDATE SET
+                joins = EXCLUDED.joins, leaves = EXCLUDED.leaves
+        """
+        _daily_ = """
+            INSERT INTO analytics.voice_rollups (period, bucket, appname, guildid, joins, leaves)
+            SELECT 'DAY', date_trunc('day', bucket, 'UTC'), appname, guildid, SUM(joins), SUM(leaves)
+            FROM analytics.voice_rollups
+            WHERE period = 'HOUR' AND bucket >= %(start)s AND bucket < %(end)s
+            GROUP BY 2, 3, 4
+            ON CONFLICT (period, bucket, appname, guildid) DO UPDATE SET
+                joins = EXCLUDED.joins, leaves = EXCLUDED.leaves
+        """
+
+    class SnapshotRollup(RollupModel):
+        """
+        Schema
+        ------
+        CREATE TABLE analytics.snapshot_rollups(
+            period analytics.RollupPeriod NOT NULL,
+            bucket TIMESTAMPTZ NOT NULL,
+            appname TEXT NOT NULL,
+            samples INTEGER NOT NULL,
+            guild_min INTEGER NOT NULL,
+            guild_max INTEGER NOT NULL,
+            guild_sum BIGINT NOT NULL,
+            member_min INTEGER NOT NULL,
+            member_max INTEGER NOT NULL,
+            member_sum BIGINT NOT NULL,
+            user_min INTEGER NOT NULL,
+            user_max INTEGER NOT NULL,
+            user_sum BIGINT NOT NULL,
+            voice_min INTEGER NOT NULL,
+            voice_max INTEGER NOT NULL,
+            voice_sum BIGINT NOT NULL,
+            PRIMARY KEY (period, bucket, appname)
+        );
+
+        Sums are stored instead of averages, so buckets may be combined.
+        The average of a bucket is `sum / samples`.
+        """
+        _schema_ = 'analytics'
+        _tablename_ = 'snapshot_rollups'
+        _source_ = 'analytics.snapshots'
+
+        period: Column[RollupPeriod] = Column(primary=True)
+        bucket = Timestamp(primary=True)
+        appname = String(primary=True)
+        samples = Integer()
+        guild_min = Integer()
+        guild_max = Integer()
+        guild_sum = Integer()
+        member_min = Integer()
+        member_max = Integer()
+        member_sum = Integer()
+        user_min = Integer()
+        user_max = Integer()
+        user_sum = Integer()
+        voice_min = Integer()
+        voice_max = Integer()
+        voice_sum = Integer()
+
+        _rollup_columns_ = """
+            period, bucket, appname, samples,
+            guild_min, guild_max, guild_sum, member_min, member_max, member_sum,
+            user_min, user_max, user_sum, voice_min, voice_max, voice_sum
+        """
+        _update_ = """
+            samples = EXCLUDED.samples,
+            guild_min = EXCLUDED.guild_min, guild_max = EXCLUDED.guild_max, guild_sum = EXCLUDED.guild_sum,
+            member_min = EXCLUDED.member_min, member_max = EXCLUDED.member_max, member_sum = EXCLUDED.member_sum,
+            user_min = EXCLUDED.user_min, user_max = EXCLUDED.user_max, user_sum = EXCLUDED.user_sum,
+            voice_min = EXCLUDED.voice_min, voice_max = EXCLUDED.voice_max, voice_sum = EXCLUDED.voice_sum
+        """
+        _hourly_ = f"""
+            INSERT INTO analytics.snapshot_rollups ({_rollup_columns_})
+            SELECT
+                'HOUR', date_trunc('hour', created_at, 'UTC'), appname, COUNT(*),
+                MIN(guild_count), MAX(guild_count), SUM(guild_count),
+                MIN(member_count), MAX(member_count), SUM(member_count),
+                MIN(user_count), MAX(user_count), SUM(user_count),
+                MIN(in_voice), MAX(in_voice), SUM(in_voice)
+            FROM analytics.snapshots
+            WHERE created_at >= %(start)s AND created_at < %(end)s
+            GROUP BY 2, 3
+            ON CONFLICT (period, bucket, appname) DO UPDATE SET {_update_}
+        """
+        _daily_ = f"""
+            INSERT INTO analytics.snapshot_rollups ({_rollup_columns_})
+            SELECT
+                'DAY', date_trunc('day', bucket, 'UTC'), appname, SUM(samples),
+                MIN(guild_min), MAX(guild_max), SUM(guild_sum),
+                MIN(member_min), MAX(member_max), SUM(member_sum),
+                MIN(user_min), MAX(user_max), SUM(user_sum),
+                MIN(voice_min), MAX(voice_max), SUM(voice_sum)
+            FROM analytics.snapshot_rollups
+            WHERE period = 'HOUR' AND bucket >= %(start)s AND bucket < %(end)s
+            GROUP BY 2, 3
+            ON CONFLICT (period, bucket, appname) DO UPDATE SET {_update_}
+        """
@@ -1,14 +1,15 @@
 import asyncio
 import datetime
 import logging
-from collections import namedtuple
+from collections import namedtuple, deque
 from typing import NamedTuple, Optional, Generic, Type, TypeVar
 
-from meta.ipc import AppRoute, AppClient
+from meta.ipc import AppRoute, AppClient, SchemaCodec
+from meta.config import conf
 from meta.logger import logging_context, log_wrap, set_logging_context
 
 from data import RowModel
-from .data import AnalyticsData, CommandStatus, VoiceAction, GuildAction
+from .data import AnalyticsData, CommandStatus, VoiceAction, GuildAction, RenderStatus
 
 
 logger = logging.getLogger(__name__)
@@ -41,16 +42,21 @@ class EventHandler(Generic[T]):
     @property
     def route(self):
         if self._route is None:
-            self._route = AppRoute(self.handle_event, name=self.route_name)
+            self._route = AppRoute(self.handle_event, SchemaCodec(varargs=self.struct), name=self.route_name)
         return self._route
 
-    async def handle_event(self, data):
-        try:
-            await self.queue.put(data)
-        except asyncio.QueueFull:
-            logger.warning(
-                f"Queue on event handler {self.route_name} is full! Discarding event {data}"
-            )
+    async def handle_event(self, *events):
+        """
+        Queue incoming events for insertion.
+        Accepts both single events and batches sent by an `EventEmitter`.
+        """
+        for data in events:
+            try:
+                self.queue.put_nowait(data)
+            except asyncio.QueueFull:
+                logger.warning(
+                    f"Queue on event handler {self.route_name} is full! Discarding event {data}"
+                )
 
     @log_wrap(action='consumer')
     async def consumer(self):
@@ -137,6 +143,170 @@ class EventHandler(Generic[T]):
         return self
 
 
+class EventEmitter(Generic[T]):
+    """
+    Client side buffer for events sent to an `EventHandler` route.
+
+    Events are collected in a bounded buffer, and sent to the analytics app as a single batch
+    once `batchsize` events are waiting, or `interval` seconds after the first waiting event.
+    Batches which fail to send are returned to the buffer, and retried with the next flush.
+    When the buffer is full, for example while the analytics app is offline,
+    the oldest events are discarded and counted in `dropped`.
+    Waiting events are flushed when the emitter is closed.
+    """
+    batchsize = conf.analytics.getint('emit_batchsize', 50)
+    interval = conf.analytics.getint('emit_interval_ms', 2000) / 1000
+    max_buffer = conf.analytics.getint('emit_buffer', 5000)
+
+    def __init__(self, handler: EventHandler[T], target: str,
+                 batchsize: Optional[int] = None, interval: Optional[float] = None,
+                 max_buffer: Optional[int] = None):
+        self.handler = handler
+        self.target = target
+
+        if batchsize is not None:
+            self.batchsize = batchsize
+        if interval is not None:
+            self.interval = interval
+        if max_buffer is not None:
+            self.max_buffer = max_buffer
+
+        self.buffer: deque[T] = deque()
+        self._waiting = asyncio.Event()
+        self._full = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+        # Statistics
+        self.emitted = 0
+        self.sent = 0
+        self.batches = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def __repr__(self):
+        return (
+            f"<EventEmitter route={self.handler.route_name!r} target={self.target!r} "
+            f"buffered={len(self.buffer)} sent={self.sent} batches={self.batches} "
+            f"failed={self.failed} dropped={self.dropped}>"
+        )
+
+    @property
+    def route(self) -> AppRoute:
+        return self.handler.route
+
+    def stats(self) -> dict:
+        return {
+            'buffered': len(self.buffer),
+            'emitted': self.emitted,
+            'sent': self.sent,
+            'batches': self.batches,
+            'failed': self.failed,
+            'dropped': self.dropped,
+        }
+
+    def emit(self, event: T):
+        """
+        Add an event to the buffer, to be sent with the next batch.
+        """
+        self._trim(self.max_buffer - 1)
+        self.buffer.append(event)
+        self.emitted += 1
+        self._waiting.set()
+        if len(self.buffer) >= self.batchsize:
+            self._full.set()
+
+    def _trim(self, size: int):
+        """
+        Discard the oldest events until at most `size` events are buffered.
+        """
+        while len(self.buffer) > size:
+            self.buffer.popleft()
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(
+                    f"Event buffer for {self.handler.route_name} is full! "
+                    f"Discarded {self.dropped} events so far."
+                )
+
+    def start(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(
+                self._flush_loop(), name=f"analytics-emitter-{self.handler.route_name}"
+            )
+        return self
+
+    async def close(self):
+        """
+        Stop the flush loop and send any waiting events.
+        """
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        self._flush_task = None
+        await self.flush()
+
+    @log_wrap(action='Emitter')
+    async def _flush_loop(self):
+        while True:
+            try:
+                await self._waiting.wait()
+                try:
+                    await asyncio.wait_for(self._full.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                await self.flush()
+                if self.buffer:
+                    # Target is unavailable, wait before trying again
+                    await asyncio.sleep(self.interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(
+                    f"Unhandled exception flushing events for {self.handler.route_name}. Continuing."
+                )
+                await asyncio.sleep(self.interval)
+
+    async def flush(self):
+        """
+        Send all waiting events to the target, in batches of at most `batchsize`.
+        Events are kept in the buffer while the target is not connected,
+        and a batch which fails to send is returned to the buffer.
+        """
+        async with self._flush_lock:
+            client = self.route._client
+            while self.buffer:
+                if client is None or self.target not in client.peers:
+                    logger.debug(
+                        f"Analytics peer {self.target} not found, "
+                        f"holding {len(self.buffer)} {self.handler.route_name} events."
+                    )
+                    break
+                count = min(len(self.buffer), self.batchsize)
+                batch = [self.buffer.popleft() for _ in range(count)]
+                try:
+                    await self.route(*batch).send(self.target, wait_for_reply=False, raise_errors=True)
+                except Exception:
+                    # Return the batch to the front of the buffer, to be retried on the next flush
+                    self.buffer.extendleft(reversed(batch))
+                    self._trim(self.max_buffer)
+                    self.failed += 1
+                    logger.warning(
+                        f"Failed to send {count} {self.handler.route_name} events to {self.target}, "
+                        f"holding {len(self.buffer)} events."
+                    )
+                    break
+                self.sent += count
+                self.batches += 1
+            if not self.buffer:
+                self._waiting.clear()
+            if len(self.buffer) < self.batchsize:
+                self._full.clear()
+
+
 class CommandEvent(NamedTuple):
     appname: str
     cmdname: str
@@ -178,3 +348,23 @@ class VoiceEvent(NamedTuple):
 voice_event_handler: EventHandler[VoiceEvent] = EventHandler(
     'voice_event', AnalyticsData.VoiceSession, VoiceEvent, batchsize=5
 )
+
+
+class RenderEvent(NamedTuple):
+    appname: str
+    cardname: str
+    duration: int
+    status: RenderStatus
+    created_at: datetime.datetime
+    skin: Optional[str] = None
+    locale: Optional[str] = None
+    queue_wait: Optional[int] = None
+    render_time: Optional[int] = None
+    output_bytes: Optional[int] = None
+    cache_hit: Optional[bool] = None
+    error: Optional[str] = None
+
+
+render_event_handler: EventHandler[RenderEvent] = EventHandler(
+    'render_event', AnalyticsData.GuiRender, RenderEvent, batchsize=20
+)
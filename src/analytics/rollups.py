@@ -0,0 +1,215 @@
+"""
+Background maintenance for the analytics tables.
+
+Hourly and daily rollups are computed incrementally,
+tracking the end of the last completed bucket for each rollup in `analytics.rollup_state`.
+Hourly buckets are only computed once they have been closed for `rollup_lag` seconds,
+to allow for events buffered by the shards.
+Daily buckets are computed from the completed hourly buckets.
+
+Raw data older than the configured retention is deleted in small batches,
+and raw rows are never deleted before they have been rolled up.
+"""
+from typing import Optional, Type
+import asyncio
+import logging
+import datetime as dt
+
+from meta import conf
+from meta.logger import log_wrap
+from data import RowModel
+from utils.lib import utc_now
+
+from .data import AnalyticsData, RollupModel, RollupPeriod
+
+
+logger = logging.getLogger(__name__)
+
+
+period_length = {
+    RollupPeriod.HOUR: dt.timedelta(hours=1),
+    RollupPeriod.DAY: dt.timedelta(days=1),
+}
+
+
+def truncate(time: dt.datetime, period: RollupPeriod) -> dt.datetime:
+    """
+    Truncate the given time to the start of its UTC bucket.
+    """
+    time = time.astimezone(dt.timezone.utc).replace(minute=0, second=0, microsecond=0)
+    if period is RollupPeriod.DAY:
+        time = time.replace(hour=0)
+    return time
+
+
+class AnalyticsMaintenance:
+    # How often to run the rollup and retention jobs, in seconds
+    interval = conf.analytics.getint('rollup_interval', 300)
+    # How long after an hour closes to wait for late events before rolling it up, in seconds
+    lag = conf.analytics.getint('rollup_lag', 600)
+    # Maximum number of buckets computed in a single query
+    max_buckets = {
+        RollupPeriod.HOUR: 24,
+        RollupPeriod.DAY: 7,
+    }
+
+    # Retention in days, 0 keeps data forever
+    raw_retention = conf.analytics.getint('raw_retention_days', 90)
+    render_retention = conf.analytics.getint('render_retention_days', 30)
+    snapshot_retention = conf.analytics.getint('snapshot_retention_days', 90)
+    hourly_retention = conf.analytics.getint('hourly_retention_days', 400)
+
+    # Rows deleted per batch, and pause between batches in seconds
+    delete_batch = conf.analytics.getint('retention_batch', 5000)
+    delete_pause = 0.1
+
+    def __init__(self, data: AnalyticsData):
+        self.data = data
+        self.rollups: list[Type[RollupModel]] = [
+            data.CommandRollup,
+            data.VoiceRollup,
+            data.SnapshotRollup,
+        ]
+
+    @staticmethod
+    def _state_name(model: Type[RollupModel], period: RollupPeriod) -> str:
+        return f"{model._tablename_}:{period.value[0]}"
+
+    async def get_watermark(self, model, period) -> Optional[dt.datetime]:
+        row = await self.data.RollupState.fetch(self._state_name(model, period))
+        return row.rolled_until if row else None
+
+    async def set_watermark(self, model, period, until: dt.datetime):
+        name = self._state_name(model, period)
+        row = await self.data.RollupState.fetch_or_create(name, rolled_until=until)
+        if row.rolled_until != until:
+            await row.update(rolled_until=until)
+
+    @log_wrap(action='Rollup')
+    async def roll(self, model: Type[RollupModel], period: RollupPeriod) -> int:
+        """
+        Compute all completed buckets for the given rollup and period.
+        Returns the number of buckets computed.
+        """
+        if period is RollupPeriod.HOUR:
+            limit = truncate(utc_now() - dt.timedelta(seconds=self.lag), period)
+        else:
+            hourly = await self.get_watermark(model, RollupPeriod.HOUR)
+            if hourly is None:
+                return 0
+            limit = truncate(hourly, period)
+
+        start = await self.get_watermark(model, period)
+        if start is None:
+            earliest = await model.earliest(period)
+            if earliest is None:
+                # Nothing to roll up yet
+                return 0
+            start = truncate(earliest, period)
+
+        step = period_length[period]
+        computed = 0
+        while start < limit:
+            end = min(start + step * self.max_buckets[period], limit)
+            rows = await model.rollup(period, start, end)
+            await self.set_watermark(model, period, end)
+            computed += (end - start) // step
+            logger.debug(
+                f"Rolled up {model._tablename_} {period.name} buckets from {start} to {end} ({rows} rows)."
+            )
+            start = end
+        return computed
+
+    async def run_rollups(self):
+        for model in self.rollups:
+            for period in (RollupPeriod.HOUR, RollupPeriod.DAY):
+                try:
+                    await self.roll(model, period)
+                except Exception:
+                    logger.exception(
+                        f"Unexpected exception rolling up {model._tablename_} {period.name} buckets. Skipping."
+                    )
+
+    async def batched_delete(self, model: Type[RowModel], column: str, cutoff: dt.datetime,
+                             condition: str = 'TRUE') -> int:
+        """
+        Delete rows from the model table with `column` before `cutoff`, in batches.
+        Returns the total number of rows deleted.
+        """
+        table = f"{model._schema_}.{model._tablename_}"
+        query = f"""
+            DELETE FROM {table}
+            WHERE ctid = ANY(ARRAY(
+                SELECT ctid FROM {table}
+                WHERE {column} < %s AND {condition}
+                LIMIT %s
+            ))
+        """
+        total = 0
+        while True:
+            async with model._connector.connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(query, (cutoff, self.delete_batch))
+                    deleted = cursor.rowcount
+            total += deleted
+            if deleted < self.delete_batch:
+                break
+            await asyncio.sleep(self.delete_pause)
+        if total:
+            logger.info(f"Deleted {total} rows from {table} older than {cutoff}.")
+        return total
+
+    async def _rolled_cutoff(self, days: int, model: Optional[Type[RollupModel]], period: RollupPeriod):
+        """
+        The retention cutoff for `days` days of data,
+        bounded by the watermark of the given rollup so we never delete data which has not been rolled up.
+        """
+        cutoff = utc_now() - dt.timedelta(days=days)
+        if model is not None:
+            watermark = await self.get_watermark(model, period)
+            if watermark is None:
+                return None
+            cutoff = min(cutoff, watermark)
+        return cutoff
+
+    @log_wrap(action='Retention')
+    async def enforce_retention(self):
+        data = self.data
+        policies = [
+            (data.Commands, 'created_at', self.raw_retention, data.CommandRollup, RollupPeriod.HOUR, 'TRUE'),
+            (data.VoiceSession, 'created_at', self.raw_retention, data.VoiceRollup, RollupPeriod.HOUR, 'TRUE'),
+            (data.Snapshots, 'created_at', self.snapshot_retention, data.SnapshotRollup, RollupPeriod.HOUR, 'TRUE'),
+            (data.GuiRender, 'created_at', self.render_retention, None, RollupPeriod.HOUR, 'TRUE'),
+        ]
+        for model in self.rollups:
+            # Hourly buckets are kept until they have been rolled into daily buckets
+            policies.append(
+                (model, 'bucket', self.hourly_retention, model, RollupPeriod.DAY, "period = 'HOUR'")
+            )
+
+        for model, column, days, rollup, period, condition in policies:
+            if not days:
+                continue
+            try:
+                cutoff = await self._rolled_cutoff(days, rollup, period)
+                if cutoff is not None:
+                    await self.batched_delete(model, column, cutoff, condition)
+            except Exception:
+                logger.exception(
+                    f"Unexpected exception enforcing retention on {model._tablename_}. Skipping."
+                )
+
+    @log_wrap(action='Maintenance')
+    async def maintenance_loop(self):
+        while True:
+            try:
+                await self.run_rollups()
+                await self.enforce_retention()
+            except asyncio.CancelledError:
+                logger.info("Analytics maintenance loop cancelled, closing.")
+                return
+            except Exception:
+                logger.exception(
+                    "Unhandled exception during analytics maintenance. Ignoring and continuing cautiously."
+                )
+            await asyncio.sleep(self.interval)
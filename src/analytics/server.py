@@ -4,15 +4,16 @@ from typing import Optional
 
 from meta import conf, appname
 from meta.logger import log_context, log_action_stack, logging_context, log_app, log_wrap, setup_main_logger
-from meta.ipc import AppClient
+from meta.ipc import AppClient, SchemaCodec
 from meta.app import appname_from_shard
 from meta.sharding import shard_count
 
 from data import Database
 
-from .events import command_event_handler, guild_event_handler, voice_event_handler
+from .events import command_event_handler, guild_event_handler, voice_event_handler, render_event_handler
 from .snapshot import shard_snapshot, ShardSnapshot
 from .data import AnalyticsData
+from .rollups import AnalyticsMaintenance
 
 
 logger = logging.getLogger(__name__)
@@ -22,11 +23,11 @@ for name in conf.config.options('LOGGING_LEVELS', no_defaults=True):
 
 
 class AnalyticsServer:
-    # TODO: Move these to the config
     # How often to request snapshots
-    snap_period = 900
+    # Shards maintain their counters incrementally, so snapshots are cheap to take
+    snap_period = conf.analytics.getint('snapshot_period', 900)
     # How soon after a snapshot failure (e.g. not all shards online) to retry
-    snap_retry_period = 60
+    snap_retry_period = conf.analytics.getint('snapshot_retry_period', 60)
 
     def __init__(self) -> None:
         self.db = Database(conf.data['args'])
@@ -35,7 +36,8 @@ class AnalyticsServer:
         self.event_handlers = [
             command_event_handler,
             guild_event_handler,
-            voice_event_handler
+            voice_event_handler,
+            render_event_handler,
         ]
 
         self.talk = AppClient(
@@ -44,10 +46,13 @@ class AnalyticsServer:
             {'host': conf.analytics['server_host'], 'port': int(conf.analytics['server_port'])},
             {'host': conf.appipc['server_host'], 'port': int(conf.appipc['server_port'])}
         )
-        self.talk_shard_snapshot = self.talk.register_route()(shard_snapshot)
+        self.talk_shard_snapshot = self.talk.register_route(codec=SchemaCodec(result=ShardSnapshot))(shard_snapshot)
 
         self._snap_task: Optional[asyncio.Task] = None
 
+        self.maintenance = AnalyticsMaintenance(self.data)
+        self._maintenance_task: Optional[asyncio.Task] = None
+
     async def attach_event_handlers(self):
         for handler in self.event_handlers:
             await handler.attach(self.talk)
@@ -127,6 +132,7 @@ class AnalyticsServer:
             await self.talk.connect()
             await self.attach_event_handlers()
             self._snap_task = asyncio.create_task(self.snapshot_loop())
+            self._maintenance_task = asyncio.create_task(self.maintenance.maintenance_loop())
             await asyncio.gather(*(handler._consumer_task for handler in self.event_handlers))
 
 
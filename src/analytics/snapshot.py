@@ -1,7 +1,13 @@
-from typing import NamedTuple
+from typing import NamedTuple, Optional
+import logging
+import time
+
+import discord
 
 from meta.context import ctx_bot
 
+logger = logging.getLogger(__name__)
+
 
 class ShardSnapshot(NamedTuple):
     guild_count: int
@@ -10,6 +16,110 @@ class ShardSnapshot(NamedTuple):
     user_count: int
 
 
+class ShardCounters:
+    """
+    Shard statistics maintained incrementally from gateway events.
+
+    The counters are rebuilt from the client cache by `reconcile`,
+    which is run when the shard becomes ready and periodically afterwards,
+    correcting any drift (e.g. from members cached outside of join events, or missed events).
+    Between reconciliations, snapshots are O(1).
+
+    `user_count` counts distinct cached members, by tracking the number of cached guilds each user is in.
+    """
+    def __init__(self):
+        self.synced = False
+        self.voice_count = 0
+        self.member_count = 0
+        self.user_guilds: dict[int, int] = {}  # userid -> number of guilds
+
+        self.reconciled_at: Optional[float] = None
+        self.reconciliations = 0
+        # Total correction applied to each counter by the last reconciliation
+        self.last_drift: dict[str, int] = {}
+
+    @staticmethod
+    def _counts_voice(channel) -> bool:
+        return isinstance(channel, discord.VoiceChannel)
+
+    def snapshot(self, bot) -> ShardSnapshot:
+        return ShardSnapshot(
+            guild_count=len(bot.guilds),
+            voice_count=self.voice_count,
+            member_count=self.member_count,
+            user_count=len(self.user_guilds),
+        )
+
+    def reconcile(self, bot):
+        """
+        Recompute the counters from the client cache.
+        """
+        start = time.perf_counter()
+        voice_count = 0
+        member_count = 0
+        user_guilds = {}
+        for guild in bot.guilds:
+            member_count += guild.member_count or 0
+            voice_count += sum(len(channel.members) for channel in guild.voice_channels)
+            for member in guild.members:
+                user_guilds[member.id] = user_guilds.get(member.id, 0) + 1
+
+        if self.synced:
+            self.last_drift = {
+                'voice_count': voice_count - self.voice_count,
+                'member_count': member_count - self.member_count,
+                'user_count': len(user_guilds) - len(self.user_guilds),
+            }
+        self.voice_count = voice_count
+        self.member_count = member_count
+        self.user_guilds = user_guilds
+
+        self.synced = True
+        self.reconciled_at = time.time()
+        self.reconciliations += 1
+        logger.debug(
+            f"Reconciled shard counters in {time.perf_counter() - start:.3f}s with drift {self.last_drift}."
+        )
+
+    def _add_user(self, userid: int):
+        self.user_guilds[userid] = self.user_guilds.get(userid, 0) + 1
+
+    def _remove_user(self, userid: int):
+        count = self.user_guilds.get(userid, 0)
+        if count > 1:
+            self.user_guilds[userid] = count - 1
+        else:
+            # Ignore users we never counted, they will be corrected by the next reconciliation
+            self.user_guilds.pop(userid, None)
+
+    def member_join(self, member: discord.Member):
+        self.member_count += 1
+        self._add_user(member.id)
+
+    def member_remove(self, guildid: int, userid: int, cached: bool):
+        self.member_count -= 1
+        if cached:
+            self._remove_user(userid)
+
+    def guild_join(self, guild: discord.Guild):
+        self.member_count += guild.member_count or 0
+        self.voice_count += sum(len(channel.members) for channel in guild.voice_channels)
+        for member in guild.members:
+            self._add_user(member.id)
+
+    def guild_remove(self, guild: discord.Guild):
+        self.member_count -= guild.member_count or 0
+        self.voice_count -= sum(len(channel.members) for channel in guild.voice_channels)
+        for member in guild.members:
+            self._remove_user(member.id)
+
+    def voice_update(self, before: discord.VoiceState, after: discord.VoiceState):
+        self.voice_count += self._counts_voice(after.channel) - self._counts_voice(before.channel)
+
+
+shard_counters = ShardCounters()
+
+
 async def shard_snapshot():
     """
     Take a snapshot of the current shard.
@@ -19,10 +129,6 @@ async def shard_snapshot():
         # We cannot take a snapshot without Bot
         # Just quietly fail
         return None
-    snap = ShardSnapshot(
-        guild_count=len(bot.guilds),
-        voice_count=sum(len(channel.members) for guild in bot.guilds for channel in guild.voice_channels),
-        member_count=sum(guild.member_count for guild in bot.guilds),
-        user_count=len(set(m.id for guild in bot.guilds for m in guild.members))
-    )
-    return snap
+    if not shard_counters.synced:
+        shard_counters.reconcile(bot)
+    return shard_counters.snapshot(bot)
@@ -370,4 +370,48 @@ class CoreData(Registry, name="core"):
             webhook.proxy = conf.bot.get('proxy', None)
             return webhook
 
+    class RoleMutationJob(RowModel):
+        """
+        Schema
+        ------
+        CREATE TABLE role_mutation_jobs(
+          jobid SERIAL PRIMARY KEY,
+          guildid BIGINT NOT NULL REFERENCES guild_config (guildid) ON DELETE CASCADE,
+          kind TEXT NOT NULL,
+          reason TEXT,
+          priority INTEGER NOT NULL DEFAULT 1,
+          total INTEGER NOT NULL DEFAULT 0,
+          done INTEGER NOT NULL DEFAULT 0,
+          skipped INTEGER NOT NULL DEFAULT 0,
+          failed INTEGER NOT NULL DEFAULT 0,
+          created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+          completed_at TIMESTAMPTZ
+        );
+        CREATE INDEX role_mutation_jobs_pending ON role_mutation_jobs (guildid) WHERE completed_at IS NULL;
+
+        CREATE TABLE role_mutation_members(
+          jobid INTEGER NOT NULL REFERENCES role_mutation_jobs (jobid) ON DELETE CASCADE,
+          userid BIGINT NOT NULL,
+          add_roles BIGINT[] NOT NULL DEFAULT '{}',
+          remove_roles BIGINT[] NOT NULL DEFAULT '{}',
+          PRIMARY KEY (jobid, userid)
+        );
+        """
+        _tablename_ = 'role_mutation_jobs'
+
+        jobid = Integer(primary=True)
+        guildid = Integer()
+        kind = String()
+        reason = String()
+        priority = Integer()
+        total = Integer()
+        done = Integer()
+        skipped = Integer()
+        failed = Integer()
+        created_at = Timestamp()
+        completed_at = Timestamp()
+
+    # Pending members of each role mutation job
+    role_mutation_members = Table('role_mutation_members')
+
     workouts = Table('workout_sessions')
@@ -0,0 +1,464 @@
+from typing import Optional, Callable, Iterable
+from collections import defaultdict, deque
+from itertools import count
+import asyncio
+import datetime as dt
+import logging
+import time
+
+import discord
+from discord.http import Route
+
+from meta import LionBot, LionCog, conf
+from meta.logger import log_wrap
+from utils.lib import utc_now
+
+from .data import CoreData
+
+logger = logging.getLogger(__name__)
+
+# (userid, roleids to add, roleids to remove)
+MutationSpec = tuple[int, Iterable[int], Iterable[int]]
+
+
+class RoleMutation:
+    """
+    Pending role changes for a single member.
+    """
+    __slots__ = ('userid', 'add', 'remove')
+
+    def __init__(self, userid: int, add: Iterable[int] = (), remove: Iterable[int] = ()):
+        self.userid = userid
+        self.add: set[int] = set(add)
+        self.remove: set[int] = set(remove) - self.add
+
+    def merge(self, add: Iterable[int] = (), remove: Iterable[int] = ()):
+        """
+        Merge further changes into this mutation, later changes taking precedence.
+        """
+        add = set(add)
+        remove = set(remove) - add
+        self.add = (self.add - remove) | add
+        self.remove = (self.remove - add) | remove
+
+    def apply(self, roleids: set[int]) -> set[int]:
+        return (roleids - self.remove) | self.add
+
+
+class RoleJob:
+    """
+    A bulk role mutation job in a single guild.
+
+    Tracks the progress of the job, and estimates the time remaining
+    from the rate at which members have been processed since the job started.
+    """
+    _seq = count()
+
+    def __init__(self, guildid: int, kind: str, mutations: Iterable[RoleMutation],
+                 reason: Optional[str] = None, priority: int = 1,
+                 max_failures: Optional[int] = None,
+                 row: Optional[CoreData.RoleMutationJob] = None):
+        self.guildid = guildid
+        self.kind = kind
+        self.reason = reason
+        self.priority = priority
+        self.max_failures = max_failures
+        self.row = row
+        self.seq = next(self._seq)
+
+        self.pending: deque[RoleMutation] = deque(mutations)
+        self.in_flight = 0
+
+        self.total = row.total if row is not None else len(self.pending)
+        self.done = row.done if row is not None else 0
+        self.skipped = row.skipped if row is not None else 0
+        self.failed = row.failed if row is not None else 0
+        # userid -> error description, for failures in this run
+        self.failures: dict[int, str] = {}
+        self.aborted = False
+
+        self.started_at: Optional[float] = None
+        self._processed_at_start = 0
+
+        # Processed userids which have not been saved yet
+        self._unsaved: list[int] = []
+        self._save_lock = asyncio.Lock()
+        self._finished = asyncio.Event()
+        self._listeners: list[Callable[[], None]] = []
+
+    def __repr__(self):
+        return (
+            f"<RoleJob jobid={self.jobid} guildid={self.guildid} kind={self.kind!r} "
+            f"processed={self.processed}/{self.total} failed={self.failed} aborted={self.aborted}>"
+        )
+
+    @property
+    def jobid(self) -> Optional[int]:
+        return self.row.jobid if self.row is not None else None
+
+    @property
+    def processed(self) -> int:
+        return self.done + self.skipped + self.failed
+
+    @property
+    def remaining(self) -> int:
+        return max(self.total - self.processed, 0)
+
+    @property
+    def finished(self) -> bool:
+        return self._finished.is_set()
+
+    def eta(self) -> Optional[dt.timedelta]:
+        """
+        Estimated time until the job completes, or None if it cannot be estimated yet.
+        """
+        if self.started_at is None:
+            return None
+        processed = self.processed - self._processed_at_start
+        if processed <= 0:
+            return None
+        elapsed = time.monotonic() - self.started_at
+        return dt.timedelta(seconds=self.remaining * elapsed / processed)
+
+    def add_listener(self, callback: Callable[[], None]):
+        """
+        Add a callback to run whenever progress is made on the job, and when it finishes.
+        """
+        self._listeners.append(callback)
+
+    def abort(self):
+        """
+        Stop the job, discarding its pending members.
+        Edits already in flight are still completed.
+        """
+        self.aborted = True
+        self.pending.clear()
+
+    async def wait(self):
+        await self._finished.wait()
+
+    def _start(self):
+        self.started_at = time.monotonic()
+        self._processed_at_start = self.processed
+
+    def _notify(self):
+        for callback in self._listeners:
+            try:
+                callback()
+            except Exception:
+                logger.exception(f"Unhandled exception in progress listener of {self!r}")
+
+
+class RoleMutations(LionCog):
+    """
+    Scheduler for bulk member role updates.
+
+    Jobs are queued per guild, and each guild runs at most `concurrency` member edits at once,
+    always taking the next member from the queued job with the best priority.
+    All the changes to a member within a job are applied with a single member edit,
+    and members whose roles are already correct are skipped without an edit.
+    Jobs for a single member which only add or only remove roles
+    are instead applied per role, so they never overwrite concurrent role changes.
+    Edits are paced from the rate limit state of the member edit route,
+    leaving some of each rate limit window for other member updates.
+
+    Persisted jobs save their pending members,
+    and are resumed from the members not yet processed after a restart.
+    """
+    # Number of processed members between progress saves
+    save_interval = 100
+    # Number of member rows inserted per query when persisting a job
+    insert_chunk = 10000
+
+    def __init__(self, bot: LionBot, data: CoreData):
+        self.bot = bot
+        self.data = data
+
+        self.concurrency = conf.bot.getint('role_mutation_concurrency', 2)
+        self._global_limit = asyncio.Semaphore(conf.bot.getint('role_mutation_global_concurrency', 10))
+
+        # guildid -> queued jobs
+        self._jobs: defaultdict[int, list[RoleJob]] = defaultdict(list)
+        # guildid -> running worker task
+        self._workers: dict[int, asyncio.Task] = {}
+
+    async def cog_unload(self):
+        # Persisted jobs resume from their saved progress when next loaded
+        for task in self._workers.values():
+            task.cancel()
+        self._workers.clear()
+        self._jobs.clear()
+
+    # ----- API -----
+    async def submit(self, guildid: int, *mutations: MutationSpec, kind: str,
+                     reason: Optional[str] = None, priority: int = 1,
+                     persist: bool = True, max_failures: Optional[int] = None) -> RoleJob:
+        """
+        Schedule the given role mutations in a guild, and return the job applying them.
+
+        Mutations for the same member are merged, with later mutations taking precedence.
+        Jobs with a lower `priority` are processed first.
+        If `max_failures` is given, the job is aborted after that many failed edits.
+        If `persist` is set, the job is saved so that it resumes after a restart.
+        """
+        merged: dict[int, RoleMutation] = {}
+        for userid, add, remove in mutations:
+            if (mutation := merged.get(userid, None)) is None:
+                merged[userid] = RoleMutation(userid, add, remove)
+            else:
+                mutation.merge(add, remove)
+
+        row = None
+        if persist and merged:
+            row = await self.data.RoleMutationJob.create(
+                guildid=guildid, kind=kind, reason=reason, priority=priority, total=len(merged)
+            )
+            values = [
+                (row.jobid, mutation.userid, list(mutation.add), list(mutation.remove))
+                for mutation in merged.values()
+            ]
+            for i in range(0, len(values), self.insert_chunk):
+                await self.data.role_mutation_members.insert_many(
+                    ('jobid', 'userid', 'add_roles', 'remove_roles'),
+                    *values[i:i + self.insert_chunk]
+                )
+
+        job = RoleJob(
+            guildid, kind, merged.values(),
+            reason=reason, priority=priority, max_failures=max_failures, row=row
+        )
+        logger.info(f"Scheduled role mutation job {job!r}.")
+        self._enqueue(job)
+        return job
+
+    def guild_jobs(self, guildid: int) -> list[RoleJob]:
+        return list(self._jobs.get(guildid, ()))
+
+    def summary(self) -> str:
+        jobs = [job for gjobs in self._jobs.values() for job in gjobs]
+        return (
+            f"guilds={len(self._workers)} jobs={len(jobs)} "
+            f"pending={sum(len(job.pending) for job in jobs)} "
+            f"in_flight={sum(job.in_flight for job in jobs)}"
+        )
+
+    # ----- Event handlers -----
+    @LionCog.listener('on_ready')
+    @log_wrap(action='Resume Role Mutations')
+    async def resume_jobs(self):
+        """
+        Resume the incomplete persisted jobs in the current guilds.
+        """
+        guildids = [guild.id for guild in self.bot.guilds]
+        if not guildids:
+            return
+        running = {job.jobid for gjobs in self._jobs.values() for job in gjobs}
+        rows = await self.data.RoleMutationJob.fetch_where(guildid=guildids, completed_at=None)
+        rows = [row for row in rows if row.jobid not in running]
+        if not rows:
+            return
+
+        member_rows = await self.data.role_mutation_members.select_where(
+            jobid=[row.jobid for row in rows]
+        )
+        job_mutations = defaultdict(list)
+        for member_row in member_rows:
+            job_mutations[member_row['jobid']].append(
+                RoleMutation(member_row['userid'], member_row['add_roles'], member_row['remove_roles'])
+            )
+
+        for row in rows:
+            job = RoleJob(
+                row.guildid, row.kind, job_mutations[row.jobid],
+                reason=row.reason, priority=row.priority, row=row
+            )
+            self._enqueue(job)
+        logger.info(
+            f"Resumed {len(rows)} role mutation jobs with {len(member_rows)} pending members."
+        )
+
+    # ----- Scheduling -----
+    def _enqueue(self, job: RoleJob):
+        if not job.pending:
+            self._finish(job)
+            return
+        self._jobs[job.guildid].append(job)
+        worker = self._workers.get(job.guildid, None)
+        if worker is None or worker.done():
+            self._start_worker(job.guildid)
+
+    def _start_worker(self, guildid: int):
+        worker = self._workers[guildid] = asyncio.create_task(
+            self._run_guild(guildid), name=f'role-mutations-{guildid}'
+        )
+        worker.add_done_callback(self._worker_done)
+
+    def _worker_done(self, task: asyncio.Task):
+        for guildid, worker in list(self._workers.items()):
+            if worker is task:
+                self._workers.pop(guildid)
+                # Jobs may have been queued while the worker was finishing
+                if not task.cancelled() and any(job.pending for job in self._jobs.get(guildid, ())):
+                    self._start_worker(guildid)
+
+    def _next(self, guildid: int) -> Optional[tuple[RoleJob, RoleMutation]]:
+        """
+        Take the next mutation to apply in the given guild, if there is one.
+        """
+        jobs = [job for job in self._jobs.get(guildid, ()) if job.pending]
+        if not jobs:
+            return None
+        job = min(jobs, key=lambda job: (job.priority, job.seq))
+        if job.started_at is None:
+            job._start()
+        job.in_flight += 1
+        return job, job.pending.popleft()
+
+    @log_wrap(action='Role Mutation Worker')
+    async def _run_guild(self, guildid: int):
+        try:
+            await asyncio.gather(*(self._guild_worker(guildid) for _ in range(self.concurrency)))
+        finally:
+            # Finish any jobs emptied without a worker, e.g. aborted before starting
+            for job in list(self._jobs.get(guildid, ())):
+                if not job.pending and not job.in_flight:
+                    self._finish(job)
+
+    async def _guild_worker(self, guildid: int):
+        while (picked := self._next(guildid)) is not None:
+            job, mutation = picked
+            try:
+                await self._apply(job, mutation)
+            finally:
+                job.in_flight -= 1
+            job._notify()
+            if job.row is not None and len(job._unsaved) >= self.save_interval:
+                await self._save_progress(job)
+            if not job.pending and not job.in_flight:
+                self._finish(job)
+
+    def _finish(self, job: RoleJob):
+        if job.finished:
+            return
+        jobs = self._jobs.get(job.guildid, None)
+        if jobs is not None and job in jobs:
+            jobs.remove(job)
+            if not jobs:
+                self._jobs.pop(job.guildid, None)
+        job._finished.set()
+        job._notify()
+        if job.row is not None:
+            asyncio.create_task(self._save_completion(job))
+        logger.info(f"Finished role mutation job {job!r}.")
+
+    # ----- Execution -----
+    async def _apply(self, job: RoleJob, mutation: RoleMutation):
+        userid = mutation.userid
+        guild = self.bot.get_guild(job.guildid)
+        if guild is None:
+            # We have left the guild, nothing more can be applied
+            logger.info(f"Aborting role mutation job {job!r} because the guild is unavailable.")
+            job.abort()
+            job.skipped += 1
+            job._unsaved.append(userid)
+            return
+
+        try:
+            member = guild.get_member(userid)
+            if member is None:
+                member = await guild.fetch_member(userid)
+            roleids = {role.id for role in member.roles[1:]}
+            # Never try to add roles which no longer exist
+            mutation.add = {roleid for roleid in mutation.add if guild.get_role(roleid) is not None}
+            to_add = mutation.add - roleids
+            to_remove = mutation.remove & roleids
+            if not to_add and not to_remove:
+                job.skipped += 1
+            elif job.total == 1 and not (to_add and to_remove):
+                # A full role list edit from the cached roles would strip roles given concurrently,
+                # e.g. by other bots when the member joins, so only send the changed roles
+                async with self._global_limit:
+                    if to_add:
+                        await member.add_roles(
+                            *(discord.Object(id=roleid) for roleid in to_add), reason=job.reason
+                        )
+                    else:
+                        await member.remove_roles(
+                            *(discord.Object(id=roleid) for roleid in to_remove), reason=job.reason
+                        )
+                job.done += 1
+            else:
+                new_roleids = mutation.apply(roleids)
+                await self._pace(guild.id)
+                async with self._global_limit:
+                    await member.edit(
+                        roles=[discord.Object(id=roleid) for roleid in new_roleids],
+                        reason=job.reason
+                    )
+                job.done += 1
+        except discord.NotFound:
+            # The member left the guild
+            job.skipped += 1
+        except discord.HTTPException as e:
+            job.failed += 1
+            job.failures[userid] = e.text or str(e)
+            logger.debug(
+                f"Role mutation for <uid:{userid}> in <gid:{job.guildid}> failed: {e.text}"
+            )
+            if job.max_failures is not None and job.failed > job.max_failures:
+                logger.info(f"Aborting role mutation job {job!r} after too many failures.")
+                job.abort()
+        job._unsaved.append(userid)
+
+    def _edit_ratelimit(self, guildid: int):
+        """
+        The client rate limit state of the member edit route in the given guild, if known.
+
+        This reads the internal bucket map of the discord.py HTTP client,
+        and gives None if it is unavailable.
+        """
+        http = self.bot.http
+        route = Route('PATCH', '/guilds/{guild_id}/members/{user_id}', guild_id=guildid, user_id=0)
+        bucket_hash = getattr(http, '_bucket_hashes', {}).get(route.key, route.key)
+        return getattr(http, '_buckets', {}).get(f"{bucket_hash}:{route.major_parameters}", None)
+
+    def _pace_delay(self, guildid: int) -> float:
+        """
+        Delay before the next edit by a worker in the given guild.
+
+        Spreads the remaining requests of the current rate limit window evenly over the window,
+        reserving one request for other member updates.
+        """
+        ratelimit = self._edit_ratelimit(guildid)
+        expires = getattr(ratelimit, 'expires', None)
+        if expires is None:
+            return 0
+        window = expires - asyncio.get_running_loop().time()
+        if window <= 0:
+            return 0
+        available = ratelimit.remaining - 1
+        if available <= 0:
+            return window
+        return min(window * self.concurrency / available, window)
+
+    async def _pace(self, guildid: int):
+        if (delay := self._pace_delay(guildid)) > 0:
+            await asyncio.sleep(delay)
+
+    # ----- Persistence -----
+    async def _save_progress(self, job: RoleJob):
+        async with job._save_lock:
+            userids, job._unsaved = job._unsaved, []
+            if userids:
+                await self.data.role_mutation_members.delete_where(jobid=job.jobid, userid=userids)
+            await job.row.update(done=job.done, skipped=job.skipped, failed=job.failed)
+
+    @log_wrap(action='Save Role Mutation Job')
+    async def _save_completion(self, job: RoleJob):
+        try:
+            await self._save_progress(job)
+            if job.aborted:
+                await self.data.role_mutation_members.delete_where(jobid=job.jobid)
+            await job.row.update(completed_at=utc_now())
+        except Exception:
+            logger.exception(f"Unexpected exception saving completed role mutation job {job!r}.")
@@ -1,13 +1,13 @@
-from typing import Type
+from typing import Type, Optional
 import os
-import gc
+import asyncio
 from contextlib import closing
 import logging
 
 from babel.translator import ctx_locale, LazyStr
 
-from ..utils import image_as_file
-from ..client import request
+from ..utils import image_as_file, OutputFormat, default_output_format
+from ..client import request, client
 from .Layout import Layout
 from .Skin import Skin
 
@@ -29,6 +29,14 @@ class Card:
 
     display_name: LazyStr
 
+    # Output encoding for this card, uses the configured default if not set
+    # May be overridden per request with the `output_format` keyword argument
+    output_format: Optional[OutputFormat] = None
+
+    # Whether to quantise the output to a palette, useful for flat skins
+    # May be overridden per request with the `quantize` keyword argument
+    quantize: bool = False
+
     # Abstract base class for a drawable Card
 
     def __init__(self, *args, **kwargs):
@@ -40,6 +48,29 @@ class Card:
         self.result = await self.request(*self.args, **self.kwargs)
         return self.result
 
+    @staticmethod
+    async def render_many(*cards: 'Card'):
+        """
+        Render several cards with a single batched request to the rendering server.
+        Sets the result of each card, and returns the results in the given order.
+
+        Note that this bypasses any client-side `request` overrides,
+        so the results are the raw route responses.
+        """
+        if os.name == 'nt':
+            return await asyncio.gather(*(card.render() for card in cards))
+
+        requests = []
+        for card in cards:
+            kwargs = dict(card.kwargs)
+            kwargs.setdefault('locale', ctx_locale.get())
+            requests.append((card.route, card.args, kwargs))
+
+        results = await client.request_many(requests)
+        for card, result in zip(cards, results):
+            card.result = result
+        return results
+
     def as_file(self, filename: str):
         if not self.result:
             raise ValueError("Cannot convert before rendering.")
@@ -76,15 +107,18 @@ class Card:
         """
         locale = kwargs['locale']
         ctx_locale.set(locale)
+        output_format = kwargs.pop('output_format', None) or cls.output_format or default_output_format
+        quantize = kwargs.pop('quantize', cls.quantize)
         with closing(cls.skin(cls.card_id, locale=locale, **kwargs.pop('skin', {}))) as skin:
             # TODO: Consider caching/preloading skins in parent?
             skin.load()
             with closing(cls.layout(skin, *args, **kwargs)) as card:
+                card.output_format = OutputFormat(output_format)
+                card.quantize = quantize
                 response = card._execute_draw()
 
-        del card
-        gc.collect()
-
+        # Memory growth is bounded by the rendering pool worker recycling policy,
+        # rather than forcing a collection after every render.
         return response
 
     @classmethod
@@ -99,6 +133,8 @@ class Card:
     @classmethod
     async def generate_sample(cls, ctx=None, **kwargs):
         sample_kwargs = await cls.sample_args(ctx)
+        # Samples are embedded as `attachment://sample.png`, so always render PNG
+        kwargs.setdefault('output_format', OutputFormat.PNG)
         card = await cls.request(**{**sample_kwargs, **kwargs})
         return image_as_file(card, "sample.png")
 
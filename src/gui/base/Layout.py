@@ -1,10 +1,17 @@
 import logging
-from io import BytesIO
+
+from ..utils import OutputFormat, encode_image
 
 logger = logging.getLogger(__name__)
 
 
 class Layout:
+    # Encoding used for the rendered output, may be set per render by the Card
+    output_format: OutputFormat = OutputFormat.PNG
+
+    # Whether to quantise the rendered output to a palette before encoding
+    quantize: bool = False
+
     def __init__(self, skin, *args, **kwargs):
         self.skin = skin
 
@@ -16,13 +23,9 @@ class Layout:
         # starting = time.time()
         with self.draw() as image:
             # logger.debug(f"Drawing complete after {time.time() - starting} seconds")
-            with BytesIO() as data:
-                image.save(data, format='PNG', compress_type=3, compress_level=1)
-                # logger.debug(f"Saving complete after {time.time() - starting} seconds")
-                data.seek(0)
-                bytes = data.getvalue()
-                # logger.debug(f"Raw rendering took {time.time() - starting} seconds")
-                return bytes
+            bytes = encode_image(image, self.output_format, quantize=self.quantize)
+            # logger.debug(f"Raw rendering took {time.time() - starting} seconds")
+            return bytes
 
     def close(self):
         """
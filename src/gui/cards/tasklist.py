@@ -3,7 +3,7 @@ import pickle
 
 from PIL import Image, ImageDraw
 
-from ..utils import font_height, getsize
+from ..utils import font_height, getsize, encode_image, OutputFormat
 from ..base import Card, Layout, fielded, Skin, FieldDesc
 from ..base.Avatars import avatar_manager
 from ..base.Skin import (
@@ -110,10 +110,7 @@ class TasklistLayout(Layout, MiniProfileLayout):
     def _execute_draw(self):
         image_data = []
         for image in self.draw():
-            with BytesIO() as data:
-                image.save(data, format='PNG')
-                data.seek(0)
-                image_data.append(data.getvalue())
+            image_data.append(encode_image(image, self.output_format, quantize=self.quantize))
         return pickle.dumps(image_data)
 
     def draw(self):
@@ -357,6 +354,7 @@ class TasklistCard(Card):
         from ..utils import image_as_file
 
         sample_kwargs = await cls.sample_args(ctx)
+        kwargs.setdefault('output_format', OutputFormat.PNG)
         cards = await cls.request(**{**sample_kwargs, **kwargs})
         return image_as_file(cards[0], "sample.png")
 
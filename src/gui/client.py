@@ -1,6 +1,8 @@
-from typing import Optional
+from typing import Any, Callable, Optional
 import asyncio
 import pickle
+import bisect
+import hashlib
 import time
 import logging
 import datetime as dt
@@ -22,10 +24,77 @@ logger = logging.getLogger(__name__)
 
 socket_path = conf.gui.get('socket_path')
 
+# Rendering endpoints, either unix socket paths or `tcp://host:port` addresses
+endpoints = conf.gui.getlist('endpoints', None) or [socket_path]
+
+# Endpoint routing strategy, either `least_loaded` or `hash`
+routing = conf.gui.get('routing', 'least_loaded')
+
 
 # TODO: Catch RenderingException from the usual places with a custom error.
 
 
+class RenderEndpoint:
+    """
+    A single rendering server endpoint, with its connection health and load statistics.
+    """
+    # Smoothing factor for the request latency moving average
+    latency_alpha = 0.2
+
+    def __init__(self, address: str, max_concurrent: int):
+        self.address = address
+        if address.startswith('tcp://'):
+            host, _, port = address[len('tcp://'):].rpartition(':')
+            self.tcp = (host, int(port))
+        else:
+            self.tcp = None
+
+        self.total_failures = 0
+        self.failures = 0
+        self.retry_next = None
+
+        self.in_flight = 0
+        self.requests = 0
+        self.latency = None
+
+        # Connection lock ensures only one task is trying to get a new connection at a time
+        self._connection_lock = asyncio.Lock()
+
+        # Limit the number of allowed connections
+        self._connection_sem = asyncio.Semaphore(max_concurrent)
+
+    def __repr__(self):
+        return f"<RenderEndpoint address={self.address!r} in_flight={self.in_flight} failures={self.failures}>"
+
+    @property
+    def healthy(self):
+        return self.retry_next is None or self.retry_next <= utc_now()
+
+    def open_connection(self):
+        if self.tcp is not None:
+            return asyncio.open_connection(*self.tcp)
+        else:
+            return asyncio.open_unix_connection(path=self.address)
+
+    def record_latency(self, duration: float):
+        self.requests += 1
+        if self.latency is None:
+            self.latency = duration
+        else:
+            self.latency += self.latency_alpha * (duration - self.latency)
+
+    def stats(self):
+        return {
+            'address': self.address,
+            'healthy': self.healthy,
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'latency': self.latency,
+            'failures': self.failures,
+            'total_failures': self.total_failures,
+        }
+
+
 class GUIclient:
     retry_base = 2
     retry_delay = 5
@@ -38,86 +107,164 @@ class GUIclient:
     # Avoids clogging the pipeline with waiting (and usually expired) requests
     request_expiry = 30
 
+    # Maximum concurrent connections per endpoint
     max_concurrent = 5
 
-    def __init__(self, socket_path: str):
-        self.socket_path = socket_path
-
-        self.total_failures = 0
-        self.failures = 0
-        self.retry_next = None
-
-        # Connection lock ensures only one task is trying to get a new connection at a time
-        self._connection_lock = asyncio.Lock()
-
-        # Limit the number of allowed connections
-        self._connection_sem = asyncio.Semaphore(self.max_concurrent)
+    # Number of points each endpoint has on the consistent hashing ring
+    ring_replicas = 64
+
+    def __init__(self, *addresses: str, strategy: str = 'least_loaded'):
+        if not addresses:
+            raise ValueError("GUIclient requires at least one rendering endpoint.")
+        if strategy not in ('least_loaded', 'hash'):
+            raise ValueError(f"Unknown rendering endpoint routing strategy {strategy!r}")
+        self.strategy = strategy
+        self.endpoints = [RenderEndpoint(address, self.max_concurrent) for address in addresses]
+
+        # Consistent hashing ring of (point, endpoint index)
+        self._ring = sorted(
+            (self._hash(f"{endpoint.address}#{i}"), n)
+            for n, endpoint in enumerate(self.endpoints)
+            for i in range(self.ring_replicas)
+        )
+        self._ring_points = [point for point, _ in self._ring]
 
         # Internal cache of rendering request tasks
         # This is for easier introspection
         # And an attempt to avoid the task being garbage collected
         self._tasks = {}
 
+        # Latest statistics reported by each rendering worker, keyed by worker name
+        self.worker_stats: dict[str, dict] = {}
+
+        # Callbacks notified with the metrics of every completed or failed request
+        self.render_listeners: list[Callable[[dict], Any]] = []
+
+    @property
+    def total_failures(self):
+        return sum(endpoint.total_failures for endpoint in self.endpoints)
+
     def delay(self, fail_count):
         return min(self.max_delay, self.retry_delay + self.retry_base ** fail_count)
 
-    async def _new_connection(self):
-        async with self._connection_lock:
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    @staticmethod
+    def routing_key(route: str, kwargs: dict) -> str:
+        """
+        Key used for consistent hashing of requests.
+        Requests for the same route and base skin are sent to the same endpoint where possible,
+        keeping the per-skin caches on that endpoint warm.
+        """
+        skin = kwargs.get('skin') or {}
+        return f"{route}:{skin.get('base_skin_id')}"
+
+    def _ring_order(self, key: str) -> list[RenderEndpoint]:
+        """
+        Endpoints in consistent hashing ring order, starting from the given key.
+        """
+        start = bisect.bisect(self._ring_points, self._hash(key))
+        seen = []
+        for i in range(len(self._ring)):
+            _, n = self._ring[(start + i) % len(self._ring)]
+            endpoint = self.endpoints[n]
+            if endpoint not in seen:
+                seen.append(endpoint)
+                if len(seen) == len(self.endpoints):
+                    break
+        return seen
+
+    def choose_endpoint(self, key: str, exclude=()) -> Optional[RenderEndpoint]:
+        """
+        Choose the endpoint to send a request with the given routing key to.
+        Healthy endpoints are preferred, otherwise the endpoint which will next be retried is chosen.
+        Returns `None` if every endpoint has been excluded.
+        """
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+        if not candidates:
+            return None
+        if self.strategy == 'hash':
+            candidates = [endpoint for endpoint in self._ring_order(key) if endpoint not in exclude]
+            healthy = [endpoint for endpoint in candidates if endpoint.healthy]
+            return healthy[0] if healthy else candidates[0]
+        else:
+            healthy = [endpoint for endpoint in candidates if endpoint.healthy]
+            if healthy:
+                return min(healthy, key=lambda endpoint: (endpoint.in_flight, endpoint.latency or 0))
+            else:
+                return min(candidates, key=lambda endpoint: endpoint.retry_next)
+
+    async def _new_connection(self, endpoint: RenderEndpoint, wait=True):
+        """
+        Open a new connection to the given endpoint, backing off between failed attempts.
+
+        If `wait` is not set, a `ConnectionFailure` is raised instead of waiting for a retry,
+        so the caller may fail over to another endpoint.
+        """
+        async with endpoint._connection_lock:
             while True:
                 now = utc_now()
-                if self.retry_next and self.retry_next > now:
-                    await asyncio.sleep((self.retry_next - now).total_seconds())
+                if endpoint.retry_next and endpoint.retry_next > now:
+                    if not wait:
+                        raise ConnectionFailure(f"Rendering endpoint {endpoint.address} is backing off.")
+                    await asyncio.sleep((endpoint.retry_next - now).total_seconds())
                 try:
                     connection = await asyncio.wait_for(
-                        asyncio.open_unix_connection(path=self.socket_path),
+                        endpoint.open_connection(),
                         timeout=self.connection_timeout
                     )
-                    if self.failures > 0:
+                    if endpoint.failures > 0:
                         logger.info(
-                            f"Rendering connection succeeded after {self.failures} failures."
+                            f"Rendering connection to {endpoint.address} succeeded after {endpoint.failures} failures."
                         )
-                    self.failures = 0
-                    self.retry_next = None
+                    endpoint.failures = 0
+                    endpoint.retry_next = None
                     return connection
                 except asyncio.CancelledError:
                     raise
                 except asyncio.TimeoutError:
-                    self.failures += 1
-                    self.total_failures += 1
-                    delay = self.delay(self.failures)
-                    self.retry_next = utc_now() + dt.timedelta(seconds=delay)
+                    endpoint.failures += 1
+                    endpoint.total_failures += 1
+                    delay = self.delay(endpoint.failures)
+                    endpoint.retry_next = utc_now() + dt.timedelta(seconds=delay)
                     logger.warning(
-                        f"Connection to the rendering server timed out! Next retry after {delay} seconds"
+                        f"Connection to the rendering server {endpoint.address} timed out! "
+                        f"Next retry after {delay} seconds"
                     )
-                except (ConnectionRefusedError, ConnectionError, ConnectionResetError):
-                    self.failures += 1
-                    self.total_failures += 1
-                    delay = self.delay(self.failures)
-                    self.retry_next = utc_now() + dt.timedelta(seconds=delay)
+                except (ConnectionRefusedError, ConnectionError, ConnectionResetError, FileNotFoundError):
+                    endpoint.failures += 1
+                    endpoint.total_failures += 1
+                    delay = self.delay(endpoint.failures)
+                    endpoint.retry_next = utc_now() + dt.timedelta(seconds=delay)
                     logger.warning(
-                        f"Connection to the rendering server failed! Next retry after {delay} seconds",
+                        f"Connection to the rendering server {endpoint.address} failed! "
+                        f"Next retry after {delay} seconds",
                         exc_info=True,
                     )
                 except Exception:
-                    self.failures += 1
-                    self.total_failures += 1
-                    delay = self.delay(self.failures)
-                    self.retry_next = utc_now() + dt.timedelta(seconds=delay)
+                    endpoint.failures += 1
+                    endpoint.total_failures += 1
+                    delay = self.delay(endpoint.failures)
+                    endpoint.retry_next = utc_now() + dt.timedelta(seconds=delay)
                     logger.exception(
-                        "Unexpected exception encountered connecting to the rendering server! "
+                        f"Unexpected exception encountered connecting to the rendering server {endpoint.address}! "
                         f"Skipping connection, setting retry to {delay} seconds.",
                         exc_info=True,
                     )
                     raise
+                if not wait:
+                    raise ConnectionFailure(f"Could not connect to rendering endpoint {endpoint.address}.")
 
     @asynccontextmanager
-    async def connection(self):
+    async def connection(self, endpoint: RenderEndpoint, wait=True):
         set_logging_context(action="GUI connect")
-        if self._connection_sem.locked():
-            logger.debug("GUI render request pool full. Queuing request.")
-        async with self._connection_sem:
+        if endpoint._connection_sem.locked():
+            logger.debug(f"GUI render request pool for {endpoint.address} full. Queuing request.")
+        async with endpoint._connection_sem:
             logger.debug("Acquired connection semaphore, requesting connection.")
-            connection = await self._new_connection()
+            connection = await self._new_connection(endpoint, wait=wait)
             logger.debug("Acquired connection.")
 
             try:
@@ -129,57 +276,133 @@ class GUIclient:
                     writer.close()
                     await writer.wait_closed()
 
+    def stats(self):
+        return {
+            'strategy': self.strategy,
+            'endpoints': [endpoint.stats() for endpoint in self.endpoints],
+        }
+
     @with_log_ctx(action="Render")
     async def request(self, route: str, timeout: Optional[float]=None, **kwargs):
         reqid = short_uuid()
         timeout = timeout or self.request_expiry
+        metrics = {'route': route, 'kwargs': kwargs.get('kwargs', {})}
+        start = time.time()
         task = asyncio.create_task(
-            self._request(route, reqid=reqid, **kwargs),
+            self._request(route, reqid=reqid, metrics=metrics, **kwargs),
             name=f"Render {reqid}"
         )
         self._tasks[reqid] = task
         task.add_done_callback(lambda fut: self._tasks.pop(reqid, None))
         try:
             return await asyncio.wait_for(task, timeout=timeout)
-        except RenderingException:
+        except RenderingException as e:
+            if isinstance(e, ConnectionFailure):
+                metrics['status'] = 'CONNECTION_FAILURE'
+            metrics.setdefault('error', repr(e))
             raise
         except asyncio.CancelledError:
+            metrics['status'] = 'CANCELLED'
             logger.debug(
                 f"Rendering req '{reqid}' received cancel signal."
             )
             raise
         except asyncio.TimeoutError:
+            metrics['status'] = 'TIMED_OUT'
             logger.warning(f"GUI rendering request '{reqid}' timed out.")
             raise ConnectionTimedOut(f"Request {reqid} timed out.")
-        except (ConnectionError, ConnectionRefusedError, ConnectionResetError):
+        except (ConnectionError, ConnectionRefusedError, ConnectionResetError) as e:
+            metrics['status'] = 'CONNECTION_FAILURE'
+            metrics['error'] = repr(e)
             logger.warning(f"GUI rendering pipe broke for request '{reqid}'.", exc_info=True)
             raise ConnectionFailure
-        except Exception:
+        except Exception as e:
+            metrics['status'] = 'SYSTEM_ERROR'
+            metrics['error'] = repr(e)
             logger.exception(
                 f"Unhandled exception while rendering request '{reqid}' on route `{route}` "
                 f"with kwargs: {kwargs}"
             )
             raise
-
-    async def _request(self, route, args=(), reqid: Optional[str] = None, kwargs={}):
+        finally:
+            metrics['duration'] = time.time() - start
+            if route == 'batch':
+                self._notify_batch(metrics)
+            else:
+                self._notify_render(metrics)
+
+    def _notify_render(self, metrics: dict):
+        for listener in self.render_listeners:
+            try:
+                listener(metrics)
+            except Exception:
+                logger.exception(
+                    f"Unhandled exception in render listener {listener!r}. Ignoring."
+                )
+
+    def _notify_batch(self, metrics: dict):
+        """
+        Notify the render listeners of each request in a batched render,
+        with its own route and arguments, and its own result when the batch completed.
+        """
+        requests = metrics['kwargs'].get('requests', ())
+        items = metrics.pop('items', None)
+        if items is None or len(items) != len(requests):
+            items = [{}] * len(requests)
+        for (route, _, kwargs), item in zip(requests, items):
+            self._notify_render({**metrics, 'route': route, 'kwargs': kwargs, **item})
+
+    async def request_many(self, requests: list[tuple[str, tuple, dict]], timeout: Optional[float] = None):
+        """
+        Render several route requests in a single batched request.
+
+        Each request is a `(route, args, kwargs)` tuple.
+        Returns the rendered data for each request, in the given order.
+        Raises `RenderingFailure` if any of the requests failed to render.
+        """
+        results = await self.request(
+            'batch',
+            timeout=timeout,
+            kwargs={'requests': list(requests)}
+        )
+        if len(results) != len(requests):
+            logger.error(f"Rendering server sent a malformed batch response: {results}")
+            raise RenderingFailure("Malformed batch render response.")
+
+        rendered = []
+        for (route, _, _), (data, error, _) in zip(requests, results):
+            if error is not None:
+                logger.error(
+                    f"Batched rendering failed on route {route!r}! Error: {error}"
+                )
+                raise RenderingFailure(f"Batched render of route {route!r} failed with {error}")
+            rendered.append(data)
+        return rendered
+
+    async def _request(self, route, args=(), reqid: Optional[str] = None, kwargs={}, metrics: Optional[dict] = None):
         set_logging_context(action=route)
         logger.debug(
             f"Sending rendering request '{reqid}' to route {route!r} with args {args!r} and kwargs {kwargs!r}"
         )
-        async with self.connection() as connection:
-            render_start = time.time()
-            reader, writer = connection
-
-            packet = (route, args, kwargs)
-            encoded = pickle.dumps(packet)
-
-            writer.write(encoded)
-            writer.write_eof()
-
-            data = await reader.read(-1)
-            result = pickle.loads(data)
-
-            render_end = time.time()
+        key = self.routing_key(route, kwargs)
+        tried = []
+        while True:
+            endpoint = self.choose_endpoint(key, exclude=tried)
+            tried.append(endpoint)
+            # Only wait out the backoff on the last available endpoint
+            last_resort = len(tried) == len(self.endpoints)
+            try:
+                result, duration = await self._request_from(endpoint, route, args, kwargs, wait=last_resort)
+                if metrics is not None:
+                    metrics.update(self._response_metrics(result))
+                break
+            except (ConnectionFailure, ConnectionError, ConnectionRefusedError, ConnectionResetError):
+                if last_resort:
+                    raise
+                logger.warning(
+                    f"Rendering request '{reqid}' failed on endpoint {endpoint.address}, failing over.",
+                    exc_info=True
+                )
 
         if not result or not result['rqid']:
             logger.error(f"Rendering server sent a malformed response: {result}")
@@ -191,11 +414,78 @@ class GUIclient:
             raise RenderingFailure(f"Rendering server returned {result}")
         else:
             image_data = result.pop('data')
+            if (worker := result.get('worker')):
+                self.worker_stats[worker['name']] = worker
             logger.debug(
-                f"Rendering completed in {render_end-render_start:.6f} seconds. Response: {result}"
+                f"Rendering completed on {endpoint.address} in {duration:.6f} seconds. Response: {result}"
             )
             return image_data
 
+    @staticmethod
+    def _response_metrics(result: dict) -> dict:
+        """
+        Extract the render metrics from a rendering server response.
+        """
+        if not result:
+            return {'status': 'SYSTEM_ERROR'}
+        try:
+            status = RequestState(result.get('state')).name
+        except ValueError:
+            status = 'SYSTEM_ERROR'
+
+        metrics = {
+            'status': status,
+            'error': result.get('error'),
+            'queue_wait': result.get('queue_wait'),
+            'render_time': result.get('render_time', result.get('duration')),
+            'cache_hit': result.get('cache_hit', False),
+        }
+
+        data = result.get('data') or b''
+        if isinstance(data, (bytes, bytearray)):
+            metrics['output_bytes'] = len(data)
+        else:
+            # Batched response, list of (data, error, render_time) triples
+            metrics['output_bytes'] = sum(len(item) for item, _, _ in data if item)
+            metrics['items'] = [
+                {
+                    'status': 'SUCCESS' if error is None else 'RENDER_ERROR',
+                    'error': error,
+                    'render_time': render_time,
+                    'output_bytes': len(item) if item else 0,
+                }
+                for item, error, render_time in data
+            ]
+        return metrics
+
+    async def _request_from(self, endpoint: RenderEndpoint, route, args, kwargs, wait=True):
+        """
+        Send a single rendering request to the given endpoint.
+        Returns the decoded response and the request duration.
+        """
+        endpoint.in_flight += 1
+        try:
+            async with self.connection(endpoint, wait=wait) as connection:
+                render_start = time.time()
+                reader, writer = connection
+
+                packet = (route, args, kwargs)
+                encoded = pickle.dumps(packet)
+
+                writer.write(encoded)
+                writer.write_eof()
+
+                data = await reader.read(-1)
+                result = pickle.loads(data)
+
+                render_end = time.time()
+        finally:
+            endpoint.in_flight -= 1
+
+        duration = render_end - render_start
+        endpoint.record_latency(duration)
+        return result, duration
+
 
 async def wait_until(aws, expiry: dt.datetime):
     now = utc_now()
@@ -203,7 +493,7 @@ async def wait_until(aws, expiry: dt.datetime):
     return await asyncio.wait_for(aws, timeout)
 
 
-client = GUIclient(socket_path)
+client = GUIclient(*endpoints, strategy=routing)
 
 # Exposed for backwards compatibility
 request = client.request
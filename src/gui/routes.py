@@ -1,6 +1,10 @@
 import logging
+import time
+
 from . import cards
 
+logger = logging.getLogger(__name__)
+
 routes = {}  # request name -> callable
 
 
@@ -16,6 +20,77 @@ async def ping(runner, args, kwargs):
     logging.info("Ping-Pong!")
     return b"Pong"
 
+def _execute_batch(jobs):
+    """
+    Execute a list of collected `(method, args, kwargs)` jobs sequentially.
+    Runs inside a single worker, so per-process caches (e.g. fonts) are shared between the jobs.
+    Returns a list of `(data, error, render_time)` triples in job order.
+    """
+    results = []
+    for method, args, kwargs in jobs:
+        start = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+            error = None
+        except Exception as e:
+            logger.exception(
+                "Unhandled exception occurred while executing batched route.",
+                exc_info=True,
+                stack_info=True
+            )
+            result = b''
+            error = repr(e)
+        results.append((result, error, time.perf_counter() - start))
+    return results
+
+
+@register_route('batch')
+async def batch(runner, args, kwargs):
+    """
+    Render several route requests in a single executor task.
+
+    Expects `kwargs['requests']` to be a list of `(route, args, kwargs)` tuples.
+    Each route is run with a collecting runner, so any async preprocessing (e.g. avatar fetching)
+    happens as usual, but the synchronous rendering is deferred and executed in one job.
+    Returns a list of `(data, error, render_time)` triples, in request order,
+    where `render_time` is None for requests which did not produce a render job.
+    """
+    requests = kwargs['requests']
+    jobs = []
+    job_map = {}
+    results = [None] * len(requests)
+
+    for i, (route, rargs, rkwargs) in enumerate(requests):
+        if route not in routes or route == 'batch':
+            results[i] = (b'', f"Unknown batch route {route!r}", None)
+            continue
+
+        async def collector(method, margs, mkwargs, i=i):
+            job_map[len(jobs)] = i
+            jobs.append((method, margs, mkwargs))
+
+        try:
+            await routes[route](collector, rargs, rkwargs)
+        except Exception as e:
+            logger.exception(
+                f"Unhandled exception while preparing batched route {route!r}."
+            )
+            results[i] = (b'', repr(e), None)
+
+    if jobs:
+        job_results, error = await runner(_execute_batch, (jobs,), {})
+        if error is not None:
+            return [], error
+        for j, job_result in enumerate(job_results):
+            results[job_map[j]] = job_result
+
+    for i, result in enumerate(results):
+        if result is None:
+            results[i] = (b'', "Route did not produce a render job.", None)
+
+    return results, None
+
+
 active_cards = [
     cards.StatsCard,
     cards.ProfileCard,
@@ -4,7 +4,6 @@ import pickle
 import logging
 import multiprocessing
 from contextvars import ContextVar, copy_context
-from concurrent.futures import ProcessPoolExecutor
 
 from meta.logger import log_app, logging_context, log_context, log_action_stack, setup_main_logger, make_queue_handler, set_logging_context
 from meta.config import conf
@@ -12,8 +11,13 @@ from babel.translator import LeoBabel, ctx_translator
 
 from ..routes import routes
 from ..utils import RequestState, short_uuid
+from .pool import WorkerPool
 
 requestid = ContextVar('requestid', default=None)
+# Statistics of the last worker which served a render in this request
+workerstats = ContextVar('workerstats', default=None)
+# Worker timing of the last render in this request
+rendertiming = ContextVar('rendertiming', default=None)
 logger = logging.getLogger(__name__)
 
 for name in conf.config.options('LOGGING_LEVELS', no_defaults=True):
@@ -28,9 +32,16 @@ log_app.set("GUI_SERVER")
 
 # TODO: General error handling, logging, and return paths for exceptions/null data
 PATH = conf.gui.get('socket_path')
+# Optional `host:port` to additionally serve rendering requests over TCP
+TCP_ADDRESS = conf.gui.get('tcp_address', None)
 MAX_PROC = conf.gui.getint('process_count')
 
-executor: ProcessPoolExecutor = None
+# Worker recycling policy
+MAX_RENDERS = conf.gui.getint('worker_max_renders', 500)
+MAX_RSS = conf.gui.getint('worker_max_rss_mb', 1024) * 2**20
+SPARES = conf.gui.getint('worker_spares', 1)
+
+pool: WorkerPool = None
 
 
 async def handle_request(reader, writer):
@@ -68,7 +79,9 @@ async def handle_request(reader, writer):
             'data': data,
             'length': len(data),
             'error': error,
-            'duration': dur
+            'duration': dur,
+            'worker': workerstats.get(),
+            **(rendertiming.get() or {}),
         }
         logger.debug(
             f"Request complete with status {state.name} in {dur:.6f} seconds."
@@ -114,18 +127,20 @@ def _execute(ctx, method, args, kwargs):
 
 async def runner(method, args, kwargs):
     """
-    Run the provided method in the executor.
+    Run the provided method in the worker pool.
     Abstracts the executor implementation away from specific routes.
     Also allows transparently sending variables into the execution context (e.g. rqid).
     """
-    return await asyncio.get_event_loop().run_in_executor(
-        executor,
+    result, stats, timing = await pool.run(
         _execute,
         (requestid.get(), log_context.get(), log_action_stack.get()),
         method,
         args,
         kwargs
     )
+    workerstats.set(stats)
+    rendertiming.set(timing)
+    return result
 
 
 def worker_configurer():
@@ -146,25 +161,36 @@ async def main():
     # threading.Thread(target=logger_thread, args=(logging_queue,)).start()
     logger.debug("Test")
 
-    global executor
+    global pool
     log_app.set("GUI_SERVER")
     translator = LeoBabel()
     translator._load()
     ctx_translator.set(translator)
 
     with logging_context(action='SPAWN'):
-        executor = ProcessPoolExecutor(MAX_PROC, initializer=worker_configurer)
-        executor.submit(worker_configurer)
-        # for i in range(MAX_PROC):
-        #     executor.submit(worker_configurer)
+        pool = WorkerPool(
+            MAX_PROC,
+            initializer=worker_configurer,
+            max_renders=MAX_RENDERS,
+            max_rss=MAX_RSS,
+            spares=SPARES,
+        )
+        pool.start()
 
     with logging_context(stack=["SERV"]):
-        server = await asyncio.start_unix_server(handle_request, PATH)
-        addrs = ', '.join(str(sock.getsockname()) for sock in server.sockets)
+        servers = [await asyncio.start_unix_server(handle_request, PATH)]
+        if TCP_ADDRESS:
+            host, _, port = TCP_ADDRESS.rpartition(':')
+            servers.append(await asyncio.start_server(handle_request, host, int(port)))
+        addrs = ', '.join(str(sock.getsockname()) for server in servers for sock in server.sockets)
         logger.info(f'Serving on socket: {addrs}')
 
-        async with server:
-            await server.serve_forever()
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        finally:
+            for server in servers:
+                server.close()
+            pool.shutdown()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,228 @@
+"""
+Rendering worker pool with worker recycling.
+
+Each worker process is wrapped in its own single-process executor (a "slot"),
+so that individual workers may be retired and replaced without disturbing the others.
+Workers are recycled after serving a configured number of renders,
+or when their resident memory grows above a configured threshold.
+Replacement workers are pre-spawned, so recycling does not add latency to requests.
+"""
+from typing import Optional
+import os
+import time
+import asyncio
+import logging
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import psutil
+
+from ..utils import encoding_stats, font_cache_misses
+
+logger = logging.getLogger(__name__)
+
+
+# Worker-side state
+_started_at: Optional[float] = None
+_served: int = 0
+
+
+def _worker_init(initializer):
+    global _started_at
+    _started_at = time.time()
+    if initializer is not None:
+        initializer()
+
+
+def _warmup():
+    return os.getpid()
+
+
+def _pool_call(fn, args, submitted):
+    """
+    Execute the given function inside a worker,
+    returning the result along with the current worker statistics and the call timing.
+    """
+    global _served
+    started = time.time()
+    misses = font_cache_misses()
+    result = fn(*args)
+    _served += 1
+    timing = {
+        'queue_wait': started - submitted,
+        'render_time': time.time() - started,
+        'cache_hit': font_cache_misses() == misses,
+    }
+    return result, worker_stats(), timing
+
+
+def worker_stats() -> dict:
+    """
+    Statistics for the current worker process.
+    """
+    return {
+        'pid': os.getpid(),
+        'name': multiprocessing.current_process().name,
+        'renders': _served,
+        'rss': psutil.Process().memory_info().rss,
+        'uptime': time.time() - (_started_at or time.time()),
+        'encoding': dict(encoding_stats),
+    }
+
+
+class WorkerSlot:
+    """
+    A single rendering worker process, wrapped in its own executor.
+    """
+    _counter = itertools.count()
+
+    def __init__(self, initializer=None):
+        self.slotid = next(self._counter)
+        self.executor = ProcessPoolExecutor(1, initializer=_worker_init, initargs=(initializer,))
+        self.created_at = time.time()
+
+        self.in_flight = 0
+        self.retiring = False
+        self.stats = {}
+
+        # Submitting a job forces the worker process to spawn immediately
+        self.ready = self.executor.submit(_warmup)
+
+    def __repr__(self):
+        return (
+            f"<WorkerSlot slotid={self.slotid} in_flight={self.in_flight} "
+            f"retiring={self.retiring} stats={self.stats}>"
+        )
+
+    def retire(self):
+        """
+        Stop accepting new work.
+        Pending work on the worker is still completed before it exits.
+        """
+        self.retiring = True
+        self.executor.shutdown(wait=False)
+
+
+class WorkerPool:
+    """
+    Pool of rendering worker slots with recycling and warm spares.
+
+    Parameters
+    ----------
+    size: int
+        Number of active workers.
+    initializer: Callable
+        Run in each worker process on spawn.
+    max_renders: int
+        Recycle a worker after it has served this many renders. `0` disables.
+    max_rss: int
+        Recycle a worker after its resident memory exceeds this many bytes. `0` disables.
+    spares: int
+        Number of pre-spawned workers kept ready to replace recycled workers.
+    """
+    def __init__(self, size, initializer=None, max_renders=0, max_rss=0, spares=1):
+        self.size = size
+        self.initializer = initializer
+        self.max_renders = max_renders
+        self.max_rss = max_rss
+        self.spare_count = spares
+
+        self.active: list[WorkerSlot] = []
+        self.spares: list[WorkerSlot] = []
+
+        self.recycled = 0
+
+    def start(self):
+        for _ in range(self.size):
+            self.active.append(WorkerSlot(self.initializer))
+        self._fill_spares()
+        logger.info(
+            f"Started rendering pool with {self.size} workers and {self.spare_count} spares. "
+            f"Recycling after {self.max_renders or 'unlimited'} renders "
+            f"or {(self.max_rss // 2**20) if self.max_rss else 'unlimited'} MB RSS."
+        )
+
+    def shutdown(self):
+        for slot in (*self.active, *self.spares):
+            slot.retire()
+        self.active.clear()
+        self.spares.clear()
+
+    def _fill_spares(self):
+        while len(self.spares) < self.spare_count:
+            self.spares.append(WorkerSlot(self.initializer))
+
+    def _choose(self) -> WorkerSlot:
+        return min(self.active, key=lambda slot: slot.in_flight)
+
+    def _should_recycle(self, stats) -> bool:
+        if self.max_renders and stats['renders'] >= self.max_renders:
+            return True
+        if self.max_rss and stats['rss'] >= self.max_rss:
+            return True
+        return False
+
+    def _recycle(self, slot: WorkerSlot, reason: Optional[str] = None) -> Optional[WorkerSlot]:
+        """
+        Replace the given active slot with a spare, and retire it.
+        Returns the replacement, or None if the slot was already replaced.
+        """
+        if slot.retiring or slot not in self.active:
+            return None
+        if self.spares:
+            replacement = self.spares.pop(0)
+        else:
+            replacement = WorkerSlot(self.initializer)
+        self.active[self.active.index(slot)] = replacement
+        slot.retire()
+        self.recycled += 1
+        if reason is None:
+            reason = (
+                f"after {slot.stats.get('renders')} renders "
+                f"with RSS {slot.stats.get('rss', 0) // 2**20} MB"
+            )
+        logger.info(f"Recycling rendering worker {slot.stats.get('name')} {reason}.")
+        self._fill_spares()
+        return replacement
+
+    async def run(self, fn, *args):
+        """
+        Run `fn(*args)` on the least loaded active worker.
+
+        If the worker process has died, it is replaced and the call is retried once on the replacement.
+
+        Returns a tuple `(result, stats, timing)`,
+        where `stats` are the worker statistics after the call,
+        and `timing` describes the time spent waiting for the worker and executing the call.
+        """
+        slot = self._choose()
+        try:
+            return await self._run_on(slot, fn, args)
+        except BrokenProcessPool:
+            replacement = self._recycle(slot, reason="after its process died") or self._choose()
+            return await self._run_on(replacement, fn, args)
+
+    async def _run_on(self, slot: WorkerSlot, fn, args):
+        slot.in_flight += 1
+        try:
+            result, stats, timing = await asyncio.get_event_loop().run_in_executor(
+                slot.executor, _pool_call, fn, args, time.time()
+            )
+        finally:
+            slot.in_flight -= 1
+
+        slot.stats = stats
+        if self._should_recycle(stats):
+            self._recycle(slot)
+        return result, stats, timing
+
+    def summary(self) -> dict:
+        return {
+            'recycled': self.recycled,
+            'spares': len(self.spares),
+            'workers': [
+                {**slot.stats, 'in_flight': slot.in_flight} for slot in self.active
+            ],
+        }
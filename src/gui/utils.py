@@ -1,12 +1,13 @@
 import io
 import os
 import discord
-from enum import IntEnum
+from enum import IntEnum, StrEnum
 import logging
 import string
 import random
+from functools import lru_cache
 
-from PIL import ImageFont
+from PIL import Image, ImageFont
 
 from meta import conf
 
@@ -20,6 +21,37 @@ class RequestState(IntEnum):
     RENDER_ERROR = 3
 
 
+class OutputFormat(StrEnum):
+    """
+    Output encodings available for rendered cards.
+
+    AUTO encodes with every acceptable format and keeps the smallest.
+    """
+    PNG = 'png'
+    WEBP = 'webp'
+    JPEG = 'jpeg'
+    AUTO = 'auto'
+
+
+# File extensions for each concrete output format
+format_extensions = {
+    OutputFormat.PNG: '.png',
+    OutputFormat.WEBP: '.webp',
+    OutputFormat.JPEG: '.jpg',
+}
+
+# Default output format for cards which do not specify one
+default_output_format = OutputFormat(conf.gui.get('output_format', 'png'))
+
+# Per-process encoding statistics, reported with the rendering worker statistics
+encoding_stats = {
+    'encoded': 0,
+    'bytes': 0,
+    # Bytes saved compared to the PNG candidate, only counted in AUTO mode where it is already encoded
+    'bytes_saved': 0,
+}
+
+
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 __skins_location__ = 'skins'
 
@@ -53,14 +85,34 @@ def inter_font(name, **kwargs):
     return get_font('Inter', name, **kwargs)
 
 
-def get_font(family, name, **kwargs):
+@lru_cache(maxsize=256)
+def _load_font(path, size):
     return ImageFont.truetype(
-        asset_path(f"fonts/{family}/{family}-{name}.ttf"),
+        path,
+        size=size,
         # layout_engine=ImageFont.Layout.BASIC,
-        **kwargs
     )
 
 
+def font_cache_misses() -> int:
+    """
+    Number of fonts loaded from disk by this process.
+    """
+    return _load_font.cache_info().misses
+
+
+def get_font(family, name, size=10, **kwargs):
+    """
+    Load the requested font.
+    Fonts without extra options are cached per process, so they may be shared between renders.
+    """
+    path = asset_path(f"fonts/{family}/{family}-{name}.ttf")
+    if kwargs:
+        return ImageFont.truetype(path, size=size, **kwargs)
+    else:
+        return _load_font(path, size)
+
+
 def font_height(font: ImageFont):
     ascent, descent = font.getmetrics()
     return ascent + descent
@@ -74,7 +126,83 @@ def getsize(font: ImageFont, text: str, drawing=True):
         return (right - left, bottom - top)
 
 
+def _is_opaque(image: Image.Image) -> bool:
+    if image.mode in ('RGB', 'L', 'P') and 'transparency' not in image.info:
+        return True
+    if image.mode in ('RGBA', 'LA'):
+        low, _ = image.getchannel('A').getextrema()
+        return low == 255
+    return False
+
+
+def _encode(image: Image.Image, format: OutputFormat) -> bytes:
+    with io.BytesIO() as data:
+        if format is OutputFormat.PNG:
+            image.save(data, format='PNG', compress_type=3, compress_level=1)
+        elif format is OutputFormat.WEBP:
+            image.save(data, format='WEBP', lossless=True, quality=50, method=2)
+        elif format is OutputFormat.JPEG:
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            image.save(data, format='JPEG', quality=92, subsampling=0, optimize=True)
+        else:
+            raise ValueError(f"Cannot encode image with format {format!r}")
+        return data.getvalue()
+
+
+def encode_image(image: Image.Image, format=OutputFormat.PNG, quantize=False) -> bytes:
+    """
+    Encode a rendered image into the requested output format.
+
+    If `quantize` is set, the image is first reduced to a 256 colour palette,
+    which is usually lossless enough for flat skins and much smaller.
+    JPEG is only used for opaque images, otherwise PNG is used instead.
+    In AUTO mode, every acceptable format is tried and the smallest result is returned.
+    """
+    format = OutputFormat(format)
+    png = None
+    if quantize:
+        method = Image.Quantize.FASTOCTREE if image.mode == 'RGBA' else Image.Quantize.MEDIANCUT
+        image = image.quantize(256, method=method)
+
+    if format is OutputFormat.AUTO:
+        candidates = [OutputFormat.PNG, OutputFormat.WEBP]
+        if not quantize and _is_opaque(image):
+            candidates.append(OutputFormat.JPEG)
+        results = [_encode(image, candidate) for candidate in candidates]
+        png = results[0]
+        result = min(results, key=len)
+    else:
+        if format is OutputFormat.JPEG and not _is_opaque(image):
+            format = OutputFormat.PNG
+        result = _encode(image, format)
+
+    encoding_stats['encoded'] += 1
+    encoding_stats['bytes'] += len(result)
+    if png is not None:
+        encoding_stats['bytes_saved'] += len(png) - len(result)
+    return result
+
+
+def image_format(data: bytes) -> OutputFormat:
+    """
+    Detect the output format of encoded image data.
+    """
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return OutputFormat.WEBP
+    elif data[:3] == b'\xff\xd8\xff':
+        return OutputFormat.JPEG
+    else:
+        return OutputFormat.PNG
+
+
 def image_as_file(image, name):
+    """
+    Wrap the given encoded image data in a `discord.File`,
+    setting the filename extension to match the image format.
+    """
+    root, _ = os.path.splitext(name)
+    name = root + format_extensions[image_format(image)]
     with io.BytesIO(image) as image_data:
         image_data.seek(0)
         return discord.File(image_data, filename=name)
@@ -18,6 +18,7 @@ from babel.translator import ctx_locale, LeoBabel
 from .config import Conf
 from .logger import logging_context, log_context, log_action_stack, log_wrap, set_logging_context
 from .context import context
+from .ipc import pickle_codec
 from .LionContext import LionContext
 from .LionTree import LionTree
 from .errors import HandledException, SafeCancellation
@@ -75,7 +76,7 @@ class LionBot(Bot):
         self._locks = WeakValueDictionary()
         self._running_events = set()
 
-        self._talk_global_dispatch = app_ipc.register_route('dispatch')(self._handle_global_dispatch)
+        self._talk_global_dispatch = app_ipc.register_route('dispatch', codec=pickle_codec)(self._handle_global_dispatch)
 
     @property
     def core(self):
@@ -12,6 +12,7 @@ shardname: str
 from . import sharding, conf
 from .logger import log_app
 from .ipc.client import AppClient
+from .ipc.codec import SchemaCodec
 from .args import args
 
 
@@ -39,8 +40,10 @@ shard_talk = AppClient(
     {'host': args.host, 'port': args.port},
     {'host': conf.appipc['server_host'], 'port': int(conf.appipc['server_port'])}
 )
+# Subscriptions are sent to the registry server when we connect
+shard_talk.subscriptions.add(sharding.shard_topic(sharding.shard_number))
 
 
-@shard_talk.register_route()
+@shard_talk.register_route(codec=SchemaCodec(result=str))
 async def ping():
     return "Pong!"
@@ -1,2 +1,3 @@
 from .client import AppClient, AppPayload, AppRoute
 from .server import AppServer
+from .codec import Codec, CodecError, PickleCodec, SchemaCodec, pickle_codec
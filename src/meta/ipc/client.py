@@ -2,8 +2,11 @@ from typing import Optional, TypeAlias, Any
 import asyncio
 import logging
 import pickle
+import time
 
 from ..logger import logging_context, log_wrap, set_logging_context
+from .connection import PeerConnection, FrameNotSent
+from .codec import Codec, SchemaCodec, pickle_codec, encode_message, decode_envelope
 
 
 logger = logging.getLogger(__name__)
@@ -27,17 +30,50 @@ class AppClient:
         self._server = None  # Connection to the registry server
         self._keepalive = None
 
-        self.register_route('new_peer')(self.new_peer)
-        self.register_route('drop_peer')(self.drop_peer)
-        self.register_route('peer_list')(self.peer_list)
+        # Long-lived outgoing connections to our peers
+        self._connections: dict[str, PeerConnection] = {}  # appid -> connection
+        self._connection_locks: dict[str, asyncio.Lock] = {}
+        # Incoming connections from our peers
+        self._incoming: set[PeerConnection] = set()
+        # Held connection to the registry server, used to update our subscriptions
+        self._registry: Optional[PeerConnection] = None
+
+        # Topics this client is subscribed to
+        self.subscriptions: set[str] = set()
+        # Subscribers for each topic, as known by the registry server
+        self.topics: dict[str, set[str]] = {}  # topic -> appids
+        # Per-topic publish and delivery statistics
+        self.topic_stats: dict[str, TopicStats] = {}
+
+        # Messages sent by the registry server along the held registry connection
+        # These are pickled, so are not registered as routes, and never accepted from peers
+        self.registry_routes = {
+            'new_peer': self.new_peer,
+            'drop_peer': self.drop_peer,
+            'peer_list': self.peer_list,
+            'topic_map': self.topic_map,
+        }
+        self._talk_publication = self.register_route(
+            'publication', codec=SchemaCodec(str, float, bytes, result=bytes)
+        )(self._handle_publication)
 
     @property
     def my_peers(self):
         return {peerid: peer for peerid, peer in self.peers.items() if peerid.startswith(self.basename)}
 
-    def register_route(self, name=None):
+    def register_route(self, name=None, codec: Optional[Codec] = None):
+        """
+        Decorator registering the wrapped coroutine as a route.
+
+        The `codec` describes how route arguments and results are sent.
+        Routes must provide a codec, and should prefer a `SchemaCodec`,
+        opting in to `pickle_codec` only when they need to send arbitrary objects.
+        """
+        if codec is None:
+            raise ValueError(f"Route '{name}' must provide a codec.")
+
         def wrapper(coro):
-            route = AppRoute(coro, client=self, name=name)
+            route = AppRoute(coro, codec, client=self, name=name)
             self.routes[route.name] = route
             return route
         return wrapper
@@ -47,7 +83,10 @@ class AppClient:
         try:
             reader, writer = await asyncio.open_connection(**self.server_address)
 
-            payload = ('connect', (), {'appid': self.appid, 'address': self.address})
+            payload = (
+                'connect', (),
+                {'appid': self.appid, 'address': self.address, 'topics': list(self.subscriptions)}
+            )
             writer.write(pickle.dumps(payload))
             writer.write(b'\n')
             await writer.drain()
@@ -74,17 +113,40 @@ class AppClient:
         with logging_context(action='Keepalive'):
             if self._server is None:
                 raise ValueError("Cannot keepalive non-existent server!")
-            reader, write = self._server
+            reader, writer = self._server
+            # The registry server sends us messages as frames on the held connection
+            connection = PeerConnection(reader, writer, handler=self._handle_registry, name='registry').start()
+            self._registry = connection
             try:
-                await reader.read()
+                await connection.wait_closed()
             except Exception:
                 logger.exception("Lost connection to address server. Reconnecting...")
             else:
                 # Connection ended or broke
                 logger.info("Lost connection to address server. Reconnecting...")
+            finally:
+                self._registry = None
         await asyncio.sleep(30)
         asyncio.create_task(self.server_connection())
 
+    async def _handle_registry(self, data: bytes) -> bytes:
+        """
+        Handle a single message sent by the registry server along the registry connection.
+        """
+        tag, route, body = decode_envelope(data)
+
+        set_logging_context(action=route)
+
+        if tag != pickle_codec.tag or route not in self.registry_routes:
+            logger.warning(f"Appclient '{self.appid}' recieved unknown registry message {route}. Ignoring.")
+        else:
+            try:
+                args, kwargs = pickle_codec.decode_request(body)
+                await self.registry_routes[route](*args, **kwargs)
+            except Exception:
+                logger.exception(f"Exception handling registry message '{route}'.")
+        return b''
+
     async def new_peer(self, appid, address):
         self.peers[appid] = address
 
@@ -93,35 +155,130 @@ class AppClient:
 
     async def drop_peer(self, appid):
         self.peers.pop(appid, None)
+        if (connection := self._connections.pop(appid, None)) is not None:
+            await connection.close()
+
+    async def topic_map(self, topics):
+        self.topics = {topic: set(appids) for topic, appids in topics.items()}
+
+    async def subscribe(self, *topics: str):
+        """
+        Subscribe to the given topics.
+        Subscriptions made before connecting are sent to the registry server when we connect.
+        """
+        self.subscriptions.update(topics)
+        await self._send_registry('subscribe', topics)
+
+    async def unsubscribe(self, *topics: str):
+        self.subscriptions.difference_update(topics)
+        await self._send_registry('unsubscribe', topics)
+
+    async def _send_registry(self, route, topics):
+        if self._registry is not None and not self._registry.closed:
+            message = encode_message(route, pickle_codec, (list(topics),), {})
+            await self._registry.request(message, wait_for_reply=False)
+
+    def subscribers(self, topic: str) -> set[str]:
+        """
+        Current subscribers to the given topic.
+        """
+        return {appid for appid in self.topics.get(topic, ()) if appid in self.peers}
+
+    @log_wrap(action="Publish")
+    async def publish(self, topic: str, payload: 'AppPayload', wait_for_reply=False):
+        """
+        Send the given payload to every subscriber of `topic`.
+        Returns a map of subscriber appid -> result, if `wait_for_reply` is set.
+        """
+        set_logging_context(action=topic)
+        stats = self.topic_stats.setdefault(topic, TopicStats())
+        subscribers = self.subscribers(topic)
+        stats.published += 1
+        if not subscribers:
+            stats.unrouted += 1
+            logger.debug(f"No subscribers to topic '{topic}', discarding payload {payload}.")
+            return {}
+
+        publication = self._talk_publication(topic, time.time(), payload.encoded())
+        results = await asyncio.gather(
+            *(self.request(appid, publication, wait_for_reply=wait_for_reply) for appid in subscribers),
+            return_exceptions=True
+        )
+        stats.sent += len(subscribers)
+        if wait_for_reply:
+            return {
+                appid: payload.route.decode(result) if isinstance(result, bytes) else result
+                for appid, result in zip(subscribers, results)
+            }
+        return {}
+
+    async def _handle_publication(self, topic: str, sent_at: float, body: bytes) -> bytes:
+        """
+        Handle a request published to one of our topics.
+        """
+        stats = self.topic_stats.setdefault(topic, TopicStats())
+        stats.record_delivery(time.time() - sent_at)
+        return await self._handle_body(body)
+
+    def topic_summary(self) -> dict[str, dict]:
+        return {topic: stats.summary() for topic, stats in self.topic_stats.items()}
 
     async def close(self):
         # Close connection to the server
         # TODO
-        ...
+        for connection in (*self._connections.values(), *self._incoming):
+            await connection.close()
+        self._connections.clear()
+        self._incoming.clear()
+
+    async def peer_connection(self, appid) -> PeerConnection:
+        """
+        Get the long-lived connection to the given peer, opening a new one if required.
+        """
+        connection = self._connections.get(appid, None)
+        if connection is None or connection.closed:
+            lock = self._connection_locks.setdefault(appid, asyncio.Lock())
+            async with lock:
+                connection = self._connections.get(appid, None)
+                if connection is None or connection.closed:
+                    logger.debug(f"Opening new connection to peer '{appid}'.")
+                    connection = await PeerConnection.open(self.peers[appid], name=appid)
+                    self._connections[appid] = connection
+        return connection
 
     @log_wrap(action="Req")
-    async def request(self, appid, payload: 'AppPayload', wait_for_reply=True):
+    async def request(self, appid, payload: 'AppPayload', wait_for_reply=True, raise_errors=False):
+        """
+        Send the given payload to the peer `appid`, returning the decoded result if `wait_for_reply` is set.
+
+        Failures are logged and return None, unless `raise_errors` is set.
+        """
         set_logging_context(action=appid)
         try:
             if appid not in self.peers:
                 raise ValueError(f"Peer '{appid}' not found.")
             logger.debug(f"Sending request to app '{appid}' with payload {payload}")
 
-            address = self.peers[appid]
-            reader, writer = await asyncio.open_connection(**address)
+            encoded = payload.encoded()
+            try:
+                connection = await self.peer_connection(appid)
+                result = await connection.request(encoded, wait_for_reply=wait_for_reply)
+            except FrameNotSent:
+                # The held connection may have gone stale, e.g. if the peer restarted
+                # The peer never received the request, so reconnect and try once more
+                logger.info(f"Connection to peer '{appid}' was lost. Reconnecting.")
+                self._connections.pop(appid, None)
+                connection = await self.peer_connection(appid)
+                result = await connection.request(encoded, wait_for_reply=wait_for_reply)
 
-            writer.write(payload.encoded())
-            await writer.drain()
-            writer.write_eof()
             if wait_for_reply:
-                result = await reader.read()
-                writer.close()
-                decoded = payload.route.decode(result)
-                return decoded
+                return payload.route.decode(result)
             else:
                 return None
         except Exception:
             logging.exception(f"Failed to send request to {appid}'")
+            if raise_errors:
+                raise
             return None
 
     @log_wrap(action="Broadcast")
@@ -134,23 +291,43 @@ class AppClient:
         return dict(zip(peerlist, results))
 
     async def handle_request(self, reader, writer):
+        """
+        Hold an incoming peer connection, handling each request frame sent along it.
+        """
         set_logging_context(action="SERV")
-        data = await reader.read()
-        loaded = pickle.loads(data)
-        route, args, kwargs = loaded
+        connection = PeerConnection(reader, writer, handler=self._handle_body, name='incoming').start()
+        self._incoming.add(connection)
+        try:
+            await connection.wait_closed()
+        finally:
+            self._incoming.discard(connection)
 
-        set_logging_context(action=route)
+    async def _handle_body(self, data: bytes) -> bytes:
+        """
+        Handle a single encoded request, returning the encoded response.
+        """
+        tag, route, body = decode_envelope(data)
 
-        logger.debug(f"AppClient {self.appid} handling request on route '{route}' with args {args} and kwargs {kwargs}")
+        set_logging_context(action=route)
 
-        if route in self.routes:
+        if route not in self.routes:
+            logger.warning(f"Appclient '{self.appid}' recieved unknown route {route}. Ignoring.")
+        elif tag != (codec := self.routes[route].codec).tag:
+            # Never decode a body with a codec the route did not ask for
+            logger.warning(
+                f"Appclient '{self.appid}' recieved request on route '{route}' with codec {tag}, "
+                f"but the route uses codec {codec.tag}. Ignoring."
+            )
+        else:
             try:
-                await self.routes[route].run((reader, writer), args, kwargs)
+                args, kwargs = codec.decode_request(body)
+                logger.debug(
+                    f"AppClient {self.appid} handling request on route '{route}' with args {args} and kwargs {kwargs}"
+                )
+                return await self.routes[route].run(args, kwargs)
             except Exception:
                 logger.exception(f"Fatal exception during route '{route}'. This should never happen!")
-        else:
-            logger.warning(f"Appclient '{self.appid}' recieved unknown route {route}. Ignoring.")
-        writer.write_eof()
+        return b''
 
     @log_wrap(stack=("ShardTalk",))
     async def connect(self):
@@ -165,6 +342,48 @@ class AppClient:
         await self.server_connection()
 
 
+class TopicStats:
+    """
+    Publish and delivery counters for a single topic.
+
+    `published`, `sent` and `unrouted` count messages published by this client,
+    `received` counts publications delivered to this client, along with their delivery latency.
+    """
+    __slots__ = ('published', 'sent', 'unrouted', 'received', 'latency_total', 'latency_max', 'latency_avg')
+
+    # Weight of the most recent latency sample in the moving average
+    smoothing = 0.1
+
+    def __init__(self):
+        self.published = 0
+        self.sent = 0
+        self.unrouted = 0
+        self.received = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_avg = 0.0
+
+    def record_delivery(self, latency: float):
+        if self.received:
+            self.latency_avg += self.smoothing * (latency - self.latency_avg)
+        else:
+            self.latency_avg = latency
+        self.received += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def summary(self) -> dict:
+        return {
+            'published': self.published,
+            'sent': self.sent,
+            'unrouted': self.unrouted,
+            'received': self.received,
+            'latency_mean': (self.latency_total / self.received) if self.received else None,
+            'latency_avg': self.latency_avg if self.received else None,
+            'latency_max': self.latency_max if self.received else None,
+        }
+
+
 class AppPayload:
     __slots__ = ('route', 'args', 'kwargs')
 
@@ -177,7 +396,7 @@ class AppPayload:
         return self.route.execute(*self.args, **self.kwargs).__await__()
 
     def encoded(self):
-        return pickle.dumps((self.route.name, self.args, self.kwargs))
+        return encode_message(self.route.name, self.route.codec, self.args, self.kwargs)
 
     async def send(self, appid, **kwargs):
         return await self.route._client.request(appid, self, **kwargs)
@@ -185,28 +404,25 @@ class AppPayload:
     async def broadcast(self, **kwargs):
         return await self.route._client.requestall(self, **kwargs)
 
+    async def publish(self, topic, **kwargs):
+        return await self.route._client.publish(topic, self, **kwargs)
+
 
 class AppRoute:
-    __slots__ = ('func', 'name', '_client')
+    __slots__ = ('func', 'name', 'codec', '_client', 'encode', 'decode')
 
-    def __init__(self, func, client=None, name=None):
+    def __init__(self, func, codec: Codec, client=None, name=None):
         self.func = func
         self.name = name or func.__name__
+        self.codec = codec
         self._client = client
 
+        self.encode = codec.encode_result
+        self.decode = codec.decode_result
+
     def __call__(self, *args, **kwargs):
         return AppPayload(self, *args, **kwargs)
 
-    def encode(self, output):
-        return pickle.dumps(output)
-
-    def decode(self, encoded):
-        # TODO: Handle exceptions here somehow
-        if len(encoded) > 0:
-            return pickle.loads(encoded)
-        else:
-            return ''
-
     def encoder(self, func):
         self.encode = func
 
@@ -219,20 +435,15 @@ class AppRoute:
         """
         return await self.func(*args, **kwargs)
 
-    async def run(self, connection, args, kwargs):
+    async def run(self, args, kwargs) -> bytes:
         """
-        Run the route, with the given arguments, using the given connection.
+        Run the route with the given arguments, returning the encoded result.
         """
         # TODO: ContextVar here for logging? Or in handle_request?
-        # Get encoded result
-        # TODO: handle exceptions in the execution process
         try:
             result = await self.execute(*args, **kwargs)
             payload = self.encode(result)
         except Exception:
             logger.exception(f"Exception occured running route '{self.name}' with args: {args} and kwargs: {kwargs}")
             payload = b''
-        _, writer = connection
-        writer.write(payload)
-        await writer.drain()
-        writer.close()
+        return payload
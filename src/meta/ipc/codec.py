@@ -0,0 +1,483 @@
+"""
+Pluggable message codecs for ShardTalk routes.
+
+Every route declares the codec used to encode its arguments and results.
+`SchemaCodec` packs arguments described by type hints (including NamedTuples and Enums)
+into a compact binary format, and is safe to decode from untrusted peers.
+`PickleCodec` supports arbitrary objects, and must be explicitly chosen by routes which need it.
+
+Messages are sent in an envelope carrying the codec tag and the route name,
+so receivers can look up the route and check its codec before decoding the body.
+"""
+from typing import Any, Optional, Union, get_type_hints, get_origin, get_args
+from enum import Enum
+import datetime as dt
+import pickle
+import struct
+
+
+class CodecError(Exception):
+    """
+    Raised when a message cannot be encoded or decoded with the requested codec.
+    """
+    ...
+
+
+class Codec:
+    """
+    Base codec describing how to encode route requests and results.
+    """
+    # Identifying tag sent in the message envelope
+    tag: int
+
+    def encode_request(self, args: tuple, kwargs: dict) -> bytes:
+        raise NotImplementedError
+
+    def decode_request(self, data: bytes) -> tuple[tuple, dict]:
+        raise NotImplementedError
+
+    def encode_result(self, result: Any) -> bytes:
+        raise NotImplementedError
+
+    def decode_result(self, data: bytes) -> Any:
+        raise NotImplementedError
+
+
+class PickleCodec(Codec):
+    """
+    Codec supporting arbitrary picklable objects.
+    Only use this for routes which genuinely need it, since unpickling executes arbitrary code.
+    """
+    tag = 0
+
+    def encode_request(self, args, kwargs):
+        return pickle.dumps((args, kwargs))
+
+    def decode_request(self, data):
+        return pickle.loads(data)
+
+    def encode_result(self, result):
+        return pickle.dumps(result)
+
+    def decode_result(self, data):
+        # TODO: Handle exceptions here somehow
+        if len(data) > 0:
+            return pickle.loads(data)
+        else:
+            return ''
+
+
+pickle_codec = PickleCodec()
+
+
+# ----- Schema field coders -----
+_bool = struct.Struct('!?')
+_length = struct.Struct('!I')
+_microsecond = dt.timedelta(microseconds=1)
+
+
+class _Coder:
+    """
+    Packs and unpacks a single typed value.
+
+    Fixed width coders also describe their struct format,
+    so consecutive fixed width fields may be packed with a single struct call.
+    These convert values to and from their `width` raw struct values with `to_raw` and `from_raw`,
+    unless they are `identity` coders, whose values are packed directly.
+    """
+    __slots__ = ()
+
+    fmt: Optional[str] = None
+    width: int = 1
+    identity: bool = False
+
+    def pack(self, buf: bytearray, value):
+        raise NotImplementedError
+
+    def unpack(self, data: bytes, offset: int) -> tuple[Any, int]:
+        raise NotImplementedError
+
+    def to_raw(self, value) -> tuple:
+        return (value,)
+
+    def from_raw(self, *raw):
+        return raw[0]
+
+
+class _FixedCoder(_Coder):
+    """
+    Base for fixed width coders, packing and unpacking through their struct format.
+    """
+    __slots__ = ('_struct',)
+
+    def __init__(self):
+        self._struct = struct.Struct('!' + self.fmt)
+
+    def pack(self, buf, value):
+        buf += self._struct.pack(*self.to_raw(value))
+
+    def unpack(self, data, offset):
+        return self.from_raw(*self._struct.unpack_from(data, offset)), offset + self._struct.size
+
+
+class _StructCoder(_FixedCoder):
+    __slots__ = ('fmt',)
+
+    identity = True
+
+    def __init__(self, fmt: str):
+        self.fmt = fmt
+        super().__init__()
+
+
+class _StrCoder(_Coder):
+    __slots__ = ()
+
+    def pack(self, buf, value):
+        encoded = value.encode()
+        buf += _length.pack(len(encoded))
+        buf += encoded
+
+    def unpack(self, data, offset):
+        length, = _length.unpack_from(data, offset)
+        offset += _length.size
+        return str(data[offset:offset + length], 'utf-8'), offset + length
+
+
+class _BytesCoder(_Coder):
+    __slots__ = ()
+
+    def pack(self, buf, value):
+        buf += _length.pack(len(value))
+        buf += value
+
+    def unpack(self, data, offset):
+        length, = _length.unpack_from(data, offset)
+        offset += _length.size
+        return bytes(data[offset:offset + length]), offset + length
+
+
+class _OptionalStrCoder(_Coder):
+    """
+    Optional strings are sent with a reserved length marking missing values.
+    """
+    __slots__ = ()
+
+    missing = 2**32 - 1
+
+    def pack(self, buf, value):
+        if value is None:
+            buf += _length.pack(self.missing)
+        else:
+            encoded = value.encode()
+            buf += _length.pack(len(encoded))
+            buf += encoded
+
+    def unpack(self, data, offset):
+        length, = _length.unpack_from(data, offset)
+        offset += _length.size
+        if length == self.missing:
+            return None, offset
+        return str(data[offset:offset + length], 'utf-8'), offset + length
+
+
+class _DatetimeCoder(_FixedCoder):
+    """
+    Datetimes are sent as integer microseconds since the epoch, with a flag marking aware datetimes.
+    Aware datetimes are decoded in UTC, naive datetimes are kept naive.
+    """
+    __slots__ = ()
+
+    fmt = 'q?'
+    width = 2
+    epoch = dt.datetime(1970, 1, 1)
+    epoch_utc = epoch.replace(tzinfo=dt.timezone.utc)
+
+    def to_raw(self, value: dt.datetime):
+        if value.tzinfo is not None:
+            return ((value - self.epoch_utc) // _microsecond, True)
+        else:
+            return ((value - self.epoch) // _microsecond, False)
+
+    def from_raw(self, micros, aware):
+        return (self.epoch_utc if aware else self.epoch) + dt.timedelta(microseconds=micros)
+
+
+class _EnumCoder(_FixedCoder):
+    __slots__ = ('members', 'index')
+
+    fmt = 'B'
+
+    def __init__(self, enum: type[Enum]):
+        self.members = list(enum)
+        self.index = {member: i for i, member in enumerate(self.members)}
+        super().__init__()
+
+    def to_raw(self, value):
+        return (self.index[value],)
+
+    def from_raw(self, i):
+        return self.members[i]
+
+
+class _OptionalFixedCoder(_FixedCoder):
+    """
+    Optional fixed width values are sent with a presence flag, and zeroed when missing.
+    """
+    __slots__ = ('inner', 'fmt', 'width', 'blank')
+
+    def __init__(self, inner: _Coder):
+        self.inner = inner
+        self.fmt = '?' + inner.fmt
+        self.width = inner.width + 1
+        self.blank = (False,) + tuple(struct.unpack('!' + inner.fmt, bytes(struct.calcsize('!' + inner.fmt))))
+        super().__init__()
+
+    def to_raw(self, value):
+        if value is None:
+            return self.blank
+        return (True, *self.inner.to_raw(value))
+
+    def from_raw(self, present, *raw):
+        if present:
+            return self.inner.from_raw(*raw)
+        return None
+
+
+class _OptionalCoder(_Coder):
+    __slots__ = ('inner',)
+
+    def __init__(self, inner: _Coder):
+        self.inner = inner
+
+    def pack(self, buf, value):
+        buf += _bool.pack(value is not None)
+        if value is not None:
+            self.inner.pack(buf, value)
+
+    def unpack(self, data, offset):
+        present, = _bool.unpack_from(data, offset)
+        offset += _bool.size
+        if present:
+            return self.inner.unpack(data, offset)
+        else:
+            return None, offset
+
+
+class _ListCoder(_Coder):
+    __slots__ = ('inner',)
+
+    def __init__(self, inner: _Coder):
+        self.inner = inner
+
+    def pack(self, buf, value):
+        buf += _length.pack(len(value))
+        for item in value:
+            self.inner.pack(buf, item)
+
+    def unpack(self, data, offset):
+        count, = _length.unpack_from(data, offset)
+        offset += _length.size
+        items = []
+        for _ in range(count):
+            item, offset = self.inner.unpack(data, offset)
+            items.append(item)
+        return items, offset
+
+
+class _TupleCoder(_Coder):
+    """
+    Packs NamedTuples field by field.
+    Runs of consecutive fixed width fields are packed together with a single struct.
+    """
+    __slots__ = ('cls', 'steps')
+
+    def __init__(self, cls: type):
+        self.cls = cls
+        hints = get_type_hints(cls)
+        coders = [coder_for(hints[name]) for name in cls._fields]
+
+        # Each step is either (Struct, [fixed coders]) or (None, variable coder)
+        self.steps = []
+        run = []
+        for coder in coders:
+            if coder.fmt is not None:
+                run.append(coder)
+            else:
+                if run:
+                    self.steps.append(self._fixed_step(run))
+                    run = []
+                self.steps.append((None, coder))
+        if run:
+            self.steps.append(self._fixed_step(run))
+
+    @staticmethod
+    def _fixed_step(run):
+        return (struct.Struct('!' + ''.join(coder.fmt for coder in run)), run)
+
+    def pack(self, buf, value):
+        i = 0
+        for fmt, coders in self.steps:
+            if fmt is None:
+                coders.pack(buf, value[i])
+                i += 1
+            else:
+                raw = []
+                for coder in coders:
+                    if coder.identity:
+                        raw.append(value[i])
+                    else:
+                        raw.extend(coder.to_raw(value[i]))
+                    i += 1
+                buf += fmt.pack(*raw)
+
+    def unpack(self, data, offset):
+        items = []
+        for fmt, coders in self.steps:
+            if fmt is None:
+                item, offset = coders.unpack(data, offset)
+                items.append(item)
+            else:
+                raw = fmt.unpack_from(data, offset)
+                offset += fmt.size
+                j = 0
+                for coder in coders:
+                    if coder.identity:
+                        items.append(raw[j])
+                        j += 1
+                    else:
+                        items.append(coder.from_raw(*raw[j:j + coder.width]))
+                        j += coder.width
+        return self.cls._make(items), offset
+
+
+_coder_cache: dict[Any, _Coder] = {}
+
+
+def coder_for(hint) -> _Coder:
+    """
+    Build the coder for the given type hint.
+
+    Supports `int`, `float`, `bool`, `str`, `bytes`, `datetime`, Enums, NamedTuples,
+    and `Optional` and `list` of supported types.
+    """
+    if hint in _coder_cache:
+        return _coder_cache[hint]
+
+    origin = get_origin(hint)
+    if origin is Union:
+        members = [arg for arg in get_args(hint) if arg is not type(None)]
+        if len(members) != 1:
+            raise CodecError(f"Unsupported union type {hint!r}")
+        inner = coder_for(members[0])
+        if inner.fmt is not None:
+            coder = _OptionalFixedCoder(inner)
+        elif isinstance(inner, _StrCoder):
+            coder = _OptionalStrCoder()
+        else:
+            coder = _OptionalCoder(inner)
+    elif origin is list:
+        coder = _ListCoder(coder_for(get_args(hint)[0]))
+    elif hint is bool:
+        coder = _StructCoder('?')
+    elif hint is int:
+        coder = _StructCoder('q')
+    elif hint is float:
+        coder = _StructCoder('d')
+    elif hint is str:
+        coder = _StrCoder()
+    elif hint is bytes:
+        coder = _BytesCoder()
+    elif hint is dt.datetime:
+        coder = _DatetimeCoder()
+    elif isinstance(hint, type) and issubclass(hint, Enum):
+        coder = _EnumCoder(hint)
+    elif isinstance(hint, type) and issubclass(hint, tuple) and hasattr(hint, '_fields'):
+        coder = _TupleCoder(hint)
+    else:
+        raise CodecError(f"Unsupported schema type {hint!r}")
+
+    _coder_cache[hint] = coder
+    return coder
+
+
+class SchemaCodec(Codec):
+    """
+    Compact binary codec for routes with typed positional arguments.
+
+    Parameters
+    ----------
+    arg_types: type
+        Type hints for each positional argument of the route.
+    varargs: Optional[type]
+        Type hint for any remaining positional arguments.
+    result: Optional[type]
+        Type hint for the route result. If not given, the route result is discarded.
+    """
+    tag = 1
+
+    def __init__(self, *arg_types, varargs=None, result=None):
+        self.arg_coders = [coder_for(hint) for hint in arg_types]
+        self.varargs_coder = _ListCoder(coder_for(varargs)) if varargs is not None else None
+        self.result_coder = _OptionalCoder(coder_for(result)) if result is not None else None
+
+    def encode_request(self, args, kwargs):
+        if kwargs:
+            raise CodecError("SchemaCodec does not support keyword arguments.")
+        if len(args) < len(self.arg_coders) or (len(args) > len(self.arg_coders) and not self.varargs_coder):
+            raise CodecError(f"Expected {len(self.arg_coders)} arguments, received {len(args)}.")
+
+        buf = bytearray()
+        for coder, arg in zip(self.arg_coders, args):
+            coder.pack(buf, arg)
+        if self.varargs_coder is not None:
+            self.varargs_coder.pack(buf, args[len(self.arg_coders):])
+        return bytes(buf)
+
+    def decode_request(self, data):
+        offset = 0
+        args = []
+        for coder in self.arg_coders:
+            arg, offset = coder.unpack(data, offset)
+            args.append(arg)
+        if self.varargs_coder is not None:
+            extra, offset = self.varargs_coder.unpack(data, offset)
+            args.extend(extra)
+        return tuple(args), {}
+
+    def encode_result(self, result):
+        if self.result_coder is None:
+            return b''
+        buf = bytearray()
+        self.result_coder.pack(buf, result)
+        return bytes(buf)
+
+    def decode_result(self, data):
+        if self.result_coder is None or not data:
+            return None
+        result, _ = self.result_coder.unpack(data, 0)
+        return result
+
+
+# ----- Message envelope -----
+_envelope = struct.Struct('!BB')
+
+
+def encode_message(name: str, codec: Codec, args: tuple, kwargs: dict) -> bytes:
+    """
+    Encode a route request into an envelope with the codec tag and route name.
+    """
+    encoded_name = name.encode()
+    if len(encoded_name) > 255:
+        raise CodecError(f"Route name {name!r} is too long.")
+    return _envelope.pack(codec.tag, len(encoded_name)) + encoded_name + codec.encode_request(args, kwargs)
+
+
+def decode_envelope(data: bytes) -> tuple[int, str, bytes]:
+    """
+    Read the codec tag, route name, and encoded body from a message envelope.
+    """
+    tag, length = _envelope.unpack_from(data, 0)
+    start = _envelope.size
+    name = data[start:start + length].decode()
+    return tag, name, data[start + length:]
@@ -0,0 +1,190 @@
+"""
+Framed, multiplexed connections for ShardTalk.
+
+Each frame consists of a fixed header followed by an opaque body.
+The header holds the body length, the frame kind, and a request id.
+Requests expecting a reply carry a non-zero request id,
+and the reply frame carries the same id, so many requests may be in flight on one connection.
+"""
+from typing import Optional, Callable, Awaitable
+import asyncio
+import itertools
+import logging
+import struct
+
+from ..logger import log_wrap
+
+
+logger = logging.getLogger(__name__)
+
+
+# Frame header: body length, frame kind, request id
+HEADER = struct.Struct('!IBQ')
+
+REQUEST = 1
+REPLY = 2
+
+# Handler for incoming request bodies, returns the encoded reply body
+FrameHandler = Callable[[bytes], Awaitable[bytes]]
+
+
+class FrameNotSent(ConnectionError):
+    """
+    Raised when a request frame could not be written to the connection,
+    so the peer is known not to have received it.
+    """
+    pass
+
+
+def encode_frame(kind: int, reqid: int, body: bytes) -> bytes:
+    return HEADER.pack(len(body), kind, reqid) + body
+
+
+async def read_frame(reader: asyncio.StreamReader) -> tuple[int, int, bytes]:
+    """
+    Read a single frame from the given reader.
+    Raises `asyncio.IncompleteReadError` if the connection closes mid-frame or before a frame.
+    """
+    header = await reader.readexactly(HEADER.size)
+    length, kind, reqid = HEADER.unpack(header)
+    body = await reader.readexactly(length) if length else b''
+    return kind, reqid, body
+
+
+class PeerConnection:
+    """
+    A long-lived framed connection to a ShardTalk peer.
+
+    Outgoing requests are sent with `request`, and may optionally wait for a reply.
+    Incoming requests are passed to the provided `handler`, and its result is sent back as the reply.
+    """
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 handler: Optional[FrameHandler] = None, name: str = 'peer'):
+        self.reader = reader
+        self.writer = writer
+        self.handler = handler
+        self.name = name
+
+        self._ids = itertools.count(1)
+        self._pending: dict[int, asyncio.Future] = {}
+        self._write_lock = asyncio.Lock()
+        self._handler_tasks: set[asyncio.Task] = set()
+
+        self._closed = asyncio.Event()
+        self._reader_task: Optional[asyncio.Task] = None
+
+    def __repr__(self):
+        return f"<PeerConnection name={self.name!r} pending={len(self._pending)} closed={self.closed}>"
+
+    @classmethod
+    async def open(cls, address: dict, handler: Optional[FrameHandler] = None, name: str = 'peer'):
+        """
+        Open a new connection to the given address and start reading from it.
+        """
+        reader, writer = await asyncio.open_connection(**address)
+        return cls(reader, writer, handler=handler, name=name).start()
+
+    @property
+    def closed(self):
+        return self._closed.is_set()
+
+    def start(self):
+        self._reader_task = asyncio.create_task(self._read_loop(), name=f"ipc-reader-{self.name}")
+        return self
+
+    async def _write(self, frame: bytes):
+        async with self._write_lock:
+            self.writer.write(frame)
+            await self.writer.drain()
+
+    async def _send_frame(self, frame: bytes):
+        if self.closed:
+            raise FrameNotSent(f"Connection to {self.name} is closed.")
+        try:
+            await self._write(frame)
+        except ConnectionError as e:
+            raise FrameNotSent(f"Could not write to {self.name}.") from e
+
+    async def request(self, body: bytes, wait_for_reply=True) -> Optional[bytes]:
+        """
+        Send a request frame with the given body.
+        If `wait_for_reply` is set, waits for and returns the reply body.
+
+        Raises `FrameNotSent` if the frame could not be written,
+        and `ConnectionResetError` if the connection closed while waiting for the reply.
+        """
+        if wait_for_reply:
+            reqid = next(self._ids)
+            future = asyncio.get_running_loop().create_future()
+            self._pending[reqid] = future
+            try:
+                await self._send_frame(encode_frame(REQUEST, reqid, body))
+                return await future
+            finally:
+                self._pending.pop(reqid, None)
+        else:
+            await self._send_frame(encode_frame(REQUEST, 0, body))
+            return None
+
+    @log_wrap(action='IPC Read')
+    async def _read_loop(self):
+        try:
+            while True:
+                kind, reqid, body = await read_frame(self.reader)
+                if kind == REPLY:
+                    future = self._pending.get(reqid)
+                    if future is not None and not future.done():
+                        future.set_result(body)
+                elif kind == REQUEST:
+                    task = asyncio.create_task(self._handle(reqid, body))
+                    self._handler_tasks.add(task)
+                    task.add_done_callback(self._handler_tasks.discard)
+                else:
+                    logger.warning(f"Received unknown frame kind {kind} from {self.name}. Ignoring.")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.debug(f"Connection to {self.name} closed.")
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.exception(f"Unexpected exception reading from {self.name}. Closing connection.")
+        finally:
+            self._shutdown()
+
+    async def _handle(self, reqid: int, body: bytes):
+        if self.handler is None:
+            logger.warning(f"Received request from {self.name} with no handler attached. Ignoring.")
+            reply = b''
+        else:
+            try:
+                reply = await self.handler(body)
+            except Exception:
+                logger.exception(f"Unhandled exception handling request from {self.name}.")
+                reply = b''
+        if reqid:
+            try:
+                await self._write(encode_frame(REPLY, reqid, reply or b''))
+            except ConnectionError:
+                logger.info(f"Could not reply to {self.name}, connection closed.")
+
+    def _shutdown(self):
+        if self.closed:
+            return
+        self._closed.set()
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionResetError(f"Connection to {self.name} closed."))
+        self._pending.clear()
+        if not self.writer.is_closing():
+            self.writer.close()
+
+    async def wait_closed(self):
+        await self._closed.wait()
+
+    async def close(self):
+        if self._reader_task is not None and not self._reader_task.done():
+            self._reader_task.cancel()
+        self._shutdown()
+        try:
+            await self.writer.wait_closed()
+        except Exception:
+            pass
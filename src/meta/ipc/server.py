@@ -1,11 +1,14 @@
 import asyncio
 import pickle
+from functools import partial
 import logging
 import string
 import random
 
 from ..logger import log_context, log_app, setup_main_logger, set_logging_context, log_wrap
 from ..config import conf
+from .connection import PeerConnection
+from .codec import pickle_codec, encode_message, decode_envelope
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +28,7 @@ class AppServer:
 
     def __init__(self):
         self.clients = {}  # AppID -> (info, connection)
+        self.topics: dict[str, set[str]] = {}  # topic -> subscribed AppIDs
 
         self.route('ping')(self.route_ping)
         self.route('whereis')(self.route_whereis)
@@ -71,31 +75,40 @@ class AppServer:
         writer.write(payload)
         writer.write_eof()
 
-    async def client_connection(self, connection, appid, address):
+    async def client_connection(self, connection, appid, address, topics=()):
         """
         Register and hold a new client connection.
         """
         set_logging_context(action=f"CONN {appid}")
         reader, writer = connection
-        # Add the new client
-        self.clients[appid] = (address, connection)
 
         # Send the new client a client list
         peers = self.peer_list()
+        peers[appid] = address
         writer.write(pickle.dumps(peers))
         writer.write(b'\n')
         await writer.drain()
 
+        # Hold the connection, further messages to the client are sent as frames along it
+        held = PeerConnection(
+            reader, writer, handler=partial(self.handle_client_message, appid), name=appid
+        ).start()
+        self.clients[appid] = (address, held)
+
         # Announce the new client to everyone
         await self.broadcast('new_peer', (), {'appid': appid, 'address': address})
 
+        # Register the client's subscriptions, and send everyone the new topic map
+        self.subscribe(appid, topics)
+        await self.broadcast('topic_map', (self.topic_map(),), {})
+
         # Keep the connection open until socket closed or EOF (indicating client death)
         try:
-            await reader.read()
+            await held.wait_closed()
         finally:
             # Connection ended or it broke
             logger.info(f"Lost client '{appid}'")
-            await self.deregister_client(appid)
+            await self.deregister_client(appid, held)
 
     async def handle_connection(self, reader, writer):
         data = await reader.readline()
@@ -115,17 +128,64 @@ class AppServer:
         else:
             logger.warning(f"AppServer recieved unknown route '{route}'. Ignoring.")
 
+    async def handle_client_message(self, appid, data: bytes) -> bytes:
+        """
+        Handle a message sent by a registered client along its held connection.
+        """
+        tag, route, body = decode_envelope(data)
+        if tag != pickle_codec.tag or route not in ('subscribe', 'unsubscribe'):
+            logger.warning(f"AppServer recieved unknown client message '{route}' from '{appid}'. Ignoring.")
+            return b''
+        args, _ = pickle_codec.decode_request(body)
+        topics = args[0]
+        set_logging_context(action=f"{route.upper()} {appid}")
+        logger.debug(f"Client '{appid}' {route}d to topics {topics}.")
+        if route == 'subscribe':
+            self.subscribe(appid, topics)
+        else:
+            self.unsubscribe(appid, topics)
+        await self.broadcast('topic_map', (self.topic_map(),), {})
+        return b''
+
+    def subscribe(self, appid, topics):
+        for topic in topics:
+            self.topics.setdefault(topic, set()).add(appid)
+
+    def unsubscribe(self, appid, topics):
+        for topic in topics:
+            if (subscribers := self.topics.get(topic)) is not None:
+                subscribers.discard(appid)
+                if not subscribers:
+                    self.topics.pop(topic)
+
+    def topic_map(self):
+        return {topic: list(subscribers) for topic, subscribers in self.topics.items()}
+
     def peer_list(self):
         return {appid: address for appid, (address, _) in self.clients.items()}
 
-    async def deregister_client(self, appid):
-        self.clients.pop(appid, None)
+    async def deregister_client(self, appid, held: PeerConnection):
+        """
+        Deregister the client `appid` after its held connection `held` ended.
+
+        The client may have already reconnected with a new held connection,
+        in which case only the old connection is closed, and the client stays registered.
+        """
+        if appid not in self.clients or self.clients[appid][1] is not held:
+            await held.close()
+            return
+        self.clients.pop(appid)
+        await held.close()
         await self.broadcast('drop_peer', (), {'appid': appid})
+        subscribed = [topic for topic, subscribers in self.topics.items() if appid in subscribers]
+        if subscribed:
+            self.unsubscribe(appid, subscribed)
+            await self.broadcast('topic_map', (self.topic_map(),), {})
 
     @log_wrap(action="broadcast")
     async def broadcast(self, route, args, kwargs):
         logger.debug(f"Sending broadcast on route '{route}' with args {args} and kwargs {kwargs}.")
-        payload = pickle.dumps((route, args, kwargs))
+        payload = encode_message(route, pickle_codec, args, kwargs)
         if self.clients:
             await asyncio.gather(
                 *(self._send(appid, payload) for appid in self.clients),
@@ -141,20 +201,16 @@ class AppServer:
         if appid not in self.clients:
             raise ValueError(f"Client '{appid}' is not connected.")
 
-        payload = pickle.dumps((route, args, kwargs))
+        payload = encode_message(route, pickle_codec, args, kwargs)
         return await self._send(appid, payload)
 
     async def _send(self, appid, payload):
         """
-        Send the encoded `payload` to the client `appid`.
+        Send the encoded `payload` to the client `appid`, along its held registry connection.
         """
-        address, _ = self.clients[appid]
+        _, held = self.clients[appid]
         try:
-            reader, writer = await asyncio.open_connection(**address)
-            writer.write(payload)
-            writer.write_eof()
-            await writer.drain()
-            writer.close()
+            await held.request(payload, wait_for_reply=False)
         except Exception as ex:
             # TODO: Close client if we can't connect?
             logger.exception(f"Failed to send message to '{appid}'")
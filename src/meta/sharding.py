@@ -12,6 +12,13 @@ shard_count = conf.bot.getint('shard_count', 1)
 sharded = (shard_count > 0)
 
 
+def shard_topic(shard_id: int) -> str:
+    """
+    ShardTalk topic subscribed to by the given shard.
+    """
+    return f"guild:{shard_id}"
+
+
 def SHARDID(shard_id: int, guild_column: str = 'guildid', shard_count: int = shard_count) -> Condition:
     """
     Condition constructor for filtering by shard id.
@@ -50,6 +50,7 @@ class Economy(LionCog):
         self.settings = EconomySettings()
 
         self.bonuses = {}
+        self.bulk_bonuses = {}
 
     async def cog_load(self):
         await self.data.init()
@@ -67,12 +68,25 @@ class Economy(LionCog):
             self.crossload_group(self.configure_group, configcog.config_group)
 
     # ----- Economy Bonus registration -----
-    def register_economy_bonus(self, bonus_coro, name=None):
+    def register_economy_bonus(self, bonus_coro, name=None, bulk_coro=None):
+        """
+        Register a coroutine providing an economy bonus multiplier for a member.
+
+        `bonus_coro` is called as `bonus_coro(guildid, userid, **kwargs)`.
+        The optional `bulk_coro` is called as `bulk_coro(*memberids, **kwargs)` for many members at once,
+        and should return a map `(guildid, userid) -> multiplier`.
+        Members missing from the returned map are assumed to have no bonus.
+        """
         name = name or bonus_coro.__name__
         self.bonuses[name] = bonus_coro
+        if bulk_coro is not None:
+            self.bulk_bonuses[name] = bulk_coro
+        else:
+            self.bulk_bonuses.pop(name, None)
 
     def deregister_economy_bonus(self, name):
         bonus_coro = self.bonuses.pop(name, None)
+        self.bulk_bonuses.pop(name, None)
         if bonus_coro is None:
             raise ValueError(f"Bonus function '{name}' is not registered!")
         return
@@ -83,6 +97,28 @@ class Economy(LionCog):
             multiplier *= await coro(guildid, userid, **kwargs)
         return multiplier
 
+    async def fetch_economy_bonuses(self, *memberids: tuple[int, int], **kwargs) -> dict[tuple[int, int], float]:
+        """
+        Fetch the economy bonus multiplier for each of the given members.
+
+        Bonuses registered with a bulk coroutine are answered in one call,
+        the remaining bonuses are fetched per member.
+        """
+        multipliers = {memberid: 1 for memberid in memberids}
+        if not memberids:
+            return multipliers
+        for name, coro in self.bonuses.items():
+            bulk_coro = self.bulk_bonuses.get(name, None)
+            if bulk_coro is not None:
+                results = await bulk_coro(*memberids, **kwargs)
+                for memberid, bonus in results.items():
+                    if memberid in multipliers:
+                        multipliers[memberid] *= bonus
+            else:
+                for memberid in memberids:
+                    multipliers[memberid] *= await coro(*memberid, **kwargs)
+        return multipliers
+
     # ----- Economy group commands -----
     @cmds.hybrid_group(name=_p('cmd:economy', "economy"))
     @cmds.guild_only()
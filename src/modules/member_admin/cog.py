@@ -1,4 +1,3 @@
-from io import StringIO
 from typing import Optional
 import asyncio
 
@@ -6,7 +5,6 @@ import discord
 from discord.ext import commands as cmds
 from discord.enums import AppCommandOptionType
 from discord import app_commands as appcmds
-from psycopg import sql
 from data.queries import NULLS, ORDER
 
 from meta import LionCog, LionBot, LionContext
@@ -14,10 +12,10 @@ from meta.logger import log_wrap
 from meta.sharding import THIS_SHARD
 from meta.errors import UserInputError, SafeCancellation
 from babel.translator import ctx_locale
-from utils.lib import utc_now, parse_time_static, write_records
+from utils.lib import utc_now, parse_time_static
 from utils.ui import ChoicedEnum, Transformed
 from utils.ratelimits import Bucket, BucketFull, BucketOverFull
-from data import RawExpr, NULL
+from data import NULL
 
 from wards import low_management_ward, equippable_role, high_management_ward
 
@@ -25,6 +23,7 @@ from . import babel, logger
 from .data import MemberAdminData
 from .settings import MemberAdminSettings
 from .settingui import MemberAdminUI
+from .export import DataExport, ExportFormat
 
 _p = babel._p
 
@@ -48,6 +47,9 @@ class DownloadableData(ChoicedEnum):
         return self.name
 
 class MemberAdminCog(LionCog):
+    # Maximum number of files uploaded for a single data export
+    export_max_parts = 10
+
     def __init__(self, bot: LionBot):
         self.bot = bot
 
@@ -85,6 +87,27 @@ class MemberAdminCog(LionCog):
         """
         return await self.data.past_roles.delete_where(guildid=guildid, userid=userid, roleid=roleid)
 
+    async def give_member_roles(self, member: discord.Member, roles: list[discord.Role],
+                                kind: str, reason: str) -> Optional[str]:
+        """
+        Give the member the given roles through the role mutation scheduler,
+        ahead of any bulk role updates in the guild.
+
+        Waits for the roles to be given, and returns a description of the error if this failed.
+        """
+        key = (member.guild.id, member.id)
+        self._adding_roles.add(key)
+        try:
+            job = await self.bot.core.role_mutations.submit(
+                member.guild.id,
+                (member.id, [role.id for role in roles], ()),
+                kind=kind, reason=reason, priority=0, persist=False
+            )
+            await job.wait()
+        finally:
+            self._adding_roles.discard(key)
+        return job.failures.get(member.id, None)
+
     def data_bucket_req(self, guildid: int):
         bucket = self._data_request_buckets.get(guildid, None)
         if bucket is None:
@@ -133,19 +156,15 @@ class MemberAdminCog(LionCog):
             roles = [role for role in roles if role]
             roles = [role for role in roles if role and role.is_assignable()]
             if roles:
-                try:
-                    self._adding_roles.add((member.guild.id, member.id))
-                    await member.add_roles(*roles, reason="Adding Configured Autoroles")
-                except discord.HTTPException as e:
+                error = await self.give_member_roles(member, roles, 'autoroles', "Adding Configured Autoroles")
+                if error:
                     logger.info(
-                        f"Autoroles failed for <uid:{member.id}> in <gid:{member.guild.id}>: {e.text}"
+                        f"Autoroles failed for <uid:{member.id}> in <gid:{member.guild.id}>: {error}"
                     )
                 else:
                     logger.debug(
                         f"Gave autoroles to <uid:{member.id}> in <gid:{member.guild.id}>"
                     )
-                finally:
-                    self._adding_roles.discard((member.guild.id, member.id))
 
             t = self.bot.translator.t
             ctx_locale.set(lion.lguild.locale)
@@ -202,38 +221,30 @@ class MemberAdminCog(LionCog):
                 roles = [member.guild.get_role(row['roleid']) for row in rows]
                 roles = [role for role in roles if role and role.is_assignable()]
                 if roles:
-                    try:
-                        self._adding_roles.add((member.guild.id, member.id))
-                        await member.add_roles(*roles, reason="Restoring Member Roles")
-                    except discord.HTTPException as e:
+                    error = await self.give_member_roles(member, roles, 'restore_roles', "Restoring Member Roles")
+                    if error:
                         logger.info(
-                            f"Role restore failed for <uid:{member.id}> in <gid:{member.guild.id}>: {e.text}"
+                            f"Role restore failed for <uid:{member.id}> in <gid:{member.guild.id}>: {error}"
                         )
                     else:
                         logger.debug(
                             f"Restored roles to <uid:{member.id}> in <gid:{member.guild.id}>"
                         )
-                    finally:
-                        self._adding_roles.discard((member.guild.id, member.id))
             else:
                 setting = self.settings.BotAutoroles if member.bot else self.settings.Autoroles
                 autoroles = await setting.get(member.guild.id)
                 roles = [member.guild.get_role(role.id) for role in autoroles.value]
                 roles = [role for role in roles if role and role.is_assignable()]
                 if roles:
-                    try:
-                        self._adding_roles.add((member.guild.id, member.id))
-                        await member.add_roles(*roles, reason="Adding Configured Autoroles")
-                    except discord.HTTPException as e:
+                    error = await self.give_member_roles(member, roles, 'autoroles', "Adding Configured Autoroles")
+                    if error:
                         logger.info(
-                            f"Autoroles failed for <uid:{member.id}> in <gid:{member.guild.id}>: {e.text}"
+                            f"Autoroles failed for <uid:{member.id}> in <gid:{member.guild.id}>: {error}"
                         )
                     else:
                         logger.debug(
                             f"Gave autoroles to <uid:{member.id}> in <gid:{member.guild.id}>"
                         )
-                    finally:
-                        self._adding_roles.discard((member.guild.id, member.id))
 
             t = self.bot.translator.t
             ctx_locale.set(lion.lguild.locale)
@@ -434,6 +445,7 @@ class MemberAdminCog(LionCog):
         start=_p('cmd:admin_data|param:start', "after"),
         end=_p('cmd:admin_data|param:end', "before"),
         limit=_p('cmd:admin_data|param:limit', "limit"),
+        fmt=_p('cmd:admin_data|param:format', "format"),
     )
     @appcmds.describe(
         data_type=_p(
@@ -455,7 +467,11 @@ class MemberAdminCog(LionCog):
         limit=_p(
             'cmd:admin_data|param:limit|desc',
             "Maximum number of records to retrieve."
-        )
+        ),
+        fmt=_p(
+            'cmd:admin_data|param:format|desc',
+            "File format of the (gzip compressed) download."
+        ),
     )
     @high_management_ward
     async def cmd_data(self, ctx: LionContext,
@@ -463,7 +479,8 @@ class MemberAdminCog(LionCog):
                        target: Optional[discord.User | discord.Member | discord.Role] = None,
                        start: Optional[str] = None,
                        end: Optional[str] = None,
-                       limit: appcmds.Range[int, 1, 100000] = 1000,
+                       limit: appcmds.Range[int, 1, 1000000] = 1000,
+                       fmt: Transformed[ExportFormat, AppCommandOptionType.string] = ExportFormat.CSV,
                        ):
         if not ctx.guild:
             return
@@ -497,82 +514,132 @@ class MemberAdminCog(LionCog):
             
         # Form query
         if data_type is DownloadableData.VOICE_LEADERBOARD:
-            query = self.bot.core.data.Member.table.select_where()
-            query.select(
-                'guildid',
-                'userid',
-                total_time=RawExpr(
-                    sql.SQL("study_time_between(guildid, userid, %s, %s)"),
-                    (start_time, end_time)
-                )
-            )
-            query.order_by('total_time', ORDER.DESC, NULLS.LAST)
-        elif data_type is DownloadableData.MSG_LEADERBOARD:
-            from tracking.text.data import TextTrackerData as Data
-
-            query = Data.TextSessions.table.select_where()
-            query.select(
-                'guildid',
-                'userid',
-                total_messages="SUM(messages)"
-            )
-            query.where(
-                Data.TextSessions.start_time >= start_time,
-                Data.TextSessions.start_time < end_time,
-            )
-            query.group_by('guildid', 'userid')
-            query.order_by('total_messages', ORDER.DESC, NULLS.LAST)
-        elif data_type is DownloadableData.XP_LEADERBOARD:
             from modules.statistics.data import StatsData as Data
 
-            query = Data.MemberExp.table.select_where()
-            query.select(
-                'guildid',
-                'userid',
-                total_xp="SUM(amount)"
+            # Computed in a single pass over the guild sessions, rather than per member
+            query = Data.VoiceSessionStats.member_totals_query(
+                ctx.guild.id, start_time, end_time,
+                userids=userids or None,
+                limit=limit
             )
-            query.where(
-                Data.MemberExp.earned_at >= start_time,
-                Data.MemberExp.earned_at < end_time,
-            )
-            query.group_by('guildid', 'userid')
-            query.order_by('total_xp', ORDER.DESC, NULLS.LAST)
-        elif data_type is DownloadableData.ROLEMENU_EQUIP:
-            from modules.rolemenus.data import RoleMenuData as Data
-
-            query = Data.RoleMenuHistory.table.select_where().leftjoin('role_menus', using=('menuid',))
-            query.select(
-                guildid=Data.RoleMenu.guildid,
-                userid=Data.RoleMenuHistory.userid,
-                menuid=Data.RoleMenu.menuid,
-                menu_messageid=Data.RoleMenu.messageid,
-                menu_name=Data.RoleMenu.name,
-                equipid=Data.RoleMenuHistory.equipid,
-                roleid=Data.RoleMenuHistory.roleid,
-                obtained_at=Data.RoleMenuHistory.obtained_at,
-                expires_at=Data.RoleMenuHistory.expires_at,
-                removed_at=Data.RoleMenuHistory.removed_at,
-                transactionid=Data.RoleMenuHistory.transactionid,
-            )
-            query.where(
-                Data.RoleMenuHistory.obtained_at >= start_time,
-                Data.RoleMenuHistory.obtained_at < end_time,
-            )
-            query.order_by(Data.RoleMenuHistory.obtained_at, ORDER.DESC)
-        elif data_type is DownloadableData.TRANSACTIONS:
-            raise SafeCancellation("Transaction data is not yet available")
-        elif data_type is DownloadableData.BALANCES:
-            raise SafeCancellation("Member balance data is not yet available")
-        elif data_type is DownloadableData.VOICE_SESSIONS:
-            raise SafeCancellation("Raw voice session data is not yet available")
         else:
-            raise ValueError(f"Unknown data type requested {data_type}")
+            if data_type is DownloadableData.MSG_LEADERBOARD:
+                from tracking.text.data import TextTrackerData as Data
+
+                query = Data.TextSessions.table.select_where()
+                query.select(
+                    'guildid',
+                    'userid',
+                    total_messages="SUM(messages)"
+                )
+                query.where(
+                    Data.TextSessions.start_time >= start_time,
+                    Data.TextSessions.start_time < end_time,
+                )
+                query.group_by('guildid', 'userid')
+                query.order_by('total_messages', ORDER.DESC, NULLS.LAST)
+            elif data_type is DownloadableData.XP_LEADERBOARD:
+                from modules.statistics.data import StatsData as Data
+
+                query = Data.MemberExp.table.select_where()
+                query.select(
+                    'guildid',
+                    'userid',
+                    total_xp="SUM(amount)"
+                )
+                query.where(
+                    Data.MemberExp.earned_at >= start_time,
+                    Data.MemberExp.earned_at < end_time,
+                )
+                query.group_by('guildid', 'userid')
+                query.order_by('total_xp', ORDER.DESC, NULLS.LAST)
+            elif data_type is DownloadableData.ROLEMENU_EQUIP:
+                from modules.rolemenus.data import RoleMenuData as Data
+
+                query = Data.RoleMenuHistory.table.select_where().leftjoin('role_menus', using=('menuid',))
+                query.select(
+                    guildid=Data.RoleMenu.guildid,
+                    userid=Data.RoleMenuHistory.userid,
+                    menuid=Data.RoleMenu.menuid,
+                    menu_messageid=Data.RoleMenu.messageid,
+                    menu_name=Data.RoleMenu.name,
+                    equipid=Data.RoleMenuHistory.equipid,
+                    roleid=Data.RoleMenuHistory.roleid,
+                    obtained_at=Data.RoleMenuHistory.obtained_at,
+                    expires_at=Data.RoleMenuHistory.expires_at,
+                    removed_at=Data.RoleMenuHistory.removed_at,
+                    transactionid=Data.RoleMenuHistory.transactionid,
+                )
+                query.where(
+                    Data.RoleMenuHistory.obtained_at >= start_time,
+                    Data.RoleMenuHistory.obtained_at < end_time,
+                )
+                query.order_by(Data.RoleMenuHistory.obtained_at, ORDER.DESC)
+            elif data_type is DownloadableData.TRANSACTIONS:
+                from modules.economy.data import EconomyData as Data
+
+                query = Data.Transaction.table.select_where()
+                query.select(
+                    'transactionid',
+                    'transactiontype',
+                    'guildid',
+                    'actorid',
+                    'amount',
+                    'bonus',
+                    'from_account',
+                    'to_account',
+                    'refunds',
+                    'created_at',
+                )
+                query.where(
+                    Data.Transaction.created_at >= start_time,
+                    Data.Transaction.created_at < end_time,
+                )
+                if userids:
+                    query.where(
+                        (Data.Transaction.from_account == userids) | (Data.Transaction.to_account == userids)
+                    )
+                query.order_by(Data.Transaction.created_at, ORDER.DESC)
+            elif data_type is DownloadableData.BALANCES:
+                # Current balances, the time window does not apply
+                query = self.bot.core.data.Member.table.select_where()
+                query.select(
+                    'guildid',
+                    'userid',
+                    'coins',
+                )
+                query.order_by('coins', ORDER.DESC, NULLS.LAST)
+            elif data_type is DownloadableData.VOICE_SESSIONS:
+                from tracking.voice.data import VoiceTrackerData as Data
+
+                query = Data.VoiceSessions.table.select_where()
+                query.select(
+                    'sessionid',
+                    'guildid',
+                    'userid',
+                    'channelid',
+                    'rating',
+                    'tag',
+                    'start_time',
+                    'duration',
+                    'live_duration',
+                    'stream_duration',
+                    'video_duration',
+                    'transactionid',
+                )
+                query.where(
+                    Data.VoiceSessions.start_time >= start_time,
+                    Data.VoiceSessions.start_time < end_time,
+                )
+                query.order_by(Data.VoiceSessions.start_time, ORDER.DESC)
+            else:
+                raise ValueError(f"Unknown data type requested {data_type}")
 
-        query.where(guildid=ctx.guild.id)
-        if userids:
-            query.where(userid=userids)
-        query.limit(limit)
-        query.with_no_adapter()
+            query.where(guildid=ctx.guild.id)
+            if userids and data_type is not DownloadableData.TRANSACTIONS:
+                query.where(userid=userids)
+            query.limit(limit)
+            query = query.build()
 
         # Request bucket
         try:
@@ -586,23 +653,43 @@ class MemberAdminCog(LionCog):
                 "Too many requests! Please wait a few minutes before using this command again."
             )))
 
-        # Run query
+        # Stream the results into compressed files
         await ctx.interaction.response.defer(thinking=True)
-        results = await query
-
-        if results:
-            with StringIO() as stream:
-                write_records(results, stream)
-                stream.seek(0)
-                file = discord.File(stream, filename='data.csv')
-                await ctx.reply(file=file)
-        else:
-            await ctx.error_reply(
-                t(_p(
-                    'cmd:admin_data|error:no_results',
-                    "Your query had no results! Try relaxing your filters."
-                ))
-            )
+        export = DataExport(
+            self.bot.db, query, fmt,
+            basename=data_type.name.lower(),
+            size_limit=ctx.guild.filesize_limit,
+            max_parts=self.export_max_parts,
+        )
+        try:
+            await export.run()
+            files = export.files()
+            if files:
+                for i, file in enumerate(files):
+                    content = None
+                    if len(files) > 1:
+                        content = t(_p(
+                            'cmd:admin_data|success:part',
+                            "Part {i} of {n}"
+                        )).format(i=i + 1, n=len(files))
+                    await ctx.reply(content=content, file=file)
+                if export.truncated:
+                    await ctx.reply(
+                        t(_p(
+                            'cmd:admin_data|success:truncated',
+                            "The export was too large to upload in full, and was stopped after {rows} records. "
+                            "Use the `after` and `before` options to download the rest."
+                        )).format(rows=export.rows)
+                    )
+            else:
+                await ctx.error_reply(
+                    t(_p(
+                        'cmd:admin_data|error:no_results',
+                        "Your query had no results! Try relaxing your filters."
+                    ))
+                )
+        finally:
+            export.close()
 
     @cmd_data.autocomplete('start')
     @cmd_data.autocomplete('end')
@@ -0,0 +1,186 @@
+"""
+Streaming data exports for the admin data command.
+
+Rows are read from a server-side cursor and written straight into gzip compressed files,
+so memory use is bounded by the cursor batch and the spool size regardless of the export size.
+Output is split into several files so each fits within the upload limit of the destination guild.
+"""
+from typing import Any, Optional
+from enum import Enum
+from tempfile import SpooledTemporaryFile
+import csv
+import datetime as dt
+import decimal
+import gzip
+import io
+import json
+import uuid
+
+import discord
+
+from data import Database, Expression
+from utils.ui import ChoicedEnum
+
+from . import babel, logger
+
+_p = babel._p
+
+
+class ExportFormat(ChoicedEnum):
+    CSV = _p('cmd:admin_data|param:format|choice:csv', "CSV")
+    JSONL = _p('cmd:admin_data|param:format|choice:jsonl', "JSON Lines")
+
+    @property
+    def choice_name(self):
+        return self.value
+
+    @property
+    def choice_value(self):
+        return self.name
+
+    @property
+    def extension(self):
+        return 'csv.gz' if self is ExportFormat.CSV else 'jsonl.gz'
+
+
+def _plain(value: Any) -> Any:
+    """
+    Convert a database value into a plain value for serialisation.
+    """
+    if isinstance(value, Enum):
+        return value.name
+    if isinstance(value, (dt.datetime, dt.date)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return value
+
+
+class ExportPart:
+    """
+    A single compressed output file of an export.
+    """
+    def __init__(self, fmt: ExportFormat, spool_size: int):
+        self.fmt = fmt
+        self.rows = 0
+        self.file = SpooledTemporaryFile(max_size=spool_size)
+        self._gzip = gzip.GzipFile(fileobj=self.file, mode='wb')
+        self._text = io.TextIOWrapper(self._gzip, encoding='utf-8', newline='')
+        self._csv = csv.writer(self._text) if fmt is ExportFormat.CSV else None
+        self._header_written = False
+
+    @property
+    def size(self) -> int:
+        """
+        Compressed size written so far.
+        Lags the final size by the data buffered in the compressor.
+        """
+        return self.file.tell()
+
+    def write(self, row: dict[str, Any]):
+        if self._csv is not None:
+            if not self._header_written:
+                self._csv.writerow(row.keys())
+                self._header_written = True
+            self._csv.writerow(_plain(value) for value in row.values())
+        else:
+            self._text.write(json.dumps({key: _plain(value) for key, value in row.items()}))
+            self._text.write('\n')
+        self.rows += 1
+
+    def finish(self):
+        # Closing the wrapper flushes the compressor, the spooled file is left open for reading
+        self._text.close()
+        self.file.seek(0)
+
+    def close(self):
+        self.file.close()
+
+
+class DataExport:
+    """
+    Stream the results of a query into a sequence of gzip compressed files.
+
+    Parts are rolled over when their compressed size comes within `margin` bytes of `size_limit`,
+    with the margin covering data still buffered in the compressor.
+    The export stops early, setting `truncated`, once `max_parts` files have been filled.
+    """
+    # Rows fetched from the server-side cursor per round trip
+    itersize = 2000
+    # Compressed bytes kept in memory per part before spilling to disk
+    spool_size = 4 * 1024 * 1024
+    # Headroom kept below the upload limit
+    margin = 512 * 1024
+
+    def __init__(self, connector: Database, query: Expression, fmt: ExportFormat,
+                 basename: str, size_limit: int, max_parts: int = 10):
+        self.connector = connector
+        self.query = query
+        self.fmt = fmt
+        self.basename = basename
+        self.size_limit = max(size_limit - self.margin, self.margin)
+        self.max_parts = max_parts
+
+        self.parts: list[ExportPart] = []
+        self.rows = 0
+        self.truncated = False
+
+    def _new_part(self) -> Optional[ExportPart]:
+        if len(self.parts) >= self.max_parts:
+            self.truncated = True
+            return None
+        part = ExportPart(self.fmt, self.spool_size)
+        self.parts.append(part)
+        return part
+
+    async def run(self):
+        """
+        Execute the query and write the result rows into the export parts.
+        """
+        query, values = self.query.as_tuple()
+        part = self._new_part()
+        try:
+            async with self.connector.connection() as conn:
+                # Server-side cursors only live within a transaction
+                async with conn.transaction():
+                    async with conn.cursor(name=f"export_{uuid.uuid4().hex}") as cursor:
+                        cursor.itersize = self.itersize
+                        await cursor.execute(query, values)
+                        async for row in cursor:
+                            if part.rows and part.size >= self.size_limit:
+                                part.finish()
+                                if (part := self._new_part()) is None:
+                                    break
+                            part.write(row)
+                            self.rows += 1
+            if part is not None:
+                part.finish()
+        except Exception:
+            self.close()
+            raise
+        logger.info(
+            f"Exported {self.rows} rows into {len(self.parts)} {self.fmt.name} parts "
+            f"({'truncated' if self.truncated else 'complete'})."
+        )
+
+    def files(self) -> list[discord.File]:
+        """
+        The completed export parts as uploadable files.
+        Empty if the query had no results.
+        """
+        if not self.rows:
+            return []
+        if len(self.parts) == 1:
+            names = [f"{self.basename}.{self.fmt.extension}"]
+        else:
+            names = [f"{self.basename}-{i:02}.{self.fmt.extension}" for i in range(1, len(self.parts) + 1)]
+        return [
+            discord.File(part.file, filename=name)
+            for part, name in zip(self.parts, names)
+            if part.rows
+        ]
+
+    def close(self):
+        for part in self.parts:
+            part.close()
+        self.parts.clear()
@@ -1,6 +1,7 @@
 from typing import Optional
 import asyncio
 import datetime
+from collections import defaultdict
 from weakref import WeakValueDictionary
 
 import discord
@@ -15,7 +16,6 @@ from wards import high_management_ward, high_management_iward
 from core.data import RankType
 from utils.ui import ChoicedEnum, Transformed
 from utils.lib import utc_now, replace_multiple
-from utils.ratelimits import Bucket, limit_concurrency
 from utils.data import TemporaryTable
 from modules.economy.cog import Economy
 from modules.economy.data import TransactionType
@@ -23,6 +23,7 @@ from modules.economy.data import TransactionType
 
 from . import babel, logger
 from .data import RankData, AnyRankData
+from .engine import RankEngine, RankLadder, SeasonTotals
 from .settings import RankSettings
 from .ui import RankOverviewUI, RankConfigUI, RankRefreshUI
 from .utils import rank_model_from_type, format_stat_range
@@ -122,8 +123,8 @@ class RankCog(LionCog):
         self.data = bot.db.load_registry(RankData())
         self.settings = RankSettings()
 
-        # Cached guild ranks for all current guilds. guildid -> list[Rank]
-        self._guild_ranks = {}
+        # Rank ladders and member season totals of the current guilds
+        self.engine = RankEngine()
         # Cached member SeasonRanks for recently active members
         # guildid -> userid -> SeasonRank
         # pop the guild whenever the season is updated or the rank type changes.
@@ -154,6 +155,7 @@ class RankCog(LionCog):
     @LionCog.listener('on_guildset_season_start')
     async def handle_season_start(self, guildid, setting):
         self._member_ranks.pop(guildid, None)
+        self.engine.totals.pop(guildid, None)
 
     # guild_leave event handler.. removes the guild from _guild_ranks and clears the season cache
     @LionCog.listener('on_guildset_rank_type')
@@ -206,69 +208,199 @@ class RankCog(LionCog):
             # Fetch season rank anew
             lguild = await self.bot.core.lions.fetch_guild(guildid)
             rank_type = lguild.config.get('rank_type').value
+            totals = self.engine.totals_for(guildid, rank_type, lguild.config.get('season_start').value)
             # TODO: Benchmark alltime efficiency
             season_start = lguild.config.get('season_start').value or datetime.datetime(1970, 1, 1)
             stat_data = self.bot.get_cog('StatsCog').data
             text_data = self.bot.get_cog('TextTrackerCog').data
             member_row = await self.data.MemberRank.fetch_or_create(guildid, userid)
-            if rank_type is RankType.VOICE:
+            ladder = await self.get_rank_ladder(guildid)
+            if totals is not None:
+                # Season totals are already loaded for this guild
+                stat = totals.get(userid)
+            elif rank_type is RankType.VOICE:
                 model = stat_data.VoiceSessionStats
                 # TODO: Should probably only used saved sessions here...
                 stat = (await model.study_times_since(guildid, userid, season_start))[0]
-                if rankid := member_row.current_voice_rankid:
-                    current_rank = await self.data.VoiceRank.fetch(rankid)
-                else:
-                    current_rank = None
             elif rank_type is RankType.XP:
                 model = stat_data.MemberExp
                 stat = (await model.xp_since(guildid, userid, season_start))[0]
-                if rankid := member_row.current_xp_rankid:
-                    current_rank = await self.data.XPRank.fetch(rankid)
-                else:
-                    current_rank = None
             elif rank_type is RankType.MESSAGE:
                 model = text_data.TextSessions
                 stat = (await model.member_messages_since(guildid, userid, season_start))[0]
-                if rankid := member_row.current_msg_rankid:
-                    current_rank = await self.data.MsgRank.fetch(rankid)
-                else:
-                    current_rank = None
 
-            ranks = await self.get_guild_ranks(guildid)
-            next_rank = None
-            current = current_rank.required if current_rank is not None else 0
-            next_rank = next((rank for rank in ranks if rank.required > current), None)
-            season_rank = SeasonRank(guildid, userid, current_rank, next_rank, rank_type, stat, member_row)
+            season_rank = self._make_season_rank(guildid, userid, rank_type, ladder, stat, member_row)
             member_cache[userid] = season_rank
         return season_rank
 
-    async def get_guild_ranks(self, guildid: int, refresh=False) -> list[AnyRankData]:
+    def _make_season_rank(self, guildid, userid, rank_type, ladder: RankLadder, stat, member_row) -> SeasonRank:
+        rankid = member_row[self._get_rankid_column(rank_type)] if member_row is not None else None
+        current_rank = ladder.by_id.get(rankid, None) if rankid else None
+        current = current_rank.required if current_rank is not None else 0
+        next_rank = ladder.next_above(current)
+        return SeasonRank(guildid, userid, current_rank, next_rank, rank_type, stat, member_row)
+
+    async def get_rank_ladder(self, guildid: int, refresh=False) -> RankLadder:
         """
-        Get the list of ranks of the correct type in the current guild.
+        Get the RankLadder of ranks of the correct type in the current guild.
 
         Hits cache where possible, unless `refresh` is set.
         """
         # TODO: Fill guild rank caches on cog_load
-        if refresh or (ranks := self._guild_ranks.get(guildid, None)) is None:
+        if refresh or (ladder := self.engine.ladders.get(guildid, None)) is None:
             lguild = await self.bot.core.lions.fetch_guild(guildid)
             rank_type = lguild.config.get('rank_type').value
             rank_model = rank_model_from_type(rank_type)
             ranks = await rank_model.fetch_where(guildid=guildid).order_by('required')
-            self._guild_ranks[guildid] = ranks
-        return ranks
+            ladder = self.engine.ladders[guildid] = RankLadder(ranks)
+        return ladder
+
+    async def get_guild_ranks(self, guildid: int, refresh=False) -> list[AnyRankData]:
+        """
+        Get the list of ranks of the correct type in the current guild.
+
+        Hits cache where possible, unless `refresh` is set.
+        """
+        return (await self.get_rank_ladder(guildid, refresh=refresh)).ranks
+
+    async def get_season_totals(self, guildid: int) -> SeasonTotals:
+        """
+        Get the season stat totals of the members of the given guild.
+
+        Seeds the totals from the guild leaderboard if they are not loaded,
+        or were loaded for a different rank type or season.
+        """
+        lguild = await self.bot.core.lions.fetch_guild(guildid)
+        rank_type = lguild.config.get('rank_type').value
+        season_start = lguild.config.get('season_start').value
+        if (totals := self.engine.totals_for(guildid, rank_type, season_start)) is None:
+            stats_model = self._get_stats_model(rank_type)
+            if season_start:
+                leaderboard = await stats_model.leaderboard_since(guildid, season_start)
+            else:
+                leaderboard = await stats_model.leaderboard_all(guildid)
+            # Taken after the query, so sessions completing during it are never counted twice
+            totals = SeasonTotals(rank_type, season_start, utc_now(), dict(leaderboard))
+            self.engine.seed(guildid, totals)
+            logger.debug(
+                f"Seeded season totals for {len(totals)} members in <gid:{guildid}>."
+            )
+        return totals
 
     def flush_guild_ranks(self, guildid: int):
         """
         Clear the caches for the given guild.
         """
-        self._guild_ranks.pop(guildid, None)
+        self.engine.ladders.pop(guildid, None)
         self._member_ranks.pop(guildid, None)
 
+    async def _load_season_ranks(self, guildid: int, rank_type: RankType,
+                                 ladder: RankLadder, totals: SeasonTotals,
+                                 userids: list[int]) -> dict[int, SeasonRank]:
+        """
+        Build SeasonRanks for the given members from the season totals,
+        fetching their MemberRank rows in a single query.
+
+        MemberRank rows are not created here, see `_create_rank_rows`.
+        """
+        rows = await self.data.MemberRank.fetch_where(guildid=guildid, userid=userids)
+        rowmap = {row.userid: row for row in rows}
+        member_cache = self._get_member_cache(guildid)
+        season_ranks = {}
+        for userid in userids:
+            season_rank = self._make_season_rank(
+                guildid, userid, rank_type, ladder, totals.get(userid), rowmap.get(userid, None)
+            )
+            season_ranks[userid] = member_cache[userid] = season_rank
+        return season_ranks
+
+    async def _create_rank_rows(self, guildid: int, season_ranks: list[SeasonRank]):
+        """
+        Create the missing MemberRank rows of the given SeasonRanks in bulk.
+        """
+        missing = [season_rank for season_rank in season_ranks if season_rank.rankrow is None]
+        if missing:
+            rows = await self.data.MemberRank.table.insert_many(
+                ('guildid', 'userid'),
+                *((guildid, season_rank.userid) for season_rank in missing)
+            ).with_adapter(self.data.MemberRank._make_rows)
+            rowmap = {row.userid: row for row in rows}
+            for season_rank in missing:
+                season_rank.rankrow = rowmap[season_rank.userid]
+
+    def _roles_current(self, member: discord.Member, season_rank: SeasonRank, ladder: RankLadder) -> bool:
+        """
+        Whether the member's rank roles already match their current rank.
+        """
+        current_roleid = season_rank.current_rank.roleid if season_rank.current_rank else None
+        rank_roleids = set(ladder.roleids)
+        if season_rank.rankrow is not None and season_rank.rankrow.last_roleid:
+            rank_roleids.add(season_rank.rankrow.last_roleid)
+        has_current = current_roleid is None or member.get_role(current_roleid) is not None
+        return has_current and not any(
+            role.id in rank_roleids and role.id != current_roleid for role in member.roles
+        )
+
+    async def _evaluate_ranks(self, guildid: int, rank_type: RankType,
+                              ladder: RankLadder, totals: SeasonTotals, userids: list[int]):
+        """
+        Evaluate the ranks of a batch of members against their season totals.
+
+        Rank updates are only run for members whose rank increased,
+        and role checks only for members whose rank roles do not match their rank.
+        Should be called with the guild rank lock held.
+        """
+        guild = self.bot.get_guild(guildid)
+        if guild is None:
+            return
+        member_cache = self._get_member_cache(guildid)
+        season_ranks = {userid: member_cache[userid] for userid in userids if userid in member_cache}
+        if missing := [userid for userid in userids if userid not in season_ranks]:
+            season_ranks.update(await self._load_season_ranks(guildid, rank_type, ladder, totals, missing))
+
+        to_update = []
+        to_check = []
+        for userid, season_rank in season_ranks.items():
+            season_rank.stat = totals.get(userid)
+            new_rank = ladder.rank_for(season_rank.stat)
+            current = season_rank.current_rank
+            if new_rank is not None and (current is None or new_rank.required > current.required):
+                to_update.append(season_rank)
+            elif (member := guild.get_member(userid)) is not None and not self._roles_current(member, season_rank, ladder):
+                to_check.append(season_rank)
+
+        self.engine.evaluated += len(season_ranks)
+        self.engine.changed += len(to_update)
+        if to_update or to_check:
+            await self._create_rank_rows(guildid, to_update + to_check)
+            tasks = [
+                *(asyncio.create_task(self.update_rank(season_rank), name='rank-update') for season_rank in to_update),
+                *(asyncio.create_task(self._role_check(season_rank), name='rank-role-check') for season_rank in to_check),
+            ]
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(result, Exception):
+                    logger.error(
+                        f"Unexpected exception updating member ranks in <gid:{guildid}>.",
+                        exc_info=result
+                    )
+        logger.debug(
+            f"Evaluated {len(season_ranks)} member ranks in <gid:{guildid}>, "
+            f"with {len(to_update)} rank updates and {len(to_check)} role checks. "
+            f"Engine: {self.engine.summary()}"
+        )
+
+    @log_wrap(action="Message Rank Hook")
     async def on_message_session_complete(self, *session_data):
         """
         Handle batch of completed message sessions.
         """
+        # The sessions were saved before the hook was called
+        end = utc_now()
+        guild_sessions = defaultdict(list)
         for guildid, userid, messages, guild_xp in session_data:
+            guild_sessions[guildid].append((userid, messages, guild_xp))
+
+        for guildid, sessions in guild_sessions.items():
             if not self.bot.get_guild(guildid):
                 # Ignore guilds we have left
                 continue
@@ -276,17 +408,17 @@ class RankCog(LionCog):
             rank_type = lguild.config.get('rank_type').value
             if rank_type in (RankType.MESSAGE, RankType.XP):
                 async with self.ranklock(guildid):
-                    if (_members := self._member_ranks.get(guildid, None)) is not None and userid in _members:
-                        session_rank = _members[userid]
-                        session_rank.stat += messages if (rank_type is RankType.MESSAGE) else guild_xp
-                    else:
-                        session_rank = await self.get_member_rank(guildid, userid)
-
-                    if session_rank.next_rank is not None and session_rank.stat > session_rank.next_rank.required:
-                        task = asyncio.create_task(self.update_rank(session_rank), name='update-message-rank')
-                    else:
-                        task = asyncio.create_task(self._role_check(session_rank), name='rank-role-check')
-                    await task
+                    ladder = await self.get_rank_ladder(guildid)
+                    if not ladder:
+                        # No ranks to evaluate, and totals would go stale
+                        self.engine.totals.pop(guildid, None)
+                        continue
+                    totals = await self.get_season_totals(guildid)
+                    for userid, messages, guild_xp in sessions:
+                        totals.add(userid, messages if (rank_type is RankType.MESSAGE) else guild_xp, end)
+                    await self._evaluate_ranks(
+                        guildid, rank_type, ladder, totals, list(set(userid for userid, *_ in sessions))
+                    )
 
     async def _role_check(self, session_rank: SeasonRank):
         """
@@ -411,13 +543,9 @@ class RankCog(LionCog):
 
         lguild = await self.bot.core.lions.fetch_guild(guildid)
         rank_type = lguild.config.get('rank_type').value
-        ranks = await self.get_guild_ranks(guildid)
-        new_rank = None
-        for rank in ranks:
-            if rank.required <= session_rank.stat:
-                new_rank = rank
-            else:
-                break
+        ladder = await self.get_rank_ladder(guildid)
+        ranks = ladder.ranks
+        new_rank = ladder.rank_for(session_rank.stat)
 
         if new_rank is None or new_rank is session_rank.current_rank:
             return
@@ -525,7 +653,7 @@ class RankCog(LionCog):
 
         # Update SessionRank info
         session_rank.current_rank = new_rank
-        session_rank.next_rank = next((rank for rank in ranks if rank.required > new_rank.required), None)
+        session_rank.next_rank = ladder.next_above(new_rank.required)
 
         # Provide economy reward if required
         if new_rank.reward:
@@ -634,36 +762,43 @@ class RankCog(LionCog):
 
     @log_wrap(action="Voice Rank Hook")
     async def on_voice_session_complete(self, *session_data):
-        for guildid, userid, duration, guild_xp in session_data:
-            if not self.bot.get_guild(guildid):
+        """
+        Handle batch of completed voice sessions,
+        given as (guildid, userid, duration, guild_xp, end_time) tuples.
+        """
+        guild_sessions = defaultdict(list)
+        for guildid, userid, duration, guild_xp, end_time in session_data:
+            guild_sessions[guildid].append((userid, duration, end_time))
+
+        # Load the unranked roles of every guild in the batch together
+        await self.bot.get_cog('StatsCog').settings.UnrankedRoles.read_many(*guild_sessions)
+        for guildid, sessions in guild_sessions.items():
+            guild = self.bot.get_guild(guildid)
+            if not guild:
                 # Ignore guilds we have left
                 continue
             lguild = await self.bot.core.lions.fetch_guild(guildid)
+            rank_type = lguild.config.get('rank_type').value
+            if rank_type not in (RankType.VOICE,):
+                continue
             unranked_role_setting = await self.bot.get_cog('StatsCog').settings.UnrankedRoles.get(guildid)
             unranked_roleids = set(unranked_role_setting.data)
-            guild = self.bot.get_guild(guildid)
-            member = guild.get_member(userid) if guild else None
-            if not member or member.bot or any (role.id in unranked_roleids for role in member.roles):
-                continue
-            rank_type = lguild.config.get('rank_type').value
-            if rank_type in (RankType.VOICE,):
-                async with self.ranklock(guildid):
-                    if (_members := self._member_ranks.get(guildid, None)) is not None and userid in _members:
-                        session_rank = _members[userid]
-                        # TODO: Temporary measure
-                        season_start = lguild.config.get('season_start').value or datetime.datetime(1970, 1, 1)
-                        stat_data = self.bot.get_cog('StatsCog').data
-                        session_rank.stat = (await stat_data.VoiceSessionStats.study_times_since(
-                            guildid, userid, season_start)
-                        )[0]
-                        # session_rank.stat += duration if (rank_type is RankType.VOICE) else guild_xp
-                    else:
-                        session_rank = await self.get_member_rank(guildid, userid)
-
-                    if session_rank.next_rank is not None and session_rank.stat > session_rank.next_rank.required:
-                        task = asyncio.create_task(self.update_rank(session_rank), name='voice-rank-update')
-                    else:
-                        task = asyncio.create_task(self._role_check(session_rank), name='voice-role-check')
+            async with self.ranklock(guildid):
+                ladder = await self.get_rank_ladder(guildid)
+                if not ladder:
+                    # No ranks to evaluate, and totals would go stale
+                    self.engine.totals.pop(guildid, None)
+                    continue
+                totals = await self.get_season_totals(guildid)
+                userids = set()
+                for userid, duration, end_time in sessions:
+                    # Unranked members still accumulate season stats
+                    totals.add_duration(userid, duration, end_time)
+                    member = guild.get_member(userid)
+                    if member and not member.bot and not any(role.id in unranked_roleids for role in member.roles):
+                        userids.add(userid)
+                if userids:
+                    await self._evaluate_ranks(guildid, rank_type, ladder, totals, list(userids))
 
     async def on_xp_update(self, *xp_data):
         # Currently no-op since xp is given purely by message stats
@@ -683,7 +818,8 @@ class RankCog(LionCog):
         ui.start()
 
         # Retrieve fresh rank roles
-        ranks = await self.get_guild_ranks(guild.id, refresh=True)
+        ladder = await self.get_rank_ladder(guild.id, refresh=True)
+        ranks = ladder.ranks
         ui.stage_ranks = True
         ui.poke()
 
@@ -735,6 +871,8 @@ class RankCog(LionCog):
             leaderboard = await stats_model.leaderboard_since(guild.id, season_start)
         else:
             leaderboard = await stats_model.leaderboard_all(guild.id)
+        # The leaderboard also serves as fresh season totals
+        self.engine.seed(guild.id, SeasonTotals(rank_type, season_start, utc_now(), dict(leaderboard)))
 
         # Compile map of correct ranks
         # Filtering out members who are untracked or not in server
@@ -747,7 +885,7 @@ class RankCog(LionCog):
                 # Check member does not have unranked roles
                 if not (member.bot or any(role.id in unranked_roleids for role in member.roles)):
                     # Compute member rank
-                    rank = next((rank for rank in reversed(ranks) if rank.required <= stat_total), None)
+                    rank = ladder.rank_for(stat_total)
                     if rank is not None:
                         true_member_ranks[userid] = rank
 
@@ -777,81 +915,8 @@ class RankCog(LionCog):
         ui.to_add = len(to_add)
         ui.poke()
 
-        # Perform operations
-        # Starting with removals
-        coros = []
-        bucket = Bucket(4, 5)
-
-        for member, roles in to_remove:
-            remove_coro = member.remove_roles(
-                *roles,
-                reason=t(_p(
-                    'rank_refresh|remove_roles|audit',
-                    "Removing invalid rank role."
-                ))
-            )
-            coros.append(bucket.wrapped(remove_coro))
-
-        index = 0
-        async for task in limit_concurrency(coros, 5):
-            try:
-                await task
-                index += 1
-                ui.poke()
-            except discord.HTTPException:
-                error = t(_p(
-                    'rank_refresh|remove_roles|small_error',
-                    "*Could not remove ranks from {member}*"
-                )).format(member=to_remove[index][0].mention)
-                ui.errors.append(error)
-                if len(ui.errors) > 10:
-                    await ui.set_error(
-                        t(_p(
-                            'rank_refresh|remove_roles|error:too_many_issues',
-                            "Too many issues occurred while removing ranks! "
-                            "Please check my permissions and try again in a few minutes."
-                        ))
-                    )
-                    return
-            ui.removed += 1
-            ui.poke()
-
-        coros = []
-        for member, role in to_add:
-            add_coro = member.add_roles(
-                role,
-                reason=t(_p(
-                    'rank_refresh|add_roles|audit',
-                    "Adding rank role from refresh"
-                ))
-            )
-            coros.append(bucket.wrapped(add_coro))
-
-        index = 0
-        async for task in limit_concurrency(coros, 5):
-            try:
-                await task
-                index += 1
-                ui.poke()
-            except discord.HTTPException:
-                error = t(_p(
-                    'rank_refresh|add_roles|small_error',
-                    "*Could not add {role} to {member}*"
-                )).format(member=to_add[index][0].mention, role=to_add[index][1].mention)
-                ui.errors.append(error)
-                if len(ui.errors) > 10:
-                    await ui.set_error(
-                        t(_p(
-                            'rank_refresh|add_roles|error:too_many_issues',
-                            "Too many issues occurred while adding ranks! "
-                            "Please check my permissions and try again in a few minutes."
-                        ))
-                    )
-                    return
-            ui.added += 1
-            ui.poke()
-
         # Save correct member ranks and given roles to data
+        # This is done first, since the role updates may be resumed after a restart
         # First clear the member rank data entirely
         await self.data.MemberRank.table.delete_where(guildid=guild.id)
         if true_member_ranks:
@@ -865,6 +930,41 @@ class RankCog(LionCog):
                 *values
             )
         self.flush_guild_ranks(guild.id)
+
+        # Perform operations
+        # Removals and additions for the same member are merged into a single edit
+        job = await self.bot.core.role_mutations.submit(
+            guild.id,
+            *((member.id, (), [role.id for role in roles]) for member, roles in to_remove),
+            *((member.id, (role.id,), ()) for member, role in to_add),
+            kind='rank_refresh',
+            reason=t(_p(
+                'rank_refresh|edit_roles|audit',
+                "Refreshing member rank roles."
+            )),
+            max_failures=10,
+        )
+        ui.job = job
+        job.add_listener(ui.poke)
+        await job.wait()
+
+        failures = job.failures
+        ui.removed = sum(1 for member, _ in to_remove if member.id not in failures)
+        ui.added = sum(1 for member, _ in to_add if member.id not in failures)
+        for userid in list(failures)[:10]:
+            ui.errors.append(t(_p(
+                'rank_refresh|edit_roles|small_error',
+                "*Could not update the rank roles of {member}*"
+            )).format(member=f"<@{userid}>"))
+        if job.aborted:
+            await ui.set_error(
+                t(_p(
+                    'rank_refresh|edit_roles|error:too_many_issues',
+                    "Too many issues occurred while updating ranks! "
+                    "Please check my permissions and try again in a few minutes."
+                ))
+            )
+            return
         await ui.set_done()
 
         # Event log
@@ -0,0 +1,133 @@
+from typing import Optional, Iterable
+from bisect import bisect_right
+import datetime as dt
+
+from core.data import RankType
+
+from .data import AnyRankData
+
+
+class RankLadder:
+    """
+    The activity ranks of a single guild, ordered by required stat.
+
+    Rank thresholds are stored as a sorted array,
+    so the rank for a given stat is found by bisection instead of a scan.
+    """
+    __slots__ = ('ranks', 'thresholds', 'by_id', 'roleids')
+
+    def __init__(self, ranks: Iterable[AnyRankData]):
+        self.ranks: list[AnyRankData] = sorted(ranks, key=lambda rank: rank.required)
+        self.thresholds: list[int] = [rank.required for rank in self.ranks]
+        self.by_id: dict[int, AnyRankData] = {rank.rankid: rank for rank in self.ranks}
+        self.roleids: set[int] = {rank.roleid for rank in self.ranks}
+
+    def __len__(self):
+        return len(self.ranks)
+
+    def rank_for(self, stat: int) -> Optional[AnyRankData]:
+        """
+        The highest rank whose requirement is met by the given stat.
+        """
+        index = bisect_right(self.thresholds, stat)
+        return self.ranks[index - 1] if index else None
+
+    def next_above(self, required: int) -> Optional[AnyRankData]:
+        """
+        The lowest rank with requirement strictly greater than `required`.
+        """
+        index = bisect_right(self.thresholds, required)
+        return self.ranks[index] if index < len(self.ranks) else None
+
+
+class SeasonTotals:
+    """
+    Season stat totals for the members of a single guild.
+
+    Seeded in bulk from the guild leaderboard at `loaded_at`,
+    and kept current afterwards by adding the stats of completed sessions.
+    Sessions which completed before the totals were loaded are already included in the seed.
+    """
+    __slots__ = ('rank_type', 'season_start', 'loaded_at', 'totals')
+
+    def __init__(self, rank_type: RankType, season_start: Optional[dt.datetime],
+                 loaded_at: dt.datetime, totals: dict[int, int]):
+        self.rank_type = rank_type
+        self.season_start = season_start
+        self.loaded_at = loaded_at
+        self.totals = totals
+
+    def __len__(self):
+        return len(self.totals)
+
+    def get(self, userid: int) -> int:
+        return self.totals.get(userid, 0)
+
+    def add(self, userid: int, amount: int, end: dt.datetime):
+        """
+        Add the stat of a session which completed at `end`.
+        """
+        if end > self.loaded_at and amount > 0:
+            self.totals[userid] = self.totals.get(userid, 0) + amount
+
+    def add_duration(self, userid: int, duration: int, end: dt.datetime):
+        """
+        Add the duration of a voice session which completed at `end`.
+
+        Only counts the part of the session after the totals were loaded and the season started,
+        since ongoing sessions are included in the seed up to the time it was loaded.
+        """
+        counted_from = self.loaded_at
+        if self.season_start is not None:
+            counted_from = max(counted_from, self.season_start)
+        amount = min(duration, int((end - counted_from).total_seconds()))
+        if amount > 0:
+            self.totals[userid] = self.totals.get(userid, 0) + amount
+
+
+class RankEngine:
+    """
+    In-memory rank state for the current guilds.
+
+    Holds the rank ladder and the member season totals of each guild,
+    so that batches of completed sessions may be evaluated without querying member statistics.
+    """
+    def __init__(self):
+        # guildid -> RankLadder
+        self.ladders: dict[int, RankLadder] = {}
+        # guildid -> SeasonTotals
+        self.totals: dict[int, SeasonTotals] = {}
+
+        self.seeded = 0
+        self.evaluated = 0
+        self.changed = 0
+
+    def totals_for(self, guildid: int,
+                   rank_type: RankType, season_start: Optional[dt.datetime]) -> Optional[SeasonTotals]:
+        """
+        The loaded season totals of the given guild,
+        or None if they were not loaded or were loaded for a different rank type or season.
+        """
+        totals = self.totals.get(guildid, None)
+        if totals is not None and (totals.rank_type is not rank_type or totals.season_start != season_start):
+            self.totals.pop(guildid, None)
+            totals = None
+        return totals
+
+    def seed(self, guildid: int, totals: SeasonTotals):
+        self.totals[guildid] = totals
+        self.seeded += 1
+
+    def flush(self, guildid: int):
+        """
+        Forget the rank ladder and season totals of the given guild.
+        """
+        self.ladders.pop(guildid, None)
+        self.totals.pop(guildid, None)
+
+    def summary(self) -> str:
+        return (
+            f"ladders={len(self.ladders)} guilds={len(self.totals)} "
+            f"members={sum(len(totals) for totals in self.totals.values())} "
+            f"seeded={self.seeded} evaluated={self.evaluated} changed={self.changed}"
+        )
@@ -6,6 +6,7 @@ from discord.ui.select import select, Select, SelectOption, RoleSelect
 from discord.ui.button import button, Button, ButtonStyle
 
 from meta import conf, LionBot
+from core.roles import RoleJob
 from meta.logger import log_wrap
 from core.data import RankType
 from data import ORDER
@@ -42,6 +43,9 @@ class RankRefreshUI(MessageUI):
         self.removed = 0
         self.added = 0
 
+        # Role mutation job applying the role changes, once scheduled
+        self.job: Optional[RoleJob] = None
+
         self.error: Optional[str] = None
         self.done = False
 
@@ -198,7 +202,34 @@ class RankRefreshUI(MessageUI):
             lines.append(text)
             stop_here = not bool(stage)
 
-        if not stop_here:
+        job = self.job
+        if not stop_here and job is not None and not job.finished and not errored:
+            # Role changes are being applied, show the overall progress and estimated completion
+            lines.append("")
+            eta = job.eta()
+            if eta is not None:
+                eta_str = discord.utils.format_dt(utc_now() + eta, 'R')
+            else:
+                eta_str = t(_p(
+                    'ui:refresh_ranks|embed|field:update|eta:unknown',
+                    "Calculating..."
+                ))
+            name = t(_p(
+                'ui:refresh_ranks|embed|field:update|name',
+                "Updating member rank roles"
+            ))
+            value = t(_p(
+                'ui:refresh_ranks|embed|field:update|value',
+                "{progress} {done}/{total} members updated\n"
+                "Estimated completion: {eta}"
+            )).format(
+                progress=self.progress_bar(job.processed, 0, max(job.total, 1)),
+                done=job.processed,
+                total=job.total,
+                eta=eta_str,
+            )
+            embed.add_field(name=name, value=value, inline=False)
+        elif not stop_here:
             lines.append("")
             if self.to_remove > self.removed and not errored:
                 # Still have members to remove, show loading bar
@@ -25,6 +25,7 @@ from data.queries import ORDER
 from meta import LionBot, LionCog, LionContext
 from meta.errors import UserInputError
 from meta.app import shard_talk, appname_from_shard
+from meta.ipc import SchemaCodec
 from meta.logger import log_wrap, set_logging_context
 
 from babel import ctx_translator, ctx_locale
@@ -63,9 +64,9 @@ class Reminders(LionCog):
         else:
             self.monitor = None
 
-        self.talk_reload = shard_talk.register_route('reload_reminders')(self.reload_reminders)
-        self.talk_schedule = shard_talk.register_route('schedule_reminders')(self.schedule_reminders)
-        self.talk_cancel = shard_talk.register_route('cancel_reminders')(self.cancel_reminders)
+        self.talk_reload = shard_talk.register_route('reload_reminders', codec=SchemaCodec())(self.reload_reminders)
+        self.talk_schedule = shard_talk.register_route('schedule_reminders', codec=SchemaCodec(varargs=int))(self.schedule_reminders)
+        self.talk_cancel = shard_talk.register_route('cancel_reminders', codec=SchemaCodec(varargs=int))(self.cancel_reminders)
 
         # Short term userid -> list[Reminder] cache, mainly for autocomplete
         self._user_reminder_cache: TTLCache[int, list[ReminderData.Reminder]] = TTLCache(1000, ttl=60)
@@ -134,7 +134,10 @@ class TimeSlot:
         config_data = await self.data.ScheduleGuild.fetch_multiple(*guildids)
 
         # Fetch channel data. This *should* hit cache if initialisation did its job
-        channel_settings = {guildid: await ScheduleSettings.SessionChannels.get(guildid) for guildid in guildids}
+        channel_data = await ScheduleSettings.SessionChannels.read_many(*guildids)
+        channel_settings = {
+            guildid: ScheduleSettings.SessionChannels(guildid, channel_data[guildid]) for guildid in guildids
+        }
 
         # Data fetch all member schedules with this slotid
         members = await self.data.ScheduleSessionMember.fetch_where(
@@ -5,7 +5,7 @@ from itertools import chain
 from psycopg import sql
 
 from meta.logger import log_wrap
-from data import RowModel, Registry, Table, RegisterEnum
+from data import RowModel, Registry, Table, RegisterEnum, RawExpr
 from data.columns import Integer, String, Timestamp, Bool, Column
 
 from utils.lib import utc_now
@@ -61,8 +61,8 @@ class StatsData(Registry):
             guildid,
             start_time,
             duration,
-            (timezone('UTC', start_time) + duration * interval '1 second') AS end_time
-          FROM session_history
+            (start_time + duration * interval '1 second') AS end_time
+          FROM voice_sessions
           UNION ALL
           SELECT
             userid,
@@ -70,7 +70,19 @@ class StatsData(Registry):
             start_time,
             EXTRACT(EPOCH FROM (NOW() - start_time)) AS duration,
             NOW() AS end_time
-          FROM current_sessions;
+          FROM voice_sessions_ongoing
+          UNION ALL
+          SELECT
+            userid,
+            guildid,
+            day::TIMESTAMP AT TIME ZONE 'UTC' AS start_time,
+            duration,
+            (day::TIMESTAMP AT TIME ZONE 'UTC') + duration * interval '1 second' AS end_time
+          FROM voice_session_days;
+
+        Sessions older than the compaction horizon are kept as daily totals in `voice_session_days`,
+        and appear here as a single session starting at UTC midnight.
+        Totals are exact, but time within a compacted day is only resolved to the day.
         """
         _tablename_ = "voice_sessions_combined"
 
@@ -193,62 +205,108 @@ class StatsData(Registry):
                     return [r['stime'] or 0 for r in await cursor.fetchall()]
 
         @classmethod
-        @log_wrap(action='leaderboard_since')
-        async def leaderboard_since(cls, guildid: int, since):
+        def _totals_between_query(cls, userids: Optional[Iterable[int]] = None) -> sql.Composable:
             """
-            Return the voice totals since the given time for each member in the guild.
+            Voice time of each member of a guild within a window, in a single pass over the sessions.
+
+            Sessions are clipped to the window and summed per member.
+            A member's sessions in a single guild never overlap,
+            so this agrees with `study_time_between` for each member.
+            Takes the arguments (end, start, guildid, end, start[, userids]).
             """
-            # Retrieve sum of all sessions (incl. ongoing) ending after given time
-            first_query = sql.SQL(
+            return sql.SQL(
                 """
                 SELECT
                     userid,
-                    sum(duration) as total_duration
+                    SUM(EXTRACT(EPOCH FROM (LEAST(end_time, %s) - GREATEST(start_time, %s)))) AS total_time
                 FROM voice_sessions_combined
                 WHERE
                     guildid = %s
-                    AND
-                    end_time > %s
+                    AND start_time < %s
+                    AND end_time > %s
+                    {}
                 GROUP BY userid
-                ORDER BY total_duration DESC
                 """
+            ).format(
+                sql.SQL("AND userid = ANY(%s)") if userids is not None else sql.SQL('')
             )
-            first_query_args = (guildid, since)
 
-            # Retrieve how much we "overshoot", from sessions which intersect the given time
-            second_query = sql.SQL(
+        @classmethod
+        @log_wrap(action='leaderboard_between')
+        async def leaderboard_between(cls, guildid: int, start, end) -> list[tuple[int, int]]:
+            """
+            Return the voice totals between the given times for each member in the guild,
+            as a list of (userid, total) pairs in descending order of total.
+            Members with no voice time in the window are omitted.
+            """
+            query = sql.SQL("{} ORDER BY total_time DESC").format(cls._totals_between_query())
+            async with cls._connector.connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(query, (end, start, guildid, end, start))
+                    return [
+                        (row['userid'], int(row['total_time']))
+                        for row in await cursor.fetchall()
+                    ]
+
+        @classmethod
+        def member_totals_query(cls, guildid: int, start, end,
+                                userids: Optional[list[int]] = None,
+                                limit: Optional[int] = None) -> RawExpr:
+            """
+            Query for rows of (guildid, userid, total_time) for every member of the guild,
+            optionally restricted to the given users, in descending order of voice time between the given times.
+            Members with no voice time in the window have a NULL total.
+            """
+            query = sql.SQL(
                 """
                 SELECT
-                    SUM(EXTRACT(EPOCH FROM (%s - start_time))) AS diff,
-                    userid
-                FROM voice_sessions_combined
+                    members.guildid AS guildid,
+                    members.userid AS userid,
+                    totals.total_time::INTEGER AS total_time
+                FROM members
+                LEFT JOIN ({}) AS totals USING (userid)
                 WHERE
-                    guildid = %s
-                    AND
-                    start_time < %s
-                    AND
-                    end_time > %s
-                GROUP BY userid
+                    members.guildid = %s
+                    {}
+                ORDER BY total_time DESC NULLS LAST
+                {}
                 """
+            ).format(
+                cls._totals_between_query(userids),
+                sql.SQL("AND members.userid = ANY(%s)") if userids is not None else sql.SQL(''),
+                sql.SQL("LIMIT %s") if limit is not None else sql.SQL(''),
             )
-            second_query_args = (since, guildid, since, since)
+            args = [end, start, guildid, end, start]
+            if userids is not None:
+                args.append(userids)
+            args.append(guildid)
+            if userids is not None:
+                args.append(userids)
+            if limit is not None:
+                args.append(limit)
+            return RawExpr(query, tuple(args))
 
+        @classmethod
+        @log_wrap(action='member_totals_between')
+        async def member_totals_between(cls, guildid: int, start, end,
+                                        userids: Optional[list[int]] = None,
+                                        limit: Optional[int] = None) -> list[dict]:
+            """
+            Return the rows of `member_totals_query`.
+            """
+            query, args = cls.member_totals_query(guildid, start, end, userids=userids, limit=limit).as_tuple()
             async with cls._connector.connection() as conn:
-                cls._connector.conn = conn
-                async with conn.transaction():
-                    async with conn.cursor() as cursor:
-                        await cursor.execute(second_query, second_query_args)
-                        overshoot_rows = await cursor.fetchall()
-                        overshoot = {row['userid']: int(row['diff']) for row in overshoot_rows}
-
-                    async with conn.cursor() as cursor:
-                        await cursor.execute(first_query, first_query_args)
-                        leaderboard = [
-                            (row['userid'], int(row['total_duration'] - overshoot.get(row['userid'], 0)))
-                            for row in await cursor.fetchall()
-                        ]
-                    leaderboard.sort(key=lambda t: t[1], reverse=True)
-            return leaderboard
+                async with conn.cursor() as cursor:
+                    await cursor.execute(query, args)
+                    return await cursor.fetchall()
+
+        @classmethod
+        @log_wrap(action='leaderboard_since')
+        async def leaderboard_since(cls, guildid: int, since):
+            """
+            Return the voice totals since the given time for each member in the guild.
+            """
+            return await cls.leaderboard_between(guildid, since, utc_now())
 
         @classmethod
         @log_wrap(action='leaderboard_all')
@@ -4,7 +4,7 @@ from io import BytesIO
 from PIL import Image
 
 from meta import LionBot
-from gui.base import CardMode
+from gui.base import CardMode, Card
 
 from .stats import get_stats_card
 from .profile import get_profile_card
@@ -26,14 +26,10 @@ async def get_full_profile(bot: LionBot, userid: int, guildid: int, mode: CardMo
     )
     stats_card, profile_card = await asyncio.gather(*get_tasks)
 
-    # Render cards
-    render_tasks = (
-        asyncio.create_task(stats_card.render(), name='render-stats-for-combined'),
-        asyncio.create_task(profile_card.render(), name='render=profile-for-combined'),
-    )
+    # Render both cards in a single batched request
+    stats_data, profile_data = await Card.render_many(stats_card, profile_card)
 
     # Load the card data into images
-    stats_data, profile_data = await asyncio.gather(*render_tasks)
     with BytesIO(stats_data) as stats_stream, BytesIO(profile_data) as profile_stream:
         with Image.open(stats_stream) as stats_image, Image.open(profile_stream) as profile_image:
             # Create a new blank image of the correct dimenstions
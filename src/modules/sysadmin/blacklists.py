@@ -16,6 +16,7 @@ from meta import LionCog, LionBot, LionContext
 from meta.logger import logging_context, log_wrap, set_logging_context
 from meta.errors import UserInputError
 from meta.app import shard_talk
+from meta.ipc import SchemaCodec
 
 from utils.ui import ChoicedEnum, Transformed, FastModal, LeoUI, error_handler_for, ModalRetryUI
 from utils.lib import EmbedField, tabulate, MessageArgs, parse_ids, error_embed
@@ -49,8 +50,8 @@ class Blacklists(LionCog):
         self.user_blacklist: set[int] = set()
         self.guild_blacklist: set[int] = set()
 
-        self.talk_user_blacklist = shard_talk.register_route("user blacklist")(self.load_user_blacklist)
-        self.talk_guild_blacklist = shard_talk.register_route("guild blacklist")(self.load_guild_blacklist)
+        self.talk_user_blacklist = shard_talk.register_route("user blacklist", codec=SchemaCodec())(self.load_user_blacklist)
+        self.talk_guild_blacklist = shard_talk.register_route("guild blacklist", codec=SchemaCodec())(self.load_guild_blacklist)
 
     async def cog_load(self):
         await self.data.init()
@@ -22,6 +22,7 @@ import discord.app_commands as appcmd
 
 from meta.logger import logging_context, log_wrap
 from meta.app import shard_talk
+from meta.ipc import SchemaCodec
 from meta import conf
 from meta.context import context, ctx_bot
 from meta.LionContext import LionContext
@@ -256,7 +257,7 @@ class Exec(LionCog):
         self.bot = bot
         self.t = bot.translator.t
 
-        self.talk_async = shard_talk.register_route('exec')(_async)
+        self.talk_async = shard_talk.register_route('exec', codec=SchemaCodec(str, result=str))(_async)
 
     async def cog_check(self, ctx: LionContext) -> bool:  # type: ignore
         passed = await sys_admin(ctx.bot, ctx.author.id)
@@ -301,7 +302,8 @@ class Exec(LionCog):
                 await ctx.interaction.edit_original_response(embed=embed)
             else:
                 # Send to given target
-                result = await self.talk_async(string).send(target)
+                # Failed remote executions reply with an empty result, decoded as None
+                result = await self.talk_async(string).send(target) or ''
                 if len(result) > 1900:
                     # Send as file
                     with StringIO(result) as fp:
@@ -373,10 +375,11 @@ class Exec(LionCog):
                     await ctx.reply(embed=embed)
                 return
             else:
-                result = await self.talk_async(string).send(target)
+                result = await self.talk_async(string).send(target) or ''
                 results = {target: result}
         else:
             results = await self.talk_async(string).broadcast(except_self=False)
+            results = {appid: result or '' for appid, result in results.items()}
 
         blocks = [f"# {appid}\n{result}" for appid, result in results.items()]
         output = "\n\n".join(blocks)
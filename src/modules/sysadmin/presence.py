@@ -11,6 +11,7 @@ from discord.app_commands.transformers import AppCommandOptionType
 from meta import LionCog, LionBot, LionContext
 from meta.logger import log_wrap
 from meta.app import shard_talk, appname
+from meta.ipc import SchemaCodec
 from utils.ui import ChoicedEnum, Transformed
 from utils.lib import tabulate
 
@@ -236,7 +237,7 @@ class PresenceCtrl(LionCog):
         self._tick = asyncio.Event()
         self._loop_task: Optional[asyncio.Task] = None
 
-        self.talk_reload_presence = shard_talk.register_route("reload presence")(self.reload_presence)
+        self.talk_reload_presence = shard_talk.register_route("reload presence", codec=SchemaCodec())(self.reload_presence)
 
     async def cog_load(self):
         await self.data.init()
@@ -1,6 +1,8 @@
 from typing import Type
 import json
 
+from psycopg import sql
+
 from data import RowModel, Table, ORDER
 from meta.logger import log_wrap, set_logging_context
 
@@ -126,6 +128,55 @@ class ListData:
 
         return data
 
+    @classmethod
+    @log_wrap(isolate=True)
+    async def read_many(cls, *parent_ids, use_cache=True) -> dict:
+        """
+        Read in all entries associated to each of the given ids, in a single query.
+
+        Returns a map parent_id -> data, with an empty list for ids without entries.
+        Fills the cache for every given id, if caching is enabled.
+        """
+        set_logging_context(action=f"Read many {cls.setting_id}")
+        results = {}
+        to_fetch = []
+        for parent_id in parent_ids:
+            if cls._cache is not None and use_cache and parent_id in cls._cache:
+                results[parent_id] = cls._cache[parent_id]
+            else:
+                to_fetch.append(parent_id)
+
+        if to_fetch:
+            table = cls._table_interface  # type: Table
+            query = table.select_where(**{cls._id_column: to_fetch}).select(cls._id_column, cls._data_column)
+            if cls._order_column:
+                query.order_by(cls._order_column, direction=cls._order_type)
+
+            fetched = {parent_id: [] for parent_id in to_fetch}
+            for row in await query:
+                fetched[row[cls._id_column]].append(row[cls._data_column])
+
+            if cls._cache is not None:
+                cls._cache.update(fetched)
+            results.update(fetched)
+
+        return results
+
+    @classmethod
+    def _array_query(cls) -> sql.Composable:
+        """
+        Expression selecting the list for a single parent id as an array, taking the parent id as a parameter.
+        """
+        order = sql.SQL('')
+        if cls._order_column:
+            order = sql.SQL(" ORDER BY {} {}").format(sql.Identifier(cls._order_column), cls._order_type.value)
+        return sql.SQL("ARRAY(SELECT {data} FROM {table} WHERE {id} = %s{order})").format(
+            data=sql.Identifier(cls._data_column),
+            table=cls._table_interface.identifier,
+            id=sql.Identifier(cls._id_column),
+            order=order,
+        )
+
     @classmethod
     @log_wrap(isolate=True)
     async def _writer(cls, id, data, add_only=False, remove_only=False, **kwargs):
@@ -179,6 +230,36 @@ class ListData:
                         cls._cache[id] = data
 
 
+@log_wrap(action='Read List Settings')
+async def read_list_settings(parent_id, *settings: Type[ListData]) -> dict[str, list]:
+    """
+    Read several list settings for the same parent id in a single query.
+
+    Updates the setting caches, and returns a map setting_id -> data.
+    """
+    if not settings:
+        return {}
+    query = sql.SQL("SELECT {}").format(
+        sql.SQL(', ').join(
+            sql.SQL("{} AS {}").format(setting._array_query(), sql.Identifier(setting.setting_id))
+            for setting in settings
+        )
+    )
+    connector = settings[0]._table_interface.connector
+    async with connector.connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(query, tuple(parent_id for _ in settings))
+            row = await cursor.fetchone()
+
+    results = {}
+    for setting in settings:
+        data = list(row[setting.setting_id])
+        if setting._cache is not None:
+            setting._cache[parent_id] = data
+        results[setting.setting_id] = data
+    return results
+
+
 class KeyValueData:
     """
     Mixin for settings implemented in a Key-Value table.
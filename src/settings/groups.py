@@ -1,8 +1,10 @@
-from typing import Generic, Type, TypeVar, Optional, overload
+from typing import Any, Generic, Type, TypeVar, Optional, overload
+from collections.abc import Mapping
+from types import MappingProxyType
 
 from data import RowModel
 
-from .data import ModelData
+from .data import ModelData, ListData, read_list_settings
 from .ui import InteractiveSetting
 from .base import BaseSetting
 
@@ -89,6 +91,55 @@ class ModelSetting(ModelData, BaseSetting):
     ...
 
 
+class ConfigSnapshot(Mapping[str, Any]):
+    """
+    Immutable snapshot of the configuration of a single object.
+
+    Stores the setting data of every model setting and cached list setting, keyed by setting_id.
+    Indexing by setting_id gives the setting value, as `config.get(setting_id).value` would.
+    Snapshots are never modified, changed configuration produces a new snapshot.
+    """
+    __slots__ = ('parent_id', '_settings', '_data', '_row_data', '_lists')
+
+    def __init__(self, parent_id, settings, data: dict[str, Any], row_data, lists: tuple):
+        self.parent_id = parent_id
+        self._settings = settings
+        self._data = MappingProxyType(data)
+        # Sources the snapshot was built from, used to detect changes
+        self._row_data = row_data
+        self._lists = lists
+
+    def __getitem__(self, setting_id):
+        data = self._data[setting_id]
+        setting_cls = self._settings[setting_id]
+        if data is None:
+            data = setting_cls._default
+        return setting_cls._data_to_value(self.parent_id, data)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def data(self, setting_id):
+        """
+        Raw stored data for the given setting, or None if unset.
+        """
+        return self._data[setting_id]
+
+    def is_current(self, row) -> bool:
+        """
+        Whether the snapshot still matches the given model row and the cached list settings.
+
+        Row data and list caches are replaced rather than modified when updated,
+        so comparing identities is sufficient.
+        """
+        if row.data is not self._row_data:
+            return False
+        return all(setting_cls._cache.get(self.parent_id, None) is data for setting_cls, data in self._lists)
+
+
 class ModelConfig:
     """
     A ModelConfig provides a central point of configuration for any object described by a single Model.
@@ -110,6 +161,8 @@ class ModelConfig:
         self.row = row
         self.kwargs = kwargs
 
+        self._snapshot: Optional[ConfigSnapshot] = None
+
     @classmethod
     def register_setting(cls, setting_cls):
         """
@@ -152,6 +205,63 @@ class ModelConfig:
         data = setting_cls._read_from_row(self.parent_id, self.row, **self.kwargs)
         return setting_cls(self.parent_id, data, **self.kwargs)
 
+    @classmethod
+    def _snapshot_lists(cls) -> list[Type[ListData]]:
+        """
+        Registered list settings which may be included in snapshots.
+
+        These must use the standard list reader and have a cache, so that changes can be detected.
+        """
+        return [
+            setting_cls for setting_cls in cls.settings.values()
+            if isinstance(setting_cls, type) and issubclass(setting_cls, ListData)
+            and setting_cls._cache is not None
+            and setting_cls._reader.__func__ is ListData._reader.__func__
+        ]
+
+    def _build_snapshot(self) -> ConfigSnapshot:
+        data = {
+            setting_id: self.row[self.settings[setting_id]._column]
+            for setting_id in self._model_settings
+        }
+        lists = []
+        for setting_cls in self._snapshot_lists():
+            if (list_data := setting_cls._cache.get(self.parent_id, None)) is not None:
+                data[setting_cls.setting_id] = tuple(list_data)
+                lists.append((setting_cls, list_data))
+        return ConfigSnapshot(self.parent_id, self.settings, data, self.row.data, tuple(lists))
+
+    @property
+    def snapshot(self) -> ConfigSnapshot:
+        """
+        Immutable snapshot of the current configuration, shared between callers.
+
+        Rebuilt from cached data whenever the model row or a cached list setting changes.
+        List settings which are not cached are missing, use `fetch_snapshot` to load them.
+        """
+        snapshot = self._snapshot
+        if snapshot is None or not snapshot.is_current(self.row):
+            snapshot = self._snapshot = self._build_snapshot()
+        return snapshot
+
+    async def fetch_snapshot(self) -> ConfigSnapshot:
+        """
+        Snapshot of the current configuration including every list setting,
+        loading any uncached list settings in a single query.
+        """
+        snapshot = self.snapshot
+        missing = [setting_cls for setting_cls in self._snapshot_lists() if setting_cls.setting_id not in snapshot]
+        if missing:
+            await read_list_settings(self.parent_id, *missing)
+            snapshot = self._snapshot = self._build_snapshot()
+        return snapshot
+
+    def invalidate_snapshot(self):
+        """
+        Discard the current snapshot, so it is rebuilt on next access.
+        """
+        self._snapshot = None
+
 
 class ModelSettings:
     """
@@ -214,10 +214,10 @@ class TextTrackerCog(LionCog):
                 + self.global_word_xp.value * sess.total_words / 100
             )
 
-            lguild = lguilds[sess.guildid]
-            periodxp = lguild.config.get('xp_per_period').value
-            wordxp = lguild.config.get('word_xp').value
-            xpcoins = lguild.config.get('coins_per_xp').value
+            config = lguilds[sess.guildid].config.snapshot
+            periodxp = config['xp_per_period']
+            wordxp = config['word_xp']
+            xpcoins = config['coins_per_xp']
             guildxp = (
                 sess.total_periods * periodxp
                 + wordxp * sess.total_words / 100
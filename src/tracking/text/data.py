@@ -38,7 +38,7 @@ class TextTrackerData(Registry):
         Schema
         ------
         CREATE TABLE text_sessions(
-          sessionid BIGSERIAL PRIMARY KEY,
+          sessionid BIGSERIAL,
           guildid BIGINT NOT NULL,
           userid BIGINT NOT NULL,
           start_time TIMESTAMPTZ NOT NULL,
@@ -51,11 +51,16 @@ class TextTrackerData(Registry):
           end_time TIMESTAMP GENERATED ALWAYS AS
             ((start_time AT TIME ZONE 'UTC') + duration * interval '1 second')
           STORED,
+          PRIMARY KEY (sessionid, start_time),
           FOREIGN KEY (guildid, userid) REFERENCES members (guildid, userid) ON DELETE CASCADE
-        );
+        ) PARTITION BY RANGE (start_time);
         CREATE INDEX text_sessions_members ON text_sessions (guildid, userid);
-        CREATE INDEX text_sessions_start_time ON text_sessions (start_time);
         CREATE INDEX text_sessions_end_time ON text_sessions (end_time);
+        CREATE TABLE text_sessions_default PARTITION OF text_sessions DEFAULT;
+
+        Partitioned by calendar month of start_time (UTC), see `create_session_partitions`.
+        Each partition has its own start_time index (BRIN once the month has closed).
+        Session ids are still unique, being drawn from a single sequence.
         """
         _tablename_ = 'text_sessions'
 
@@ -1,6 +1,8 @@
 from typing import Optional
 import asyncio
 import itertools
+import time
+import contextlib
 import datetime as dt
 
 import discord
@@ -8,7 +10,7 @@ from discord.ext import commands as cmds
 from discord import app_commands as appcmds
 
 from data import Condition
-from meta import LionBot, LionCog, LionContext
+from meta import LionBot, LionCog, LionContext, conf
 from meta.logger import log_wrap
 from meta.sharding import THIS_SHARD
 from meta.monitor import ComponentMonitor, ComponentStatus, StatusLevel
@@ -22,14 +24,43 @@ from .data import VoiceTrackerData
 from .settings import VoiceTrackerSettings, VoiceTrackerConfigUI
 
 from .session import VoiceSession, TrackedVoiceState, SessionState
+from .tracked import TrackedTodayCache
+from .timers import VoiceSessionTimers
 
 _p = babel._p
 
 
+class PendingVoiceUpdate:
+    """
+    Net voice state change of a member, coalesced over the debounce window.
+    """
+    __slots__ = ('member', 'before', 'bchannel', 'after', 'achannel', 'first_at', 'last_at', 'events', 'handle')
+
+    def __init__(self, member: discord.Member,
+                 before: TrackedVoiceState, bchannel, after: TrackedVoiceState, achannel, at: dt.datetime):
+        self.member = member
+        self.before = before
+        self.bchannel = bchannel
+        self.after = after
+        self.achannel = achannel
+        self.first_at = at
+        self.last_at = at
+        self.events = 1
+        self.handle: Optional[asyncio.TimerHandle] = None
+
+
 class VoiceTrackerCog(LionCog):
     """
     LionCog module controlling and configuring the voice tracking subsystem.
     """
+    # Sessions older than this many days are compacted into daily totals, 0 disables compaction
+    compaction_horizon = conf.bot.getint('voice_compaction_horizon_days', 365)
+    # Number of days of history compacted in each transaction
+    compaction_step = conf.bot.getint('voice_compaction_step_days', 7)
+    # How often to run the compaction job, in seconds
+    compaction_interval = 24 * 3600
+    # Delay before retrying a voice session start which failed to write, in seconds
+    start_retry_delay = 60
 
     def __init__(self, bot: LionBot):
         self.bot = bot
@@ -48,6 +79,27 @@ class VoiceTrackerCog(LionCog):
 
         self.active_sessions = VoiceSession._active_sessions_
 
+        # Voice state changes waiting out the debounce window, and running processing tasks
+        self.debounce_window = conf.bot.getfloat('voice_debounce_seconds', 2)
+        self._pending_updates: dict[tuple[int, int], PendingVoiceUpdate] = {}
+        self._update_tasks: set[asyncio.Task] = set()
+        self.debounce_stats = dict(debounced=0, coalesced=0, cancelled=0, dropped=0)
+
+        # Shared scheduler for voice session starts and expiries
+        self.timers = VoiceSessionTimers(self._start_sessions, self._expire_sessions)
+
+        # Completed voice time tracked today by each member, for the daily voice cap
+        self.tracked_today = TrackedTodayCache(conf.bot.getint('voice_tracked_cache_size', 100000))
+
+        # Whether sessions have been loaded from a full initialisation, allowing incremental resumes
+        self._loaded = False
+        # (duration, corrected sessions) of the most recent initialisation or resume
+        self.last_reconcile: Optional[tuple[float, Optional[int]]] = None
+
+        # History compaction is only run from the first shard
+        self.compactor = (self.bot.shard_id == 0)
+        self._compaction_task: Optional[asyncio.Task] = None
+
     async def _monitor(self):
         state = (
             "<"
@@ -60,6 +112,11 @@ class VoiceTrackerCog(LionCog):
                 " actual={actual}"
                 " channels={channels}"
                 " cached={cached}"
+                " registry=<{registry}>"
+                " tracked_today=<{tracked_today}>"
+                " timers=<{timers}>"
+                " debounce=<{debounce}>"
+                " last_reconcile={last_reconcile}"
                 " initial_event={initial_event}"
                 " lock={lock}"
                 ">"
@@ -72,7 +129,15 @@ class VoiceTrackerCog(LionCog):
             locked=0,
             actual=0,
             channels=0,
-            cached=sum(len(gsessions) for gsessions in VoiceSession._sessions_.values()),
+            cached=0,
+            registry=' '.join(f"{name}={value}" for name, value in VoiceSession._sessions_.stats().items()),
+            tracked_today=self.tracked_today.summary(),
+            timers=self.timers.summary(),
+            last_reconcile=self.last_reconcile,
+            debounce=' '.join(
+                f"{name}={value}"
+                for name, value in (('pending', len(self._pending_updates)), *self.debounce_stats.items())
+            ),
             initial_event=self.initialised,
             lock=self.tracking_lock
         )
@@ -91,6 +156,8 @@ class VoiceTrackerCog(LionCog):
                 if session.state:
                     channels.add(session.state.channelid)
         data['channels'] = len(channels)
+        # Registered sessions which are not active are only kept alive by the registry cache
+        data['cached'] = max(len(VoiceSession._sessions_) - data['active'], 0)
 
         for guild in self.bot.guilds:
             for channel in itertools.chain(guild.voice_channels, guild.stage_channels):
@@ -127,6 +194,8 @@ class VoiceTrackerCog(LionCog):
         # Update the tracked voice channel cache
         await self.settings.UntrackedChannels.setup(self.bot)
 
+        self.timers.start()
+
         configcog = self.bot.get_cog('ConfigCog')
         if configcog is None:
             logger.critical(
@@ -138,7 +207,14 @@ class VoiceTrackerCog(LionCog):
         if self.bot.is_ready():
             await self.initialise()
 
+        if self.compactor and self.compaction_horizon:
+            self._compaction_task = asyncio.create_task(self._compaction_loop(), name='voice-compaction')
+
     async def cog_unload(self):
+        if self._compaction_task is not None and not self._compaction_task.done():
+            self._compaction_task.cancel()
+        self.timers.stop()
+        self._drop_pending_updates()
         # TODO: Shutdown task to trigger updates on all ongoing sessions
         # Simultaneously!
         ...
@@ -177,6 +253,8 @@ class VoiceTrackerCog(LionCog):
         Assumes untracked channel data is up to date.
         """
         OngoingData = VoiceTrackerData.VoiceSessionsOngoing
+        timings = {}
+        phase_start = time.perf_counter()
 
         # Compute time to end complete sessions
         now = utc_now()
@@ -194,10 +272,22 @@ class VoiceTrackerCog(LionCog):
                 *((guildid, userid, lguilds[guildid].today) for guildid, userid in active_memberids)
             )
             tracked_today = {(row['guildid'], row['userid']): row['tracked'] for row in tracked_today_data}
+
+            # Members without ongoing data have only completed sessions, so their totals may be cached
+            ongoing_keys = set((row.guildid, row.userid) for row in ongoing)
+            self.tracked_today.seed(
+                {gid: lguild.today for gid, lguild in lguilds.items()},
+                {key: tracked for key, tracked in tracked_today.items() if key not in ongoing_keys}
+            )
         else:
             lguilds = {}
             tracked_today = {}
 
+        # Bulk compute hourly rates for the active members
+        hourly_rates = await self._calculate_rates(states)
+        timings['fetch'] = time.perf_counter() - phase_start
+        phase_start = time.perf_counter()
+
         # Zip session information together by memberid keys
         sessions: dict[tuple[int, int], tuple[Optional[TrackedVoiceState], Optional[OngoingData]]] = {}
         for row in ongoing:
@@ -227,9 +317,9 @@ class VoiceTrackerCog(LionCog):
                 # Also create/update data if required
                 lguild = lguilds[gid]
                 tomorrow = lguild.today + dt.timedelta(days=1)
-                cap = lguild.config.get('daily_voice_cap').value
+                cap = lguild.config.snapshot['daily_voice_cap']
                 tracked = tracked_today[gid, uid]
-                hourly_rate = await self._calculate_rate(gid, uid, state)
+                hourly_rate = hourly_rates[gid, uid]
 
                 if tracked >= cap:
                     # Active session is already over cap
@@ -259,12 +349,17 @@ class VoiceTrackerCog(LionCog):
                 # Ongoing data has no state, close the session
                 close_ongoing.append((gid, uid, end_at))
 
+        timings['plan'] = time.perf_counter() - phase_start
+        phase_start = time.perf_counter()
+
         # Close data that needs closing
         if close_ongoing:
             logger.info(
                 f"Ending {len(close_ongoing)} ongoing voice sessions with no matching voice state."
             )
             await self.data.VoiceSessionsOngoing.close_voice_sessions_at(*close_ongoing)
+            for gid, uid, _ in close_ongoing:
+                self.tracked_today.invalidate(gid, uid)
 
         # Update data that needs updating
         if update_ongoing:
@@ -291,6 +386,9 @@ class VoiceTrackerCog(LionCog):
             ).with_adapter(self.data.VoiceSessionsOngoing._make_rows)
             load_sessions.extend(rows)
 
+        timings['write'] = time.perf_counter() - phase_start
+        phase_start = time.perf_counter()
+
         # Create sessions from ongoing, with expiry
         for row in load_sessions:
             VoiceSession.from_ongoing(self.bot, row, expiries[(row.guildid, row.userid)])
@@ -300,10 +398,197 @@ class VoiceTrackerCog(LionCog):
             session = VoiceSession.get(self.bot, gid, uid)
             await session.schedule_start(*args)
 
+        timings['schedule'] = time.perf_counter() - phase_start
+
+        logger.info(
+            f"Successfully loaded {len(load_sessions)} and scheduled {len(schedule_sessions)} voice sessions. "
+            "Phase timings: " + ', '.join(f"{phase}={duration:.3f}s" for phase, duration in timings.items())
+        )
+
+    async def _lock_sessions(self, stack: contextlib.AsyncExitStack, memberids, timers):
+        """
+        Acquire the session locks of the given members, within the given exit stack.
+
+        Returns the sessions which are still active and have not been rescheduled in `timers` since firing.
+        Locks are always acquired in `memberid` order, so overlapping batches cannot deadlock.
+        """
+        sessions = []
+        for gid, uid in sorted(memberids):
+            session = VoiceSession.get(self.bot, gid, uid, create=False)
+            if session is not None and session.activity:
+                await stack.enter_async_context(session.lock)
+                if session.activity and (gid, uid) not in timers:
+                    sessions.append(session)
+        return sessions
+
+    async def _cancel_sessions(self, sessions):
+        """
+        Cancel the given sessions, taking each session lock in `memberid` order.
+
+        Start and expiry batches already holding a session lock finish writing first,
+        so their session data is visible to the caller, and later batches skip the cancelled sessions.
+        """
+        for session in sorted(sessions, key=lambda session: session.memberid):
+            async with session.lock:
+                session.cancel()
+
+    @log_wrap(action='Start Voice Sessions')
+    async def _start_sessions(self, memberids: list[tuple[int, int]]):
+        """
+        Start the pending voice sessions of the given members, writing the session data in bulk.
+
+        If the bulk write fails, the sessions are started individually,
+        and sessions which still fail to start are rescheduled after `start_retry_delay` seconds.
+        """
+        async with contextlib.AsyncExitStack() as stack:
+            sessions = await self._lock_sessions(stack, memberids, self.timers.starts)
+            sessions = [session for session in sessions if session.activity is SessionState.PENDING]
+            if not sessions:
+                return
+
+            try:
+                await self._write_session_starts(sessions)
+                started = len(sessions)
+            except Exception:
+                logger.exception(
+                    f"Failed to start {len(sessions)} voice sessions in bulk. Starting them individually."
+                )
+                started = 0
+                for session in sessions:
+                    try:
+                        await self._write_session_starts([session])
+                    except Exception:
+                        logger.exception(
+                            f"Failed to start voice session for member <uid:{session.userid}> "
+                            f"in guild <gid:{session.guildid}>. "
+                            f"Retrying in {self.start_retry_delay} seconds."
+                        )
+                        session._schedule_start(self.start_retry_delay)
+                    else:
+                        started += 1
+        logger.info(f"Started {started} of {len(sessions)} voice sessions.")
+
+    async def _write_session_starts(self, sessions: list[VoiceSession]):
+        """
+        Write the ongoing session data for the given pending sessions, and mark them as started.
+        """
+        # Create the members and tracked channels if required
+        await self.bot.core.lions.fetch_members(*(session.memberid for session in sessions))
+        await self.data.TrackedChannel.fetch_multiple(
+            *set((session.state.channelid, session.guildid) for session in sessions)
+        )
+
+        # Insert the ongoing sessions with the correct states
+        rows = await self.data.VoiceSessionsOngoing.table.insert_many(
+            ('guildid', 'userid', 'channelid', 'start_time', 'last_update', 'live_stream',
+             'live_video', 'hourly_coins', 'tag'),
+            *(
+                (
+                    session.guildid, session.userid, session.state.channelid,
+                    session.start_time, session.start_time,
+                    session.state.stream, session.state.video,
+                    session.hourly_rate, session._tag
+                )
+                for session in sessions
+            )
+        ).with_adapter(self.data.VoiceSessionsOngoing._make_rows)
+        rowmap = {(row.guildid, row.userid): row for row in rows}
+        for session in sessions:
+            session._started(rowmap[session.memberid])
+
+    @log_wrap(action='Expire Voice Sessions')
+    async def _expire_sessions(self, memberids: list[tuple[int, int]]):
+        """
+        Expire the voice sessions of the given members which have reached the daily voice cap,
+        closing the session data in bulk and scheduling the next session starts.
+        """
+        async with contextlib.AsyncExitStack() as stack:
+            sessions = await self._lock_sessions(stack, memberids, self.timers.expiries)
+            if not sessions:
+                return
+
+            now = utc_now()
+            ongoing = [session for session in sessions if session.activity is SessionState.ONGOING]
+            if ongoing:
+                try:
+                    await self.data.VoiceSessionsOngoing.close_voice_sessions_at(
+                        *((session.guildid, session.userid, now) for session in ongoing)
+                    )
+                except Exception:
+                    logger.exception(
+                        f"Failed to close {len(ongoing)} expired voice sessions. "
+                        f"Retrying in {self.start_retry_delay} seconds."
+                    )
+                    retry_at = utc_now() + dt.timedelta(seconds=self.start_retry_delay)
+                    for session in ongoing:
+                        session.schedule_expiry(retry_at)
+                    sessions = [session for session in sessions if session.activity is not SessionState.ONGOING]
+                    ongoing = []
+            completions = [session._rank_completion(now) for session in ongoing]
+            for session in sessions:
+                await session._expired(now)
+            rank_cog = self.bot.get_cog('RankCog')
+            if completions and rank_cog is not None:
+                asyncio.create_task(rank_cog.on_voice_session_complete(*completions))
+
+            rates = {}
+            try:
+                rates = await self._calculate_rates({session.memberid: session.state for session in sessions})
+            except Exception:
+                logger.exception(f"Failed to calculate hourly rates for {len(sessions)} expired voice sessions.")
+            rescheduled = 0
+            for session in sessions:
+                try:
+                    delay, start, expiry = await self._session_boundaries_for(session.guildid, session.userid)
+                    session._reschedule(delay, start, expiry, rates[session.memberid])
+                except Exception:
+                    logger.exception(
+                        f"Failed to reschedule expired voice session for member <uid:{session.userid}> "
+                        f"in guild <gid:{session.guildid}>. Retrying in {self.start_retry_delay} seconds."
+                    )
+                    session._retry_expiry(self.start_retry_delay)
+                else:
+                    rescheduled += 1
+        logger.info(f"Expired {len(ongoing)} and rescheduled {rescheduled} of {len(sessions)} voice sessions.")
+
+    async def _resume_sessions(self, states: dict[tuple[int, int], TrackedVoiceState]) -> int:
+        """
+        Reconcile the loaded sessions with a fresh voice state snapshot,
+        only reloading members whose state differs from the state of their active session.
+
+        Returns the number of members whose sessions were corrected.
+        """
+        known = {
+            (session.guildid, session.userid): session
+            for gsessions in self.active_sessions.values() for session in gsessions.values()
+        }
+        changed = [
+            key for key in states.keys() | known.keys()
+            if key not in states or key not in known or known[key].state != states[key]
+        ]
+        if not changed:
+            return 0
+
+        # Deactivate the stale sessions, fresh sessions are created on load
+        await self._cancel_sessions([known[key] for key in changed if key in known])
+        for gid, uid in changed:
+            VoiceSession._sessions_.pop(gid, uid)
+
+        # Load the ongoing data of the changed members only
+        ongoing = await self.data.VoiceSessionsOngoing.fetch_where(
+            guildid=list(set(gid for gid, _ in changed)),
+            userid=list(set(uid for _, uid in changed))
+        )
+        changed_keys = set(changed)
+        ongoing = [row for row in ongoing if (row.guildid, row.userid) in changed_keys]
         logger.info(
-            f"Successfully loaded {len(load_sessions)} and scheduled {len(schedule_sessions)} voice sessions."
+            f"Resuming voice tracking with {len(changed)} changed voice states "
+            f"and {len(ongoing)} matching ongoing sessions."
         )
 
+        await self._load_sessions({key: states[key] for key in changed if key in states}, ongoing)
+        return len(changed)
+
     @log_wrap(action='refresh guild sessions')
     async def refresh_guild_sessions(self, guild: discord.Guild):
         """
@@ -323,15 +608,18 @@ class VoiceTrackerCog(LionCog):
             logger.debug(f"Voice state refresh for <gid: {guild.id}> is past lock")
 
             # Deactivate any ongoing session tasks in this guild
-            active = self.active_sessions.pop(guild.id, {}).values()
-            for session in active:
-                session.cancel()
+            active = list(self.active_sessions.get(guild.id, {}).values())
+            await self._cancel_sessions(active)
+            self.active_sessions.pop(guild.id, None)
             # Clear registry
-            VoiceSession._sessions_.pop(guild.id, None)
+            VoiceSession._sessions_.pop_guild(guild.id)
+            self._drop_pending_updates(guild.id)
 
             # Update untracked channel information for this guild
+            # Reloaded with the other uncached guild list settings in a single query
             self.untracked_channels.pop(guild.id, None)
-            await self.settings.UntrackedChannels.get(guild.id)
+            lguild = await self.bot.core.lions.fetch_guild(guild.id)
+            await lguild.config.fetch_snapshot()
 
             # Read tracked voice states
             states = {}
@@ -356,6 +644,44 @@ class VoiceTrackerCog(LionCog):
             )
 
 
+    @log_wrap(action='Compact Voice History')
+    async def compact_history(self) -> int:
+        """
+        Compact all voice sessions older than the compaction horizon into daily totals.
+
+        Works forwards from the oldest session in steps of `compaction_step` days,
+        so a large backlog is compacted in a series of short transactions.
+        Returns the number of sessions compacted.
+        """
+        model = self.data.VoiceSessions
+        horizon = (utc_now() - dt.timedelta(days=self.compaction_horizon)).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        oldest = await model.oldest_start()
+        if oldest is None or oldest >= horizon:
+            return 0
+
+        step = dt.timedelta(days=max(self.compaction_step, 1))
+        until = oldest.astimezone(dt.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        total = 0
+        while until < horizon:
+            until = min(until + step, horizon)
+            total += await model.compact_before(until)
+            # Leave room for the rest of the application between batches
+            await asyncio.sleep(1)
+        logger.info(f"Compacted {total} voice sessions from before {horizon} into daily totals.")
+        return total
+
+    async def _compaction_loop(self):
+        while True:
+            try:
+                await self.compact_history()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Unexpected exception while compacting voice history. Retrying next cycle.")
+            await asyncio.sleep(self.compaction_interval)
+
     # ----- Event Handlers -----
     @LionCog.listener('on_ready')
     @log_wrap(action='Init Voice Sessions')
@@ -378,14 +704,21 @@ class VoiceTrackerCog(LionCog):
         # And make sure future events will be processed after initialisation
         # Note only events occurring after our voice state snapshot will be processed
         async with self.tracking_lock:
-            # Deactivate all ongoing sessions
-            active = [session for gsessions in self.active_sessions.values() for session in gsessions.values()]
-            for session in active:
-                session.cancel()
-            self.active_sessions.clear()
-
-            # Also clear the session registry cache
-            VoiceSession._sessions_.clear()
+            reconcile_start = time.perf_counter()
+            # Sessions loaded by this tracker are kept in step with their data,
+            # so after a reconnect only members whose state changed need to be reloaded
+            resuming = self._loaded
+            self._drop_pending_updates()
+
+            if not resuming:
+                # Deactivate all ongoing sessions
+                active = [session for gsessions in self.active_sessions.values() for session in gsessions.values()]
+                await self._cancel_sessions(active)
+                self.active_sessions.clear()
+
+                # Also clear the session registry cache
+                VoiceSession._sessions_.clear()
+                self.tracked_today.clear()
 
             # Refresh untracked information for all guilds we are in
             await self.settings.UntrackedChannels.setup(self.bot)
@@ -405,21 +738,35 @@ class VoiceTrackerCog(LionCog):
             )
             self.handle_events = True
 
-            # Load ongoing session data for the entire shard
-            ongoing = await self.data.VoiceSessionsOngoing.fetch_where(THIS_SHARD)
+            if resuming:
+                corrected = await self._resume_sessions(states)
+            else:
+                # Load ongoing session data for the entire shard
+                ongoing = await self.data.VoiceSessionsOngoing.fetch_where(THIS_SHARD)
+                logger.info(
+                    f"Retrieved {len(ongoing)} ongoing voice sessions from data. Beginning reload."
+                )
+
+                await self._load_sessions(states, ongoing)
+                corrected = None
+                self._loaded = True
+
+            duration = time.perf_counter() - reconcile_start
+            self.last_reconcile = (duration, corrected)
             logger.info(
-                f"Retrieved {len(ongoing)} ongoing voice sessions from data. Beginning reload."
+                f"Voice session {'resume' if resuming else 'initialisation'} completed in {duration:.3f}s"
+                + (f", correcting {corrected} sessions." if resuming else ".")
             )
 
-            await self._load_sessions(states, ongoing)
-
             self.initialised.set()
 
     @LionCog.listener("on_voice_state_update")
-    @log_wrap(action='Voice Track')
     async def session_voice_tracker(self, member, before, after):
         """
-        Spawns the correct tasks from members joining, leaving, and changing live state.
+        Debounce voice state changes for each member.
+
+        Changes arriving within `debounce_window` seconds of the first change are coalesced,
+        and only the net change between the first and final states is processed.
         """
         if not self.handle_events:
             # Rely on initialisation to handle current state
@@ -435,16 +782,75 @@ class VoiceTrackerCog(LionCog):
             # Should we dispatch an event for the blacklist?
             return
 
-        # Serialise state before waiting on the lock
+        # Serialise state immediately, with the time of the change
+        now = utc_now()
         bstate = TrackedVoiceState.from_voice_state(before)
         astate = TrackedVoiceState.from_voice_state(after)
         if bstate == astate:
             # If tracked state did not change, ignore event
             return
-
-        bchannel = before.channel if before else None
         achannel = after.channel if after else None
 
+        key = (member.guild.id, member.id)
+        pending = self._pending_updates.get(key, None)
+        if pending is not None:
+            # Coalesce into the pending change
+            pending.member = member
+            pending.after = astate
+            pending.achannel = achannel
+            pending.last_at = now
+            pending.events += 1
+            self.debounce_stats['coalesced'] += 1
+        elif self.debounce_window > 0:
+            pending = PendingVoiceUpdate(member, bstate, before.channel if before else None, astate, achannel, now)
+            self._pending_updates[key] = pending
+            pending.handle = asyncio.get_running_loop().call_later(
+                self.debounce_window, self._flush_pending_update, key
+            )
+            self.debounce_stats['debounced'] += 1
+        else:
+            pending = PendingVoiceUpdate(member, bstate, before.channel if before else None, astate, achannel, now)
+            await self._process_voice_update(pending)
+
+    def _flush_pending_update(self, key):
+        pending = self._pending_updates.pop(key, None)
+        if pending is not None:
+            task = asyncio.create_task(self._process_voice_update(pending))
+            self._update_tasks.add(task)
+            task.add_done_callback(self._update_tasks.discard)
+
+    def _drop_pending_updates(self, guildid: Optional[int] = None):
+        """
+        Discard pending voice state changes, in the given guild or everywhere.
+
+        Used when taking a fresh voice state snapshot, which already reflects these changes.
+        """
+        keys = [key for key in self._pending_updates if guildid is None or key[0] == guildid]
+        for key in keys:
+            self._pending_updates.pop(key).handle.cancel()
+        self.debounce_stats['dropped'] += len(keys)
+
+    @log_wrap(action='Voice Track')
+    async def _process_voice_update(self, update: 'PendingVoiceUpdate'):
+        """
+        Spawns the correct tasks from members joining, leaving, and changing live state.
+        """
+        if not self.handle_events:
+            return
+
+        member = update.member
+        bstate, astate = update.before, update.after
+        bchannel, achannel = update.bchannel, update.achannel
+        if update.events > 1:
+            logger.debug(
+                f"Coalesced {update.events} voice state changes for member <uid:{member.id}> "
+                f"in guild <gid:{member.guild.id}>."
+            )
+        if bstate == astate:
+            # Changes cancelled out within the debounce window
+            self.debounce_stats['cancelled'] += 1
+            return
+
         # Take tracking lock
         async with self.tracking_lock:
             # Fetch tracked member session state
@@ -474,7 +880,7 @@ class VoiceTrackerCog(LionCog):
                             f"in guild '{member.guild.name}' <gid: {member.guild.id}> "
                             " because they left the channel."
                         )
-                        await session.close()
+                        await session.close(at=update.first_at)
                     elif not self.is_untracked(bchannel):
                         # Leaving tracked channel without an active session?
                         logger.warning(
@@ -496,10 +902,12 @@ class VoiceTrackerCog(LionCog):
                             f"joined channel '{achannel}' <cid:{joining}> "
                             f"during voice session in channel <cid:{tstate.channelid}>!"
                         )
-                        await session.close()
+                        await session.close(at=update.first_at)
                     if not self.is_untracked(achannel):
                         # If the channel they are joining is tracked, schedule a session start for them
-                        delay, start, expiry = await self._session_boundaries_for(member.guild.id, member.id)
+                        delay, start, expiry = await self._session_boundaries_for(
+                            member.guild.id, member.id, at=update.last_at
+                        )
                         hourly_rate = await self._calculate_rate(member.guild.id, member.id, astate)
 
                         logger.debug(
@@ -531,7 +939,7 @@ class VoiceTrackerCog(LionCog):
                 # Recalculate the economy rate, and update the session
                 # Touch the ongoing session with the new state
                 hourly_rate = await self._calculate_rate(member.guild.id, member.id, astate)
-                await session.update(new_state=astate, new_rate=hourly_rate)
+                await session.update(new_state=astate, new_rate=hourly_rate, at=update.last_at)
 
     @LionCog.listener("on_guildset_untracked_channels")
     @LionCog.listener("on_guildset_hourly_reward")
@@ -550,6 +958,9 @@ class VoiceTrackerCog(LionCog):
             logger.debug(
                 f"Voice tracker handling '{setting.setting_id}' event for guild <gid: {guildid}>."
             )
+            if setting.setting_id == 'timezone':
+                # Days have moved, cached daily totals no longer apply
+                self.tracked_today.invalidate_guild(guildid)
             await self.refresh_guild_sessions(guild)
 
     async def _calculate_rate(self, guildid, userid, state):
@@ -559,9 +970,10 @@ class VoiceTrackerCog(LionCog):
         Takes into account economy bonuses.
         """
         lguild = await self.bot.core.lions.fetch_guild(guildid)
-        hourly_rate = lguild.config.get('hourly_reward').value
+        config = lguild.config.snapshot
+        hourly_rate = config['hourly_reward']
         if state.live:
-            hourly_rate += lguild.config.get('hourly_live_bonus').value
+            hourly_rate += config['hourly_live_bonus']
 
         economy = self.bot.get_cog('Economy')
         if economy is not None:
@@ -572,9 +984,37 @@ class VoiceTrackerCog(LionCog):
 
         return hourly_rate
 
-    async def _session_boundaries_for(self, guildid: int, userid: int) -> tuple[float, dt.datetime, dt.datetime]:
+    async def _calculate_rates(self, states: dict[tuple[int, int], TrackedVoiceState]) -> dict[tuple[int, int], float]:
+        """
+        Calculate the economy hourly rate for many members at once.
+
+        Equivalent to `_calculate_rate` for each member, but fetches economy bonuses in bulk.
+        Assumes the guilds of the given members are already cached.
+        """
+        lguilds = await self.bot.core.lions.fetch_guilds(*set(gid for gid, _ in states))
+        rates = {}
+        for (gid, uid), state in states.items():
+            config = lguilds[gid].config.snapshot
+            hourly_rate = config['hourly_reward']
+            if state.live:
+                hourly_rate += config['hourly_live_bonus']
+            rates[(gid, uid)] = hourly_rate
+
+        economy = self.bot.get_cog('Economy')
+        if economy is not None:
+            bonuses = await economy.fetch_economy_bonuses(*rates.keys())
+            for key, bonus in bonuses.items():
+                rates[key] *= bonus
+        elif rates:
+            logger.warning("Economy cog not loaded! Voice tracker cannot account for economy bonuses.")
+
+        return rates
+
+    async def _session_boundaries_for(self, guildid: int, userid: int,
+                                      at: Optional[dt.datetime] = None) -> tuple[float, dt.datetime, dt.datetime]:
         """
         Compute when the next session for this member should start and expire.
+        If `at` is given, the session is computed as if requested at that time.
 
         Assumes the member does not have a currently active session!
         Takes into account the daily voice cap, and the member's study time so far today.
@@ -589,17 +1029,18 @@ class VoiceTrackerCog(LionCog):
         """
         lguild = await self.bot.core.lions.fetch_guild(guildid)
         now = lguild.now
+        requested = at.astimezone(now.tzinfo) if at is not None else now
         tomorrow = lguild.today + dt.timedelta(days=1)
 
         studied_today = await self.fetch_tracked_today(guildid, userid)
-        cap = lguild.config.get('daily_voice_cap').value
+        cap = lguild.config.snapshot['daily_voice_cap']
 
         if studied_today >= cap - 90:
             start_time = tomorrow
             delay = (tomorrow - now).total_seconds()
         else:
-            start_time = now
-            delay = 20
+            start_time = requested
+            delay = max(20 - (now - requested).total_seconds(), 0)
 
         remaining = cap - studied_today
         expiry = start_time + dt.timedelta(seconds=remaining)
@@ -614,9 +1055,17 @@ class VoiceTrackerCog(LionCog):
 
         Applies cache wherever possible.
         """
-        # TODO: Design caching scheme for this.
         lguild = await self.bot.core.lions.fetch_guild(guildid)
-        return await self.data.VoiceSessions.study_time_since(guildid, userid, lguild.today)
+        today = lguild.today
+        tracked = self.tracked_today.get(guildid, userid, today)
+        if tracked is None:
+            version = self.tracked_today.begin(guildid, userid)
+            tracked = await self.data.VoiceSessions.study_time_since(guildid, userid, today)
+            # Only cache totals without an ongoing session, since these stay valid until the next session closes
+            session = VoiceSession.get(self.bot, guildid, userid, create=False)
+            if session is None or session.activity is not SessionState.ONGOING:
+                self.tracked_today.set(guildid, userid, today, int(tracked or 0), version=version)
+        return tracked
 
     @LionCog.listener("on_guild_join")
     @log_wrap(action='Join Guild Voice Sessions')
@@ -639,13 +1088,13 @@ class VoiceTrackerCog(LionCog):
             return
 
         async with self.tracking_lock:
-            sessions = VoiceSession._active_sessions_.pop(guild.id, {})
-            VoiceSession._sessions_.pop(guild.id, None)
+            sessions = list(VoiceSession._active_sessions_.get(guild.id, {}).values())
+            await self._cancel_sessions(sessions)
+            VoiceSession._active_sessions_.pop(guild.id, None)
+            VoiceSession._sessions_.pop_guild(guild.id)
+            self.tracked_today.invalidate_guild(guild.id)
             now = utc_now()
-            to_close = []  # (guildid, userid, _at)
-            for session in sessions.values():
-                session.cancel()
-                to_close.append((session.guildid, session.userid, now))
+            to_close = [(session.guildid, session.userid, now) for session in sessions]  # (guildid, userid, _at)
             if to_close:
                 await self.data.VoiceSessionsOngoing.close_voice_sessions_at(*to_close)
             logger.info(
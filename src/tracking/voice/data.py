@@ -1,10 +1,11 @@
+from typing import Optional
 import datetime as dt
 from itertools import chain
 from psycopg import sql
 
 from meta.logger import log_wrap
 from data import RowModel, Registry, Table
-from data.columns import Integer, String, Timestamp, Bool
+from data.columns import Integer, String, Timestamp, Bool, Column
 
 from core.data import CoreData
 from utils.lib import utc_now
@@ -236,7 +237,7 @@ class VoiceTrackerData(Registry):
         Schema
         ------
         CREATE TABLE voice_sessions(
-          sessionid SERIAL PRIMARY KEY,
+          sessionid SERIAL,
           guildid BIGINT NOT NULL,
           userid BIGINT NOT NULL,
           channelid BIGINT REFERENCES tracked_channels (channelid),
@@ -248,9 +249,16 @@ class VoiceTrackerData(Registry):
           stream_duration INTEGER DEFAULT 0,
           video_duration INTEGER DEFAULT 0,
           transactionid INTEGER REFERENCES coin_transactions (transactionid) ON UPDATE CASCADE ON DELETE CASCADE,
+          PRIMARY KEY (sessionid, start_time),
           FOREIGN KEY (guildid, userid) REFERENCES members (guildid, userid) ON DELETE CASCADE
-        );
-        CREATE INDEX session_history_members ON session_history (guildid, userid, start_time);
+        ) PARTITION BY RANGE (start_time);
+        CREATE INDEX voice_session_members ON voice_sessions (guildid, userid, start_time);
+        CREATE INDEX voice_session_guild_time ON voice_sessions USING BTREE (guildid, start_time);
+        CREATE INDEX voice_session_user_time ON voice_sessions USING BTREE (userid, start_time);
+        CREATE TABLE voice_sessions_default PARTITION OF voice_sessions DEFAULT;
+
+        Partitioned by calendar month of start_time (UTC), see `create_session_partitions`.
+        Session ids are still unique, being drawn from a single sequence.
         """
         _tablename_ = "voice_sessions"
 
@@ -307,6 +315,74 @@ class VoiceTrackerData(Registry):
                     )
                     return await cursor.fetchall()
 
+        @classmethod
+        @log_wrap(action='oldest_voice_session')
+        async def oldest_start(cls) -> Optional[dt.datetime]:
+            """
+            Start time of the oldest completed session, if any.
+            """
+            async with cls._connector.connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(
+                        "SELECT start_time FROM voice_sessions ORDER BY start_time ASC LIMIT 1"
+                    )
+                    row = await cursor.fetchone()
+                    return row['start_time'] if row else None
+
+        @classmethod
+        @log_wrap(action='compact_voice_sessions')
+        async def compact_before(cls, until: dt.datetime) -> int:
+            """
+            Fold all sessions starting before `until` into `voice_session_days`.
+            `until` should be a UTC midnight.
+            Returns the number of sessions removed.
+            """
+            async with cls._connector.connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(
+                        "SELECT compact_voice_sessions(%s) AS compacted",
+                        (until,)
+                    )
+                    row = await cursor.fetchone()
+                    return row['compacted'] if row else 0
+
+    class VoiceSessionDays(RowModel):
+        """
+        Daily per-member totals of compacted voice sessions.
+
+        Schema
+        ------
+        CREATE TABLE voice_session_days(
+          guildid BIGINT NOT NULL,
+          userid BIGINT NOT NULL,
+          day DATE NOT NULL,
+          sessions INTEGER NOT NULL DEFAULT 0,
+          duration INTEGER NOT NULL DEFAULT 0,
+          live_duration INTEGER NOT NULL DEFAULT 0,
+          stream_duration INTEGER NOT NULL DEFAULT 0,
+          video_duration INTEGER NOT NULL DEFAULT 0,
+          coins_earned INTEGER NOT NULL DEFAULT 0,
+          PRIMARY KEY (guildid, userid, day),
+          FOREIGN KEY (guildid, userid) REFERENCES members (guildid, userid) ON DELETE CASCADE
+        );
+        CREATE INDEX voice_session_days_users ON voice_session_days (userid, day);
+
+        Sessions are split at UTC midnight, and `duration` is the part of each session within the day.
+        Session counts, stream durations and coins are attributed to the day the session started.
+        The cross-guild totals, with overlapping sessions counted once, are kept in `voice_user_days`.
+        """
+        _tablename_ = "voice_session_days"
+
+        guildid = Integer(primary=True)
+        userid = Integer(primary=True)
+        day: Column[dt.date] = Column(primary=True)
+        sessions = Integer()
+        duration = Integer()
+        live_duration = Integer()
+        stream_duration = Integer()
+        video_duration = Integer()
+        coins_earned = Integer()
+
     """
     Schema
     ------
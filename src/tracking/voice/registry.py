@@ -0,0 +1,121 @@
+from typing import TYPE_CHECKING, Iterator, Optional
+from collections import defaultdict
+import weakref
+
+from cachetools import TTLCache
+
+if TYPE_CHECKING:
+    from .session import VoiceSession
+
+
+class _CountingTTLCache(TTLCache):
+    """
+    TTLCache recording how many entries were evicted for space or expired.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.evicted = 0
+        self.expired = 0
+
+    def popitem(self):
+        item = super().popitem()
+        self.evicted += 1
+        return item
+
+    def expire(self, *args, **kwargs):
+        before = len(self)
+        result = super().expire(*args, **kwargs)
+        self.expired += before - len(self)
+        return result
+
+
+class SessionRegistry:
+    """
+    Global registry of VoiceSessions, keyed by (guildid, userid).
+
+    Sessions are held weakly, so any session referenced elsewhere (e.g. active sessions) stays registered.
+    A single size and TTL bounded cache keeps recently used inactive sessions alive,
+    and a secondary guild index allows iterating the sessions of a guild without scanning the registry.
+    """
+    def __init__(self, maxsize: int = 50000, ttl: int = 60 * 60):
+        # (guildid, userid) -> weak session reference
+        self._refs: dict[tuple[int, int], weakref.ref] = {}
+        # guildid -> userids with registered sessions
+        self._guilds: defaultdict[int, set[int]] = defaultdict(set)
+        # Strong references to recently used sessions
+        self._recent = _CountingTTLCache(maxsize=maxsize, ttl=ttl)
+
+    def __len__(self):
+        return len(self._refs)
+
+    def _discard(self, key, ref=None):
+        """
+        Remove the given key from the registry and guild index.
+        If `ref` is given, only remove the key if it is still registered with that reference.
+        """
+        if ref is not None and self._refs.get(key, None) is not ref:
+            return
+        self._refs.pop(key, None)
+        guildid, userid = key
+        userids = self._guilds.get(guildid, None)
+        if userids is not None:
+            userids.discard(userid)
+            if not userids:
+                self._guilds.pop(guildid, None)
+
+    def get(self, guildid: int, userid: int) -> Optional['VoiceSession']:
+        key = (guildid, userid)
+        ref = self._refs.get(key, None)
+        session = ref() if ref is not None else None
+        if session is not None:
+            self._recent[key] = session
+        return session
+
+    def add(self, session: 'VoiceSession'):
+        key = (session.guildid, session.userid)
+        # The reference removes itself from the registry when the session is collected
+        self._refs[key] = weakref.ref(session, lambda ref, key=key: self._discard(key, ref))
+        self._guilds[session.guildid].add(session.userid)
+        self._recent[key] = session
+
+    def pop(self, guildid: int, userid: int) -> Optional['VoiceSession']:
+        key = (guildid, userid)
+        ref = self._refs.get(key, None)
+        self._discard(key)
+        self._recent.pop(key, None)
+        return ref() if ref is not None else None
+
+    def guild_sessions(self, guildid: int) -> Iterator['VoiceSession']:
+        """
+        Iterate over the registered sessions in the given guild.
+        """
+        for userid in list(self._guilds.get(guildid, ())):
+            ref = self._refs.get((guildid, userid), None)
+            if ref is not None and (session := ref()) is not None:
+                yield session
+
+    def pop_guild(self, guildid: int) -> list['VoiceSession']:
+        """
+        Remove and return all registered sessions in the given guild.
+        """
+        sessions = list(self.guild_sessions(guildid))
+        for userid in list(self._guilds.get(guildid, ())):
+            self.pop(guildid, userid)
+        return sessions
+
+    def clear(self):
+        self._refs.clear()
+        self._guilds.clear()
+        # Clearing pops every item, which should not count as evictions
+        evicted = self._recent.evicted
+        self._recent.clear()
+        self._recent.evicted = evicted
+
+    def stats(self) -> dict[str, int]:
+        return dict(
+            registered=len(self._refs),
+            guilds=len(self._guilds),
+            recent=len(self._recent),
+            evicted=self._recent.evicted,
+            expired=self._recent.expired,
+        )
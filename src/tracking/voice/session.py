@@ -5,12 +5,12 @@ import datetime as dt
 import asyncio
 
 import discord
-from cachetools import TTLCache
 
 from utils.lib import utc_now
-from meta import LionBot
-from data import WeakCache
+from meta import LionBot, conf
 from .data import VoiceTrackerData
+from .timers import VoiceSessionTimers
+from .registry import SessionRegistry
 
 from . import logger, babel
 
@@ -33,6 +33,7 @@ class TrackedVoiceState:
         equal = other.channelid == self.channelid
         equal = equal and other.video == self.video
         equal = equal and other.stream == self.stream
+        return equal
 
     def __bool__(self):
         """Whether this is an active state"""
@@ -71,15 +72,19 @@ class VoiceSession:
     __slots__ = (
         'bot',
         'guildid', 'userid',
-        'registry',
-        'start_task', 'expiry_task',
+        'registry', 'timers',
+        'pending', 'expires_at',
         'data', 'state', 'hourly_rate',
         '_tag', '_start_time',
         'lock',
         '__weakref__'
     )
 
-    _sessions_ = defaultdict(lambda: WeakCache(TTLCache(5000, ttl=60*60)))  # Registry mapping
+    # Global registry of sessions, keeping recently used inactive sessions alive
+    _sessions_ = SessionRegistry(
+        maxsize=conf.bot.getint('voice_session_cache_size', 50000),
+        ttl=conf.bot.getint('voice_session_cache_ttl', 60 * 60)
+    )
 
     # Maintains strong references to active sessions
     _active_sessions_: dict[int, dict[int, 'VoiceSession']] = defaultdict(dict) 
@@ -88,10 +93,13 @@ class VoiceSession:
         self.bot = bot
         self.guildid = guildid
         self.userid = userid
-        self.registry: VoiceTrackerData = self.bot.get_cog('VoiceTrackerCog').data
+        cog = self.bot.get_cog('VoiceTrackerCog')
+        self.registry: VoiceTrackerData = cog.data
+        # Shared scheduler driving session starts and expiries
+        self.timers: VoiceSessionTimers = cog.timers
 
-        self.start_task = None  # Task triggering a delayed session start
-        self.expiry_task = None  # Task triggering a session expiry from reaching the daily cap
+        self.pending = False  # Whether a delayed session start is scheduled
+        self.expires_at: Optional[dt.datetime] = None  # When the session reaches the daily cap
         self.data: Optional[VoiceTrackerData.VoiceSessionsOngoing] = data  # Ongoing session data
 
         # TrackedVoiceState set when session is active
@@ -105,12 +113,31 @@ class VoiceSession:
         # Ensures state changes are atomic and serialised
         self.lock = asyncio.Lock()
 
+    @property
+    def memberid(self) -> tuple[int, int]:
+        return (self.guildid, self.userid)
+
     def cancel(self):
-        if self.start_task is not None:
-            self.start_task.cancel()
-        if self.expiry_task is not None:
-            self.expiry_task.cancel()
+        """
+        Deactivate the session without closing its data, cancelling any scheduled start or expiry.
+
+        Should be called with the session lock held,
+        so that a running start or expiry batch finishes first, and later batches skip the session.
+        """
+        self.timers.cancel(self.memberid)
         self._active_sessions_[self.guildid].pop(self.userid, None)
+        self.pending = False
+        self.data = None
+
+    def _retry_expiry(self, delay: float):
+        """
+        Retry handling the expiry of this session after `delay` seconds.
+
+        Used when an expired session could not be rescheduled.
+        The session is kept pending without a start, so it stays active but does not track time.
+        """
+        self.pending = True
+        self.schedule_expiry(utc_now() + dt.timedelta(seconds=delay))
 
     @property
     def tag(self) -> Optional[str]:
@@ -132,7 +159,7 @@ class VoiceSession:
     def activity(self):
         if self.data is not None:
             return SessionState.ONGOING
-        elif self.start_task is not None:
+        elif self.pending:
             return SessionState.PENDING
         else:
             return SessionState.INACTIVE
@@ -153,10 +180,10 @@ class VoiceSession:
         Fetch the VoiceSession for the given member. Respects cache.
         Creates the session if it doesn't already exist.
         """
-        session = cls._sessions_[guildid].get(userid, None)
+        session = cls._sessions_.get(guildid, userid)
         if session is None and create:
             session = cls(bot, guildid, userid)
-            cls._sessions_[guildid][userid] = session
+            cls._sessions_.add(session)
         return session
 
     @classmethod
@@ -192,46 +219,24 @@ class VoiceSession:
         self._start_time = start_time
         self._tag = None
 
-        self.start_task = asyncio.create_task(self._start_after(delay, start_time))
+        self._schedule_start(delay)
         self.schedule_expiry(expire_time)
         self._active_sessions_[self.guildid][self.userid] = self
 
-    async def _start_after(self, delay: int, start_time: dt.datetime):
-        """
-        Start a new voice session with the given state and hourly rate.
+    def _schedule_start(self, delay: float):
+        self.pending = True
+        self.timers.schedule_start(self.memberid, utc_now().timestamp() + delay)
 
-        Creates the tracked_channel if required.
+    def _started(self, data: VoiceTrackerData.VoiceSessionsOngoing):
         """
-        await asyncio.sleep(delay)
-
-        async with self.lock:
-            logger.info(
-                f"Starting voice session for member <uid:{self.userid}> in guild <gid:{self.guildid}> "
-                f"and channel <cid:{self.state.channelid}>."
-            )
-            # Create the lion if required
-            await self.bot.core.lions.fetch_member(self.guildid, self.userid)
-
-            # Create the tracked channel if required
-            await self.registry.TrackedChannel.fetch_or_create(
-                self.state.channelid, guildid=self.guildid, deleted=False
-            )
+        Mark the pending session as started with the given ongoing session data.
 
-            # Insert an ongoing_session with the correct state, set data
-            state = self.state
-            self.data = await self.registry.VoiceSessionsOngoing.create(
-                guildid=self.guildid,
-                userid=self.userid,
-                channelid=state.channelid,
-                start_time=start_time,
-                last_update=start_time,
-                live_stream=state.stream,
-                live_video=state.video,
-                hourly_coins=self.hourly_rate,
-                tag=self._tag
-            )
-            self.bot.dispatch('voice_session_start', self.data)
-            self.start_task = None
+        The session starts are written in bulk by the voice tracker,
+        see `VoiceTrackerCog._start_sessions`.
+        """
+        self.data = data
+        self.pending = False
+        self.bot.dispatch('voice_session_start', self.data)
 
     def schedule_expiry(self, expire_time):
         """
@@ -239,16 +244,15 @@ class VoiceSession:
         """
         if not self.activity:
             raise ValueError("Cannot schedule expiry for an inactive session!")
-        if self.expiry_task is not None and not self.expiry_task.done():
-            self.expiry_task.cancel()
+        self.expires_at = expire_time
+        self.timers.schedule_expiry(self.memberid, expire_time.timestamp())
 
-        delay = (expire_time - utc_now()).total_seconds()
-        self.expiry_task = asyncio.create_task(self._expire_after(delay))
-
-    async def update(self, new_state: Optional[TrackedVoiceState] = None, new_rate: Optional[int] = None):
+    async def update(self, new_state: Optional[TrackedVoiceState] = None, new_rate: Optional[int] = None,
+                     at: Optional[dt.datetime] = None):
         """
         Update the session state with the provided voice state or hourly rate.
         Also applies to pending states.
+        The ongoing session is updated as of the given time, or the current time if not given.
 
         Raises ValueError if the state does not match the saved session (i.e. wrong channel)
         """
@@ -264,68 +268,67 @@ class VoiceSession:
                 await self.data.update_voice_session_at(
                     guildid=self.guildid,
                     userid=self.userid,
-                    _at=utc_now(),
+                    _at=max(at, self.data.last_update) if at is not None else utc_now(),
                     stream=self.state.stream,
                     video=self.state.video,
                     rate=self.hourly_rate
                 )
 
-    async def _expire_after(self, delay: int):
+    async def _expired(self, now: dt.datetime):
         """
-        Expire a session which has exceeded the daily voice cap.
+        Handle the session expiring from reaching the daily voice cap.
+
+        Called with the session lock held, after the ongoing session data has been closed at `now`.
+        The session is left inactive, keeping its voice state,
+        and the next session start is scheduled by `_reschedule`.
         """
-        # TODO: Logging, and guild logging, and user notification (?)
-        await asyncio.sleep(delay)
         logger.info(
             f"Expiring voice session for member <uid:{self.userid}> in guild <gid:{self.guildid}> "
             f"and channel <cid:{self.state.channelid}>."
         )
-        async with self.lock:
-            await self._close()
-
-            if self.activity:
-                t = self.bot.translator.t
-                lguild = await self.bot.core.lions.fetch_guild(self.guildid)
-                if self.activity is SessionState.ONGOING and self.data is not None:
-                    lguild.log_event(
-                        t(_p(
-                            'eventlog|event:voice_session_expired|title',
-                            "Member Voice Session Expired"
-                        )),
-                        t(_p(
-                            'eventlog|event:voice_session_expired|desc',
-                            "{member}'s voice session in {channel} expired "
-                            "because they reached the daily voice cap."
-                        )).format(
-                            member=f"<@{self.userid}>",
-                            channel=f"<#{self.state.channelid}>",
-                        ),
-                        start=discord.utils.format_dt(self.data.start_time),
-                        coins_earned=int(self.data._total_coins_earned),
-                    )
-
-            if self.start_task is not None:
-                self.start_task.cancel()
-                self.start_task = None
-
-            self.data = None
-
-            cog = self.bot.get_cog('VoiceTrackerCog')
-            delay, start, expiry = await cog._session_boundaries_for(self.guildid, self.userid)
-            hourly_rate = await cog._calculate_rate(self.guildid, self.userid, self.state)
-
-            self.hourly_rate = hourly_rate
-            self._start_time = start
+        if self.activity is SessionState.ONGOING:
+            # Expired sessions are passed to the rank hook together
+            await self._closed(now, update_ranks=False)
+
+            t = self.bot.translator.t
+            lguild = await self.bot.core.lions.fetch_guild(self.guildid)
+            lguild.log_event(
+                t(_p(
+                    'eventlog|event:voice_session_expired|title',
+                    "Member Voice Session Expired"
+                )),
+                t(_p(
+                    'eventlog|event:voice_session_expired|desc',
+                    "{member}'s voice session in {channel} expired "
+                    "because they reached the daily voice cap."
+                )).format(
+                    member=f"<@{self.userid}>",
+                    channel=f"<#{self.state.channelid}>",
+                ),
+                start=discord.utils.format_dt(self.data.start_time),
+                coins_earned=int(self.data._total_coins_earned),
+            )
+        self.data = None
+        self.pending = False
+        self.timers.starts.cancel(self.memberid)
 
-            self.start_task = asyncio.create_task(self._start_after(delay, start))
-            self.schedule_expiry(expiry)
+    def _reschedule(self, delay: float, start_time: dt.datetime, expire_time: dt.datetime, hourly_rate):
+        """
+        Schedule the next session start for an expired session, keeping the current voice state.
+        """
+        self.hourly_rate = hourly_rate
+        self._start_time = start_time
+        self._schedule_start(delay)
+        self.schedule_expiry(expire_time)
 
-    async def close(self):
+    async def close(self, at: Optional[dt.datetime] = None):
         """
         Close the session, or cancel the pending session. Idempotent.
+
+        The ongoing session is closed at the given time, or the current time if not given.
         """
         async with self.lock:
-            await self._close()
+            await self._close(at)
             if self.activity:
                 t = self.bot.translator.t
                 lguild = await self.bot.core.lions.fetch_guild(self.guildid)
@@ -360,13 +363,9 @@ class VoiceSession:
                         ),
                     )
 
-            if self.start_task is not None:
-                self.start_task.cancel()
-                self.start_task = None
-
-            if self.expiry_task is not None:
-                self.expiry_task.cancel()
-                self.expiry_task = None
+            self.timers.cancel(self.memberid)
+            self.pending = False
+            self.expires_at = None
 
             self.data = None
             self.state = None
@@ -377,19 +376,38 @@ class VoiceSession:
             # Always release strong reference to session (to allow garbage collection)
             self._active_sessions_[self.guildid].pop(self.userid)
 
-    async def _close(self):
+    async def _close(self, at: Optional[dt.datetime] = None):
         if self.activity is SessionState.ONGOING:
-            # End the ongoing session
-            now = utc_now()
+            # End the ongoing session, never before it was last updated
+            now = max(at, self.data.last_update) if at is not None else utc_now()
             await self.data.close_study_session_at(self.guildid, self.userid, now)
+            await self._closed(now)
+
+    def _rank_completion(self, now: dt.datetime) -> tuple:
+        """
+        Completed session data for the rank hook, for the ongoing session closed at `now`.
+        """
+        return (self.guildid, self.userid, int((now - self.data.start_time).total_seconds()), 0, now)
+
+    async def _closed(self, now: dt.datetime, update_ranks: bool = True):
+        """
+        Post-process the ongoing session after its data was closed at `now`.
+
+        If `update_ranks` is not set, the caller is responsible for passing the completed session to the rank hook.
+        """
+        # Keep the cached daily total current, before the next session boundaries are computed
+        cog = self.bot.get_cog('VoiceTrackerCog')
+        if cog is not None:
+            lguild = await self.bot.core.lions.fetch_guild(self.guildid)
+            cog.tracked_today.record_session(
+                self.guildid, self.userid, lguild.today, self.data.start_time, now
+            )
 
-            # TODO: Something a bit saner/safer.. dispatch the finished session instead?
-            self.bot.dispatch('voice_session_end', self.data, now)
+        # TODO: Something a bit saner/safer.. dispatch the finished session instead?
+        self.bot.dispatch('voice_session_end', self.data, now)
 
-            # Rank update
-            # TODO: Change to broadcasted event?
-            rank_cog = self.bot.get_cog('RankCog')
-            if rank_cog is not None:
-                asyncio.create_task(rank_cog.on_voice_session_complete(
-                    (self.guildid, self.userid, int((utc_now() - self.data.start_time).total_seconds()), 0)
-                ))
+        # Rank update
+        # TODO: Change to broadcasted event?
+        rank_cog = self.bot.get_cog('RankCog')
+        if update_ranks and rank_cog is not None:
+            asyncio.create_task(rank_cog.on_voice_session_complete(self._rank_completion(now)))
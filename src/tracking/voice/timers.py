@@ -0,0 +1,196 @@
+from typing import TypeVar, Generic, Optional, Callable, Coroutine, Any
+from collections import defaultdict
+import asyncio
+import math
+
+from utils.lib import utc_now
+
+from . import logger
+
+Timerid = TypeVar('Timerid')
+
+
+class TimerWheel(Generic[Timerid]):
+    """
+    Hashed timer wheel storing timers in slots of `resolution` seconds.
+
+    Slots are keyed by absolute tick rather than a fixed ring,
+    so timers may be scheduled arbitrarily far ahead.
+    Scheduling and cancelling timers is O(1),
+    and all timers due in a tick are collected together by `pop_due`.
+
+    Each timerid must be unique and hashable.
+    Scheduling an existing timerid replaces its timer.
+    """
+    def __init__(self, resolution: float = 1):
+        self.resolution = resolution
+
+        self._slots: defaultdict[int, set[Timerid]] = defaultdict(set)
+        self._timers: dict[Timerid, int] = {}  # timerid -> tick
+        # Next tick which has not been collected
+        self._cursor = self._tick_of(utc_now().timestamp())
+
+        self.scheduled = 0
+        self.fired = 0
+        self.cancelled = 0
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, timerid):
+        return timerid in self._timers
+
+    def _tick_of(self, timestamp: float) -> int:
+        return math.floor(timestamp / self.resolution)
+
+    def next_tick_at(self) -> float:
+        """
+        Timestamp at which the next uncollected tick ends.
+        """
+        return (self._cursor + 1) * self.resolution
+
+    def schedule(self, timerid: Timerid, timestamp: float):
+        """
+        Schedule the given timer to fire at the given timestamp.
+        Timers in the past fire on the next collection.
+        """
+        self._remove(timerid)
+        # Timers fire at the end of their tick, so never early
+        tick = max(self._tick_of(timestamp), self._cursor)
+        self._slots[tick].add(timerid)
+        self._timers[timerid] = tick
+        self.scheduled += 1
+
+    def cancel(self, timerid: Timerid) -> bool:
+        """
+        Cancel the given timer, if it exists.
+        """
+        if removed := self._remove(timerid):
+            self.cancelled += 1
+        return removed
+
+    def _remove(self, timerid: Timerid) -> bool:
+        tick = self._timers.pop(timerid, None)
+        if tick is None:
+            return False
+        slot = self._slots[tick]
+        slot.discard(timerid)
+        if not slot:
+            self._slots.pop(tick)
+        return True
+
+    def pop_due(self, timestamp: float) -> list[Timerid]:
+        """
+        Remove and return all timers in the ticks which have completed by the given timestamp.
+        """
+        due = []
+        last = self._tick_of(timestamp) - 1
+        while self._cursor <= last:
+            slot = self._slots.pop(self._cursor, None)
+            if slot:
+                for timerid in slot:
+                    self._timers.pop(timerid, None)
+                due.extend(slot)
+            self._cursor += 1
+        self.fired += len(due)
+        return due
+
+    def clear(self):
+        self.cancelled += len(self._timers)
+        self._slots.clear()
+        self._timers.clear()
+
+    def summary(self) -> str:
+        return (
+            f"pending={len(self._timers)} scheduled={self.scheduled} "
+            f"fired={self.fired} cancelled={self.cancelled}"
+        )
+
+
+Memberid = tuple[int, int]
+BatchExecutor = Callable[[list[Memberid]], Coroutine[Any, Any, None]]
+
+
+class VoiceSessionTimers:
+    """
+    Shared scheduler for voice session starts and expiries.
+
+    Replaces a sleeping task per session with two timer wheels driven by a single loop.
+    Timers due in the same tick are passed together to the batch executors,
+    so the resulting database writes may be made in bulk.
+    """
+    def __init__(self, on_start: BatchExecutor, on_expire: BatchExecutor, resolution: float = 1):
+        self.on_start = on_start
+        self.on_expire = on_expire
+
+        self.starts: TimerWheel[Memberid] = TimerWheel(resolution)
+        self.expiries: TimerWheel[Memberid] = TimerWheel(resolution)
+
+        self._loop_task: Optional[asyncio.Task] = None
+        # Keep references to running batches
+        self._running: set[asyncio.Task] = set()
+
+    def schedule_start(self, memberid: Memberid, timestamp: float):
+        self.starts.schedule(memberid, timestamp)
+
+    def schedule_expiry(self, memberid: Memberid, timestamp: float):
+        self.expiries.schedule(memberid, timestamp)
+
+    def cancel(self, memberid: Memberid):
+        """
+        Cancel any pending start or expiry for the given member.
+        """
+        self.starts.cancel(memberid)
+        self.expiries.cancel(memberid)
+
+    def start(self):
+        if self._loop_task and not self._loop_task.done():
+            self._loop_task.cancel()
+        self._loop_task = asyncio.create_task(self._run())
+        return self._loop_task
+
+    def stop(self):
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            self._loop_task = None
+        self.starts.clear()
+        self.expiries.clear()
+
+    async def _run(self):
+        while True:
+            # Sleep to the end of the earliest uncollected tick
+            next_at = min(self.starts.next_tick_at(), self.expiries.next_tick_at())
+            delay = next_at - utc_now().timestamp()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            now = utc_now().timestamp()
+            # Collect both wheels before executing, so a batch cannot observe its own timers
+            starting = self.starts.pop_due(now)
+            expiring = self.expiries.pop_due(now)
+            if starting:
+                self._spawn(self.on_start, starting)
+            if expiring:
+                self._spawn(self.on_expire, expiring)
+
+    def _spawn(self, executor: BatchExecutor, memberids: list[Memberid]):
+        task = asyncio.create_task(self._execute(executor, memberids))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _execute(self, executor: BatchExecutor, memberids: list[Memberid]):
+        try:
+            await executor(memberids)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception(
+                f"Unhandled exception in voice session timer batch '{executor.__name__}' "
+                f"for {len(memberids)} members."
+            )
+
+    def summary(self) -> str:
+        return (
+            f"starts=<{self.starts.summary()}> expiries=<{self.expiries.summary()}> "
+            f"running={len(self._running)}"
+        )
@@ -0,0 +1,122 @@
+from typing import Optional
+from collections import OrderedDict
+import datetime as dt
+
+
+class TrackedTodayCache:
+    """
+    Cache of the completed voice time each member has tracked so far today.
+
+    Entries are keyed by member and store the guild-local day they were computed for,
+    so they lapse naturally when the guild rolls over to the next day.
+    Values only include completed sessions, and are kept current by `record_session` when sessions close.
+    Sessions closed in bulk (e.g. on reload) invalidate their members instead.
+
+    Reads from the database are bracketed by `begin` and `set`,
+    and the value read is discarded if the member changed in between.
+    """
+    def __init__(self, max_size: int = 100000):
+        self.max_size = max_size
+        # (guildid, userid) -> (day start, completed seconds)
+        self._cache: OrderedDict[tuple[int, int], tuple[dt.datetime, int]] = OrderedDict()
+        # Members currently being read from the database -> number of changes since the read began
+        self._pending: dict[tuple[int, int], int] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.seeded = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def begin(self, guildid: int, userid: int) -> int:
+        """
+        Mark the start of a database read for the given member.
+        Returns the token to pass to `set` with the result.
+        """
+        return self._pending.setdefault((guildid, userid), 0)
+
+    def _changed(self, key):
+        if key in self._pending:
+            self._pending[key] += 1
+
+    def get(self, guildid: int, userid: int, today: dt.datetime) -> Optional[int]:
+        key = (guildid, userid)
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] == today:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def set(self, guildid: int, userid: int, today: dt.datetime, tracked: int, version: Optional[int] = None):
+        """
+        Store the completed time tracked today by the given member.
+
+        If `version` is given, this completes a read started with `begin`,
+        and the value is only stored when the member has not changed since.
+        """
+        key = (guildid, userid)
+        if version is not None and self._pending.pop(key, None) != version:
+            return
+        self._cache[key] = (today, tracked)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def seed(self, today: dict[int, dt.datetime], tracked: dict[tuple[int, int], int]):
+        """
+        Bulk store completed tracked times, given the current day of each guild.
+        """
+        for (guildid, userid), seconds in tracked.items():
+            self.set(guildid, userid, today[guildid], int(seconds))
+        self.seeded += len(tracked)
+
+    def record_session(self, guildid: int, userid: int, today: dt.datetime,
+                       start: dt.datetime, end: dt.datetime):
+        """
+        Account for a completed session in the cached value, if there is one for the current day.
+        """
+        key = (guildid, userid)
+        self._changed(key)
+        entry = self._cache.get(key)
+        if entry is not None:
+            if entry[0] == today:
+                overlap = (min(end, today + dt.timedelta(days=1)) - max(start, today)).total_seconds()
+                self._cache[key] = (today, entry[1] + max(int(overlap), 0))
+            else:
+                self._cache.pop(key)
+
+    def invalidate(self, guildid: int, userid: int):
+        key = (guildid, userid)
+        self._changed(key)
+        if self._cache.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def invalidate_guild(self, guildid: int):
+        for key in self._pending:
+            if key[0] == guildid:
+                self._pending[key] += 1
+        keys = [key for key in self._cache if key[0] == guildid]
+        for key in keys:
+            self._cache.pop(key)
+        self.invalidations += len(keys)
+
+    def clear(self):
+        self.invalidations += len(self._cache)
+        for key in self._pending:
+            self._pending[key] += 1
+        self._cache.clear()
+
+    def summary(self) -> str:
+        return (
+            f"size={len(self._cache)} hits={self.hits} misses={self.misses} "
+            f"hit_rate={self.hit_rate:.1%} seeded={self.seeded} invalidations={self.invalidations}"
+        )